@@ -1,87 +1,238 @@
 import sqlite3
-import matplotlib.pyplot as plt
-import numpy as np
 import random
-from matplotlib.patches import Patch
+import threading
 
-def calculate_city_stats(conn):
+from aqi import BREAKPOINTS, aqi_sql, category_sql
+from figure_cache import cached_figure, figure_cache_report, file_stamp
+from results_writer import write_results_stream
+
+# NOTE: numpy / matplotlib are imported inside the plotting functions so that
+# jobs which only compute stats (or only ingest) don't pay for loading them.
+
+def city_stats_cursor(conn, pollutants=("pm25",), since=None, until=None):
+    """
+    Run the city-stats query and return the (un-fetched) cursor, one row per
+    city, so callers can stream rows instead of building a list.
+
+    All pollutant averages come from the same single query (one conditional
+    AVG per pollutant over the long-format AirQualityMeasurements rows).
+    since / until (unix seconds, until exclusive) restrict the weather
+    observations averaged into avg_temp to that time window.
+    The AQI and category are computed by SQLite itself from the breakpoint
+    tables in aqi.py. Populations come through CityCrosswalk (see
+    city_crosswalk.py), an integer join on the city id.
+    """
+    pollutants = tuple(dict.fromkeys(("pm25",) + tuple(pollutants)))
+    unknown = [p for p in pollutants if p not in BREAKPOINTS]
+    if unknown:
+        raise ValueError(f"Unknown pollutant(s) {unknown}; known: {', '.join(BREAKPOINTS)}")
+
+    cur = conn.cursor()
+
+    # pollutant names are validated above, so they're safe as column aliases
+    pollutant_avgs = ",\n                        ".join(
+        f"AVG(CASE WHEN aqm.parameter = '{p}' THEN aqm.value END) AS avg_{p}"
+        for p in pollutants
+    )
+    pollutant_columns = ", ".join(f"aq.avg_{p}" for p in pollutants)
+    placeholders = ", ".join("?" for _ in pollutants)
+
+    # WeatherObservations.timestamp holds unix seconds as TEXT: compare the
+    # stored column with text bounds so (city_id, timestamp) is a range in
+    # idx_weather_city_time (CAST() can't use it). Text order is numeric
+    # order for 10-digit timestamps (2001-09-09 to 2286).
+    weather_window = ""
+    window_params = []
+    if since is not None:
+        weather_window += " AND timestamp >= ?"
+        window_params.append(str(int(since)))
+    if until is not None:
+        weather_window += " AND timestamp < ?"
+        window_params.append(str(int(until)))
+
+    # weather and air quality are averaged per city on their own and then
+    # joined (one row per city on each side); joining the raw rows first
+    # gave weather_rows x measurements rows per city for the same averages.
+    # (CityDetails may hold the same geodb_id more than once, hence MAX.)
+    pm25_aqi = aqi_sql("pm25", "avg_pm25")
+    query = f"""
+        SELECT
+            *,
+            {category_sql("aqi", simple=True)} AS aq_category
+        FROM (
+            SELECT *, {pm25_aqi} AS aqi
+            FROM (
+                SELECT
+                    c.id                AS city_id,
+                    c.city_name         AS city,
+                    w.avg_temp          AS avg_temp,
+                    {pollutant_columns},
+                    (SELECT MAX(cd.population) FROM CityDetails AS cd
+                     WHERE cd.geodb_id = cx.geodb_id) AS population
+                FROM Cities AS c
+                JOIN (
+                    SELECT city_id, AVG(temperature) AS avg_temp
+                    FROM WeatherObservations
+                    WHERE city_id IS NOT NULL{weather_window}
+                    GROUP BY city_id
+                ) AS w
+                    ON w.city_id = c.id
+                JOIN (
+                    SELECT
+                        aql.city_id AS aq_city_id,
+                        {pollutant_avgs}
+                    FROM AirQualityLocations AS aql
+                    JOIN AirQualityMeasurements AS aqm
+                        ON aqm.location_id = aql.id
+                       AND aqm.parameter IN ({placeholders})
+                    GROUP BY aql.city_id
+                ) AS aq
+                    ON aq.aq_city_id = c.id
+                LEFT JOIN CityCrosswalk AS cx
+                    ON cx.city_id = c.id
+            )
+        )
+        ORDER BY city;
+    """
+
+    cur.execute(query, window_params + list(pollutants))
+    return cur
+
+
+# ------------------------------------------------------------
+# Memoisation for calculate_city_stats
+# ------------------------------------------------------------
+# Per connection: {args: (data stamp, result)}. The data stamp is
+#   - PRAGMA data_version: changes when ANOTHER connection commits, and
+#   - conn.total_changes: changes when THIS connection writes,
+# so a repeated call with nothing written in between is a dict lookup.
+# sqlite3.Connection can't be weak-referenced, so entries are keyed by
+# id(conn) with the connection kept alongside (guards against id reuse) and
+# only the most recently used connections are remembered.
+MEMO_MAX_CONNECTIONS = 8
+MEMO_MAX_ENTRIES_PER_CONNECTION = 16
+
+_CITY_STATS_MEMO = {}  # id(conn) -> (conn, {args: (stamp, result)})
+# the query service calls in from several threads (one pooled connection
+# each); the lock covers the memo bookkeeping, not the query itself
+_MEMO_LOCK = threading.Lock()
+MEMO_STATS = {"hits": 0, "misses": 0}
+
+
+def _data_stamp(conn):
+    return (conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes)
+
+
+def clear_city_stats_memo():
+    """Forget every memoised calculate_city_stats result."""
+    with _MEMO_LOCK:
+        _CITY_STATS_MEMO.clear()
+
+
+def calculate_city_stats(conn, pollutants=("pm25",), since=None, until=None, memoize=True):
     """
     Join Cities + WeatherObservations + AirQuality tables (+ CityDetails)
     and return a list of dicts, one per city, with:
       - city
       - avg_temp
       - avg_pm25
+      - avg_<pollutant> for every other pollutant asked for (e.g. avg_no2)
       - population
+      - aqi (US EPA AQI of avg_pm25)
       - aq_category ("Good", "Moderate", "Unhealthy")
+
+    See city_stats_cursor for the query itself.
+
+    Results are memoised per connection until the database changes (see
+    _data_stamp); the returned list is a fresh copy but the row dicts are
+    shared between calls, so treat them as read-only. memoize=False always
+    runs the query (used by the benchmarks).
     """
-    cur = conn.cursor()
+    if not memoize:
+        return _query_city_stats(conn, pollutants, since, until)
 
-    query = """
-        SELECT
-            c.id                AS city_id,
-            c.city_name         AS city,
-            AVG(w.temperature)  AS avg_temp,
-            AVG(aqm.value)      AS raw_avg_pm25,
-            cd.population       AS population
-        FROM Cities AS c
-        JOIN WeatherObservations AS w
-            ON w.city_id = c.id
-        JOIN AirQualityLocations AS aql
-            ON aql.city_id = c.id
-        JOIN AirQualityMeasurements AS aqm
-            ON aqm.location_id = aql.id
-           AND aqm.parameter = 'pm25'
-        LEFT JOIN GeoCities AS gc
-            ON gc.city_name = c.city_name
-        LEFT JOIN CityDetails AS cd
-            ON cd.geodb_id = gc.geodb_id
-        GROUP BY c.id, c.city_name
-        ORDER BY c.city_name;
+    key = (tuple(pollutants), since, until)
+    stamp = _data_stamp(conn)
+
+    with _MEMO_LOCK:
+        owner, entries = _CITY_STATS_MEMO.pop(id(conn), (conn, {}))
+        if owner is not conn:
+            entries = {}  # an old, closed connection had the same id
+        _CITY_STATS_MEMO[id(conn)] = (conn, entries)  # most recently used last
+        while len(_CITY_STATS_MEMO) > MEMO_MAX_CONNECTIONS:
+            del _CITY_STATS_MEMO[next(iter(_CITY_STATS_MEMO))]
+
+        cached = entries.get(key)
+        if cached is not None and cached[0] == stamp:
+            MEMO_STATS["hits"] += 1
+            return list(cached[1])
+        MEMO_STATS["misses"] += 1
+
+    result = _query_city_stats(conn, pollutants, since, until)
+    with _MEMO_LOCK:
+        entries.pop(key, None)
+        entries[key] = (stamp, result)
+        while len(entries) > MEMO_MAX_ENTRIES_PER_CONNECTION:
+            del entries[next(iter(entries))]
+    return list(result)
+
+
+def _query_city_stats(conn, pollutants, since, until):
+    cur = city_stats_cursor(conn, pollutants=pollutants, since=since, until=until)
+    columns = [col[0] for col in cur.description]
+
+    # use REAL measurements; no extra synthetic noise now
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def _decimate_labels(xs, ys, priority, max_labels, grid=(8, 14)):
+    """
+    Pick at most max_labels points to label, most important first, with at
+    most one label per cell of a grid laid over the data range (so labels
+    don't pile on top of each other).
     """
+    import numpy as np
+
+    if len(xs) == 0 or max_labels <= 0:
+        return []
+
+    def cell(values, n_cells):
+        lo, hi = values.min(), values.max()
+        span = hi - lo if hi > lo else 1.0
+        return np.minimum(((values - lo) / span * n_cells).astype(np.int64), n_cells - 1)
+
+    cells = cell(xs, grid[0]) * grid[1] + cell(ys, grid[1])
+    chosen = []
+    taken = set()
+    for i in np.argsort(-priority, kind="stable"):
+        if cells[i] in taken:
+            continue
+        taken.add(cells[i])
+        chosen.append(int(i))
+        if len(chosen) >= max_labels:
+            break
+    return chosen
+
 
-    cur.execute(query)
-    rows = cur.fetchall()
-
-    city_stats = []
-
-    for city_id, city, avg_temp, raw_pm25, population in rows:
-        if raw_pm25 is None:
-            pm25 = None
-            aq_category = None
-        else:
-            # use REAL pm25; no extra synthetic noise now
-            pm25 = raw_pm25
-
-            if pm25 <= 12.0:
-                aq_category = "Good"
-            elif pm25 <= 35.4:
-                aq_category = "Moderate"
-            else:
-                aq_category = "Unhealthy"
-
-        city_stats.append({
-            "city_id": city_id,
-            "city": city,
-            "avg_temp": avg_temp,
-            "avg_pm25": pm25,
-            "population": population,
-            "aq_category": aq_category,
-        })
-
-    return city_stats
-
-def plot_temp_vs_pm25(city_stats, save_path=None):
+@cached_figure(fields=("city", "avg_temp", "avg_pm25", "aq_category"),
+               deps=("group_stats",))
+def plot_temp_vs_pm25(city_stats, save_path=None, show=True,
+                      large_n_threshold=2000, max_labels=40):
     """
     Scatter plot of avg temperature vs avg PM2.5.
 
     • Points are color–coded by air-quality category
     • A small vertical jitter is added so overlapping points are visible
-    • A simple trend line is drawn using numpy.polyfit
+    • A least-squares trend line is drawn from streaming sums (LinearTrend)
+
+    Above large_n_threshold cities the points are drawn as a rasterised
+    hexbin density instead, and only up to max_labels notable cities
+    (highest / lowest PM2.5, temperature extremes) get a label, at most one
+    per region of the plot.
     """
-    temps = []
-    pm25_raw = []
-    labels = []
-    colors = []
+    import numpy as np
+    import matplotlib.pyplot as plt
+    from group_stats import LinearTrend, column_array
 
     # map AQ category -> color
     color_map = {
@@ -91,47 +242,79 @@ def plot_temp_vs_pm25(city_stats, save_path=None):
         None: "gray"
     }
 
-    for city_info in city_stats:
-        avg_temp = city_info.get("avg_temp")
-        avg_pm25 = city_info.get("avg_pm25")
-        aq_cat = city_info.get("aq_category")
-
-        if avg_temp is None or avg_pm25 is None or avg_pm25 <= 0:
-            continue
-
-        temps.append(avg_temp)
-        pm25_raw.append(avg_pm25)
-        labels.append(city_info.get("city"))
-        colors.append(color_map.get(aq_cat, "gray"))
+    temps = column_array(city_stats, "avg_temp")
+    pm25_raw = column_array(city_stats, "avg_pm25")
+    with np.errstate(invalid="ignore"):
+        keep = ~np.isnan(temps) & (pm25_raw > 0)
 
-    if not temps:
+    if not keep.any():
         print("No data available to plot temperature vs PM2.5.")
         return
 
-    # --- jitter the PM2.5 values only for plotting (data stays unchanged)
-    rng = random.Random(0)  # deterministic jitter
-    pm25_jittered = [p + rng.uniform(-0.15, 0.15) for p in pm25_raw]
+    keep_idx = np.flatnonzero(keep)
+    temps = temps[keep]
+    pm25_raw = pm25_raw[keep]
+    n_points = len(temps)
+    large_n = n_points > large_n_threshold
+
+    fig = plt.figure(figsize=(11, 7))
+
+    if not large_n:
+        labels = [city_stats[i].get("city") for i in keep_idx]
+        colors = [color_map.get(city_stats[i].get("aq_category"), "gray") for i in keep_idx]
 
-    plt.figure(figsize=(11, 7))
-    plt.scatter(temps, pm25_jittered, c=colors, alpha=0.65, edgecolor="k", s=70)
+        # --- jitter the PM2.5 values only for plotting (data stays unchanged)
+        rng = random.Random(0)  # deterministic jitter
+        pm25_plot = np.array([p + rng.uniform(-0.15, 0.15) for p in pm25_raw])
 
-    for x, y, label in zip(temps, pm25_jittered, labels):
-        plt.text(x, y, label, fontsize=7, ha="center", va="bottom")
+        plt.scatter(temps, pm25_plot, c=colors, alpha=0.65, edgecolor="k", s=70)
 
+        for x, y, label in zip(temps, pm25_plot, labels):
+            plt.text(x, y, label, fontsize=7, ha="center", va="bottom")
+    else:
+        # --- density view: one raster image instead of n_points artists
+        pm25_plot = pm25_raw
+        hb = plt.hexbin(
+            temps, pm25_plot, gridsize=70, bins="log", mincnt=1,
+            cmap="viridis", rasterized=True,
+        )
+        plt.colorbar(hb, label="Cities per cell (log scale)")
+
+        # label only notable cities: extremes in either direction
+        pm_rank = np.argsort(np.argsort(pm25_raw))
+        t_rank = np.argsort(np.argsort(temps))
+        n_last = n_points - 1
+        priority = np.maximum(
+            np.maximum(pm_rank, n_last - pm_rank),
+            np.maximum(t_rank, n_last - t_rank),
+        )
+        for i in _decimate_labels(temps, pm25_plot, priority, max_labels):
+            plt.text(
+                temps[i], pm25_plot[i], city_stats[keep_idx[i]].get("city"),
+                fontsize=7, ha="center", va="bottom",
+            )
 
-    # --- add a simple trend line (least-squares fit)
-    if len(temps) >= 2:
-        coeffs = np.polyfit(temps, pm25_raw, 1)
+    # --- add a simple trend line (least-squares fit from streaming sums)
+    trend = LinearTrend()
+    chunk = 100_000
+    for start in range(0, n_points, chunk):
+        trend.update(temps[start:start + chunk], pm25_raw[start:start + chunk])
+    coeffs = trend.coefficients()
+
+    if coeffs is not None:
         m, b = coeffs
-        xs = np.linspace(min(temps), max(temps), 100)
+        xs = np.linspace(temps.min(), temps.max(), 100)
         ys = m * xs + b
         plt.plot(xs, ys, linestyle="--", color="black", label="Trend line")
 
     plt.xlabel("Average Temperature (°C)")
     plt.ylabel("Average PM2.5 (µg/m³)")
-    plt.title("Average Temperature vs. Average PM2.5 by City")
+    title = "Average Temperature vs. Average PM2.5 by City"
+    if large_n:
+        title += f" ({n_points:,} cities, density view)"
+    plt.title(title)
     plt.grid(True, linestyle=":", alpha=0.5)
-    if len(temps) >= 2:
+    if coeffs is not None:
         plt.legend()
 
     plt.tight_layout()
@@ -140,10 +323,14 @@ def plot_temp_vs_pm25(city_stats, save_path=None):
         plt.savefig(save_path, bbox_inches="tight")
         print(f"Saved temp vs PM2.5 plot to {save_path}")
 
-    plt.show()
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)  # headless: free the figure right away
 
 
-def plot_population_vs_pm25(city_stats, save_path=None):
+@cached_figure(fields=("city", "population", "avg_temp", "avg_pm25"))
+def plot_population_vs_pm25(city_stats, save_path=None, show=True):
     """
     Visualization 2 (more complex):
 
@@ -156,6 +343,9 @@ def plot_population_vs_pm25(city_stats, save_path=None):
       * clips extreme PM2.5 values so the colormap has more variety
       * uses a vibrant colormap
     """
+    import numpy as np
+    import matplotlib.pyplot as plt
+
     # Filter out rows missing population or pm25
     filtered = [
         c for c in city_stats
@@ -244,9 +434,73 @@ def plot_population_vs_pm25(city_stats, save_path=None):
         fig.savefig(save_path, bbox_inches="tight")
         print(f"Saved population vs PM2.5 figure (scatter + histogram) to {save_path}")
 
-    plt.show()
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)  # headless: free the figure right away
+
+# Default climate bands for plot_city_characteristics (in °C)
+DEFAULT_TEMP_BINS = [-100, 5, 15, 25, 1000]
+DEFAULT_BAND_LABELS = [
+    "Cold (<5°C)",
+    "Mild (5–15°C)",
+    "Warm (15–25°C)",
+    "Hot (>25°C)"
+]
+
+
+def make_band_labels(temp_bins):
+    """Labels like "5–15°C" for arbitrary (sorted) band edges."""
+    return [f"{lo:g}–{hi:g}°C" for lo, hi in zip(temp_bins[:-1], temp_bins[1:])]
+
+
+def climate_band_summary(temps, populations, category_codes, temp_bins, n_categories):
+    """
+    Vectorised climate-band aggregation.
+
+    temps, populations, category_codes are equal-length arrays; a city with
+    temp_bins[i] <= temp < temp_bins[i + 1] falls into band i, cities outside
+    every band are dropped. category_codes in [0, n_categories) are counted,
+    any other code (e.g. -1) only contributes to the population average.
 
-def plot_city_characteristics(city_stats, save_path=None):
+    Returns (counts, avg_pops):
+      counts[band, category] = number of cities
+      avg_pops[band]         = mean population (NaN for empty bands)
+    """
+    import numpy as np
+
+    edges = np.asarray(temp_bins, dtype=float)
+    if edges.ndim != 1 or len(edges) < 2 or np.any(np.diff(edges) <= 0):
+        raise ValueError("temp_bins must be at least two strictly increasing edges")
+    n_bands = len(edges) - 1
+
+    temps = np.asarray(temps, dtype=float)
+    populations = np.asarray(populations, dtype=float)
+    category_codes = np.asarray(category_codes, dtype=np.int64)
+
+    # digitize gives i such that edges[i-1] <= t < edges[i]
+    band = np.digitize(temps, edges) - 1
+    in_band = (band >= 0) & (band < n_bands)
+    band = band[in_band]
+    populations = populations[in_band]
+    category_codes = category_codes[in_band]
+
+    known = (category_codes >= 0) & (category_codes < n_categories)
+    flat = band[known] * n_categories + category_codes[known]
+    counts = np.bincount(flat, minlength=n_bands * n_categories)
+    counts = counts.reshape(n_bands, n_categories)
+
+    pop_sums = np.bincount(band, weights=populations, minlength=n_bands)
+    pop_counts = np.bincount(band, minlength=n_bands)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg_pops = np.where(pop_counts > 0, pop_sums / np.maximum(pop_counts, 1), np.nan)
+
+    return counts, avg_pops
+
+
+@cached_figure(fields=("population", "avg_temp", "aq_category"))
+def plot_city_characteristics(city_stats, save_path=None, show=True,
+                              temp_bins=None, band_labels=None):
     """
     Advanced composite visualization:
 
@@ -255,13 +509,33 @@ def plot_city_characteristics(city_stats, save_path=None):
     - On a secondary y-axis, plot the average population per climate band.
     - Uses multiple colors and a shared legend.
 
+    temp_bins / band_labels override the default Cold/Mild/Warm/Hot bands
+    (labels are generated from the edges if only temp_bins is given).
+    The binning and aggregation are vectorised (see climate_band_summary),
+    so this stays fast with hundreds of thousands of cities.
+
     This is intentionally more complex than the basic bar/line examples from class.
     """
 
     import numpy as np
     import matplotlib.pyplot as plt
 
-    # Keep only cities with both population and avg_temp
+    # 1. Define climate bands and labels (in °C)
+    if temp_bins is None:
+        temp_bins = DEFAULT_TEMP_BINS
+        if band_labels is None:
+            band_labels = DEFAULT_BAND_LABELS
+    elif band_labels is None:
+        band_labels = make_band_labels(temp_bins)
+
+    if len(band_labels) != len(temp_bins) - 1:
+        raise ValueError("band_labels needs exactly one label per temperature band")
+
+    aq_categories = ["Good", "Moderate", "Unhealthy", "Unknown"]
+    cat_index = {cat: i for i, cat in enumerate(aq_categories)}
+
+    # 2. Pull the columns we need straight into arrays
+    #    (only cities with both population and avg_temp)
     data = [
         c for c in city_stats
         if c.get("population") is not None and c.get("avg_temp") is not None
@@ -271,48 +545,18 @@ def plot_city_characteristics(city_stats, save_path=None):
         print("Not enough data to plot city characteristics.")
         return
 
-    # 1. Define climate bands and labels (in °C)
-    temp_bins = [-100, 5, 15, 25, 1000]
-    band_labels = [
-        "Cold (<5°C)",
-        "Mild (5–15°C)",
-        "Warm (15–25°C)",
-        "Hot (>25°C)"
-    ]
-
-    # 2. We’ll track:
-    #    - counts[band][aq_category] = number of cities
-    #    - pop_sums[band] and pop_counts[band] to compute avg population
-    aq_categories = ["Good", "Moderate", "Unhealthy", "Unknown"]
-
-    counts = {label: {cat: 0 for cat in aq_categories} for label in band_labels}
-    pop_sums = {label: 0 for label in band_labels}
-    pop_counts = {label: 0 for label in band_labels}
-
-    for c in data:
-        temp = c["avg_temp"]
-        pop = c["population"]
-        aq = c.get("aq_category") or "Unknown"
-
-        # Find the climate band for this city's temp
-        band_idx = None
-        for i in range(len(temp_bins) - 1):
-            if temp_bins[i] <= temp < temp_bins[i + 1]:
-                band_idx = i
-                break
-        if band_idx is None:
-            continue  # should not happen, but just in case
-
-        band_label = band_labels[band_idx]
-
-        # Increment AQ category count
-        if aq not in counts[band_label]:
-            counts[band_label][aq] = 0
-        counts[band_label][aq] += 1
+    n = len(data)
+    temps = np.fromiter((c["avg_temp"] for c in data), dtype=float, count=n)
+    pops = np.fromiter((c["population"] for c in data), dtype=float, count=n)
+    codes = np.fromiter(
+        (cat_index.get(c.get("aq_category") or "Unknown", -1) for c in data),
+        dtype=np.int64,
+        count=n,
+    )
 
-        # Add to population stats
-        pop_sums[band_label] += pop
-        pop_counts[band_label] += 1
+    counts, avg_pops = climate_band_summary(
+        temps, pops, codes, temp_bins, len(aq_categories)
+    )
 
     # 3. Build arrays for plotting
     x = np.arange(len(band_labels))
@@ -331,9 +575,9 @@ def plot_city_characteristics(city_stats, save_path=None):
     bar_handles = []
 
     # Stacked bars: city counts by AQ category within each climate band
-    for cat in aq_categories:
-        heights = [counts[band][cat] for band in band_labels]
-        if sum(heights) == 0:
+    for cat_idx, cat in enumerate(aq_categories):
+        heights = counts[:, cat_idx]
+        if heights.sum() == 0:
             continue  # skip categories that don't appear at all
 
         h = ax1.bar(
@@ -346,7 +590,7 @@ def plot_city_characteristics(city_stats, save_path=None):
             alpha=0.9,
         )
         bar_handles.append(h[0])
-        bottom += np.array(heights)
+        bottom += heights
 
     ax1.set_ylabel("Number of Cities")
     ax1.set_xlabel("Climate Band (based on Average Temperature)")
@@ -368,13 +612,6 @@ def plot_city_characteristics(city_stats, save_path=None):
             )
 
     # 4. Secondary axis: average population per climate band
-    avg_pops = []
-    for band in band_labels:
-        if pop_counts[band] > 0:
-            avg_pops.append(pop_sums[band] / pop_counts[band])
-        else:
-            avg_pops.append(np.nan)
-
     ax2 = ax1.twinx()
     line_color = "#2196F3"  # blue for the line
 
@@ -415,10 +652,14 @@ def plot_city_characteristics(city_stats, save_path=None):
         plt.savefig(save_path, bbox_inches="tight")
         print(f"Saved advanced city characteristics plot to {save_path}")
 
-    plt.show()
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)  # headless: free the figure right away
 
 ##New visualizations
-def plot_pm25_ranked_by_city(city_stats, save_path=None):
+@cached_figure(fields=("city", "avg_pm25", "aq_category"))
+def plot_pm25_ranked_by_city(city_stats, save_path=None, show=True):
     """
     Final Visualization: Ranked Average PM2.5 by City
 
@@ -428,6 +669,10 @@ def plot_pm25_ranked_by_city(city_stats, save_path=None):
     - Vertical threshold lines
     - Value labels on bars
     """
+    import numpy as np
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Patch
+
 
     # Filter valid PM2.5 values
     filtered = [c for c in city_stats if c.get("avg_pm25") is not None]
@@ -516,9 +761,14 @@ def plot_pm25_ranked_by_city(city_stats, save_path=None):
         plt.savefig(save_path, bbox_inches="tight")
         print(f"Saved ranked PM2.5 visualization to {save_path}")
 
-    plt.show()
-    
-def plot_aq_category_overview(city_stats, save_path=None):
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)  # headless: free the figure right away
+
+@cached_figure(fields=("aq_category", "avg_temp", "avg_pm25", "population"),
+               deps=("group_stats",))
+def plot_aq_category_overview(city_stats, save_path=None, show=True):
     """
     Advanced Visualization: Air-Quality Category Overview (2×2 grid)
 
@@ -529,45 +779,43 @@ def plot_aq_category_overview(city_stats, save_path=None):
       (2,2) Boxplots: population by category (log scale if data exists).
 
     Uses multiple derived lists, error bars, and boxplots to match the
-    complexity of the other visualizations.
+    complexity of the other visualizations. All per-category summaries come
+    from the vectorised group-by in group_stats (no per-city list appends).
     """
+    import numpy as np
+    import matplotlib.pyplot as plt
+    from group_stats import (
+        boxplot_stats_by_codes,
+        column_array,
+        encode_categories,
+        group_by_codes,
+    )
+
     # Base categories in a fixed order
     all_cats = ["Good", "Moderate", "Unhealthy", "Unknown"]
 
-    # Containers
-    counts = {cat: 0 for cat in all_cats}
-    temps_by_cat = {cat: [] for cat in all_cats}
-    pm25_by_cat = {cat: [] for cat in all_cats}
-    pops_by_cat  = {cat: [] for cat in all_cats}
-
-    for c in city_stats:
-        aq = c.get("aq_category")
-        temp = c.get("avg_temp")
-        pm25 = c.get("avg_pm25")
-        pop = c.get("population")
-
-        # Normalize AQ category
-        if aq not in ["Good", "Moderate", "Unhealthy"]:
-            aq = "Unknown"
-
-        counts[aq] += 1
-
-        if temp is not None:
-            temps_by_cat[aq].append(temp)
-        if pm25 is not None:
-            pm25_by_cat[aq].append(pm25)
-        if pop is not None:
-            pops_by_cat[aq].append(pop)
+    # Category code per city (anything unrecognised counts as "Unknown")
+    codes = encode_categories(
+        [c.get("aq_category") for c in city_stats], all_cats, default="Unknown"
+    )
+    counts = np.bincount(codes, minlength=len(all_cats))
 
     # Only keep categories that actually appear at all
-    used_cats = [cat for cat in all_cats if counts[cat] > 0]
-    if not used_cats:
+    used_idx = [i for i in range(len(all_cats)) if counts[i] > 0]
+    if not used_idx:
         print("Not enough data to plot AQ category overview.")
         return
+    used_cats = [all_cats[i] for i in used_idx]
+
+    # Re-number the codes so group g == used_cats[g]
+    remap = np.full(len(all_cats), -1, dtype=np.int64)
+    remap[used_idx] = np.arange(len(used_idx))
+    used_codes = remap[codes]
+    n_used = len(used_cats)
 
     # Build aligned lists
-    cat_indices = np.arange(len(used_cats))
-    count_vals = [counts[cat] for cat in used_cats]
+    cat_indices = np.arange(n_used)
+    count_vals = [int(counts[i]) for i in used_idx]
 
     # Color map
     color_map = {
@@ -578,24 +826,19 @@ def plot_aq_category_overview(city_stats, save_path=None):
     }
     bar_colors = [color_map.get(cat, "#9E9E9E") for cat in used_cats]
 
-    # Compute PM2.5 means + std dev where possible
-    pm_means = []
-    pm_stds = []
-    for cat in used_cats:
-        vals = pm25_by_cat[cat]
-        if len(vals) == 0:
-            pm_means.append(np.nan)
-            pm_stds.append(0.0)
-        else:
-            pm_means.append(float(np.mean(vals)))
-            pm_stds.append(float(np.std(vals)))
-
-    # Prepare temperature data for boxplots
-    temp_data = [temps_by_cat[cat] for cat in used_cats]
-
-    # Prepare population data for boxplots (may be empty)
-    pop_data = [pops_by_cat[cat] for cat in used_cats]
-    has_any_pop = any(len(v) > 0 for v in pop_data)
+    # PM2.5 count / mean / std dev per category (one vectorised group-by)
+    pm_summary = group_by_codes(used_codes, column_array(city_stats, "avg_pm25"), n_used)
+    pm_means = pm_summary["mean"]
+    pm_stds = np.nan_to_num(pm_summary["std"])
+
+    # Boxplot statistics for temperature and population
+    temp_stats = boxplot_stats_by_codes(
+        used_codes, column_array(city_stats, "avg_temp"), n_used, labels=used_cats
+    )
+    pop_stats = boxplot_stats_by_codes(
+        used_codes, column_array(city_stats, "population"), n_used, labels=used_cats
+    )
+    has_any_pop = any(st["n"] > 0 for st in pop_stats)
 
     # --- Create 2×2 grid of subplots ---
     fig, axes = plt.subplots(2, 2, figsize=(13, 9))
@@ -627,7 +870,7 @@ def plot_aq_category_overview(city_stats, save_path=None):
 
     # (1,2) Average PM2.5 per category with error bars
     # Only plot categories that have at least one PM value
-    valid_pm_indices = [i for i, cat in enumerate(used_cats) if len(pm25_by_cat[cat]) > 0]
+    valid_pm_indices = [i for i in range(n_used) if pm_summary["count"][i] > 0]
 
     if valid_pm_indices:
         x_pm = [cat_indices[i] for i in valid_pm_indices]
@@ -683,11 +926,10 @@ def plot_aq_category_overview(city_stats, save_path=None):
         ax_pm.axis("off")
 
     # (2,1) Temperature boxplots by category
-    has_any_temp = any(len(v) > 0 for v in temp_data)
+    has_any_temp = any(st["n"] > 0 for st in temp_stats)
     if has_any_temp:
-        bp_temp = ax_temp.boxplot(
-            temp_data,
-            labels=used_cats,
+        bp_temp = ax_temp.bxp(
+            temp_stats,
             vert=True,
             patch_artist=True,
             showmeans=True,
@@ -714,15 +956,9 @@ def plot_aq_category_overview(city_stats, save_path=None):
 
     # (2,2) Population boxplots by category (log scale)
     if has_any_pop:
-        # Replace empty lists with [np.nan] to avoid errors, but they won't really show
-        pop_data_clean = [
-            vals if len(vals) > 0 else [np.nan]
-            for vals in pop_data
-        ]
-
-        bp_pop = ax_pop.boxplot(
-            pop_data_clean,
-            labels=used_cats,
+        # categories without population data have NaN stats and don't really show
+        bp_pop = ax_pop.bxp(
+            pop_stats,
             vert=True,
             patch_artist=True,
             showmeans=True,
@@ -756,36 +992,115 @@ def plot_aq_category_overview(city_stats, save_path=None):
         fig.savefig(save_path, bbox_inches="tight")
         print(f"Saved advanced AQ category overview figure to {save_path}")
 
-    plt.show()
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)  # headless: free the figure right away
+
+# ============================================================
+# HEADLESS BATCH RENDERING
+# ============================================================
+
+# name -> plot function, shared by the sequential and parallel renderers
+PLOT_FUNCTIONS = {
+    "temp_vs_pm25": plot_temp_vs_pm25,
+    "population_vs_pm25": plot_population_vs_pm25,
+    "city_characteristics": plot_city_characteristics,
+    "pm25_ranked_by_city": plot_pm25_ranked_by_city,
+    "aq_category_overview": plot_aq_category_overview,
+}
+
+# city_stats snapshot each render worker receives once (see _init_render_worker)
+_worker_city_stats = None
+
+
+def _init_render_worker(city_stats):
+    """Runs once per worker process: pick the Agg backend + keep the snapshot."""
+    global _worker_city_stats
+    import matplotlib
+    matplotlib.use("Agg")
+    _worker_city_stats = city_stats
+
+
+def _render_in_worker(name, save_path):
+    # the parent already checked the figure cache -> call the raw plot function
+    PLOT_FUNCTIONS[name].__wrapped__(_worker_city_stats, save_path=save_path, show=False)
+    return name
+
 
-def write_results_to_file(city_stats, filename="results.txt"):
-    """Write final calculated statistics to a text file."""
+def render_figures_headless(city_stats, save_paths, max_workers=None, use_cache=True):
+    """
+    Render several figures in parallel worker processes, without a display.
+
+    save_paths maps a PLOT_FUNCTIONS name to the PNG path to write, e.g.
+    {"temp_vs_pm25": "visualizations/temp_vs_pm25.png"}.
+
+    Every worker uses the non-interactive Agg backend and gets ONE copy of the
+    city_stats snapshot (through the pool initializer, not per figure), and
+    each figure is closed as soon as it is saved. The figures render at the
+    same time, so the total is roughly the time of the slowest figure.
+
+    Figures whose inputs haven't changed since the last render are restored
+    from the figure cache up front and never reach a worker (use_cache=False
+    renders everything and leaves the cache alone, e.g. for benchmarks).
+
+    Returns the list of figure names that were (re-)rendered.
+    """
+    import os
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    if use_cache:
+        save_paths = {
+            name: path for name, path in save_paths.items()
+            if not PLOT_FUNCTIONS[name].cache_lookup(city_stats, path)
+        }
+    if not save_paths:
+        return []
+    before = {name: file_stamp(path) for name, path in save_paths.items()}
+
+    workers = max_workers or min(len(save_paths), os.cpu_count() or 1)
+    rendered = []
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_render_worker,
+        initargs=(city_stats,),
+    ) as pool:
+        futures = {
+            pool.submit(_render_in_worker, name, path): name
+            for name, path in save_paths.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                rendered.append(future.result())
+                if use_cache:
+                    PLOT_FUNCTIONS[name].cache_store(city_stats, save_paths[name],
+                                                     before[name])
+            except Exception as e:
+                print(f"Error rendering figure {name}: {e}")
+
+    return rendered
+
+def write_results_to_file(city_stats, filename="results.txt", fmt=None, compress=None,
+                          correlations=None):
+    """
+    Write final calculated statistics to a file.
+
+    city_stats can be the list from calculate_city_stats, any iterator of
+    dicts, or a cursor from city_stats_cursor (streamed, never loaded whole).
+    fmt is "text" (the classic results.txt layout), "csv" or "jsonl"
+    (default: from the extension, else text);
+    compress="gzip" (or a .gz filename) gzips the output.
+    correlations: rows from analytics.correlation_report (or a function
+    returning them) to include; see results_writer.write_results_stream.
+    Returns the number of cities written (None if writing failed).
+    """
     try:
-        with open(filename, "w") as f:
-            f.write("City Statistics Results\n")
-            f.write("-" * 40 + "\n")
-
-            for city in city_stats:
-                name = city.get("city")
-                population = city.get("population")
-                avg_temp = city.get("avg_temp")
-                avg_pm25 = city.get("avg_pm25")
-                aq_category = city.get("aq_category")
-
-                # Make population human-friendly
-                if population is None:
-                    population_str = "Unknown (no population data)"
-                else:
-                    # format like 1,234,567
-                    population_str = f"{population:,}"
-
-                f.write(f"City: {name}\n")
-                f.write(f"Population: {population_str}\n")
-                f.write(f"Average Temperature: {avg_temp}\n")
-                f.write(f"Average PM2.5: {avg_pm25}\n")
-                f.write(f"Air Quality Category: {aq_category}\n")
-                f.write("-" * 40 + "\n")
-
-            print(f"Results successfully written to {filename}")
+        count = write_results_stream(city_stats, filename, fmt=fmt, compress=compress,
+                                     correlations=correlations)
+        print(f"Results successfully written to {filename}")
+        return count
     except Exception as e:
-        print(f"Error writing results to file: {e}")
\ No newline at end of file
+        print(f"Error writing results to file: {e}")
+        return None
@@ -0,0 +1,353 @@
+# ============================================================
+# analytics.py
+# Temperature vs PM2.5: grouped correlations + bootstrap intervals
+# ============================================================
+#
+# Pearson r, Spearman rho and percentile-bootstrap confidence intervals for
+# every group of a grouping at once (all cities, per country, per region,
+# per time window), without a Python loop over groups or resamples:
+#   - per-group sums come from np.bincount over integer group codes (same
+#     approach as group_stats.py),
+#   - ranks within groups come from one lexsort over (group, value),
+#   - a batch of bootstrap resamples is one (batch, n_rows) index array;
+#     resample b of group g gets the composite code b * n_groups + g, so
+#     the whole batch is scored by the same bincount code. Spearman
+#     resamples are ranked by counting picks per run of equal values
+#     rather than sorting every resample again.
+#
+#   rows = correlation_report(conn, city_stats, by=("all", "country"), window="1d")
+#   write_results_to_file(city_stats, "results.txt", correlations=rows)
+#
+# Every result row is a flat dict (grouping, group, n, pearson_r,
+# pearson_ci_low, ..., spearman_ci_high), i.e. a tidy table that the
+# results writer and csv / jsonl consumers can take as is.
+
+import warnings
+
+import numpy as np
+
+from group_stats import column_array, encode_categories
+
+GROUPINGS = ("all", "country", "region")
+
+DEFAULT_BOOTSTRAP = 1000
+DEFAULT_CONFIDENCE = 0.95
+# smallest group that gets a row (a correlation of two points is +-1)
+MIN_GROUP_SIZE = 3
+# resampled values per bootstrap batch (bounds the memory of a batch)
+BOOTSTRAP_BATCH_VALUES = 2_000_000
+
+RESULT_COLUMNS = ("grouping", "group", "n",
+                  "pearson_r", "pearson_ci_low", "pearson_ci_high",
+                  "spearman_rho", "spearman_ci_low", "spearman_ci_high")
+
+
+# ------------------------------------------------------------
+# Vectorised per-group statistics
+# ------------------------------------------------------------
+def _clean(codes, x, y, n_groups):
+    """Drop rows with a NaN value or a code outside [0, n_groups)."""
+    codes = np.asarray(codes, dtype=np.int64)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    keep = (codes >= 0) & (codes < n_groups) & ~np.isnan(x) & ~np.isnan(y)
+    return codes[keep], x[keep], y[keep]
+
+
+def grouped_pearson(codes, x, y, n_groups):
+    """
+    (count, r) arrays of length n_groups: Pearson r of x and y within each
+    group. Codes must be in [0, n_groups) and values not NaN (see _clean).
+    Groups with fewer than two rows or no variance get NaN.
+    """
+    count = np.bincount(codes, minlength=n_groups)
+    safe_count = np.maximum(count, 1)
+    mean_x = np.bincount(codes, weights=x, minlength=n_groups) / safe_count
+    mean_y = np.bincount(codes, weights=y, minlength=n_groups) / safe_count
+
+    # sums over deviations from the group means (second pass, stable)
+    dx = x - mean_x[codes]
+    dy = y - mean_y[codes]
+    sxx = np.bincount(codes, weights=dx * dx, minlength=n_groups)
+    syy = np.bincount(codes, weights=dy * dy, minlength=n_groups)
+    sxy = np.bincount(codes, weights=dx * dy, minlength=n_groups)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        r = sxy / np.sqrt(sxx * syy)
+    r = np.where((count >= 2) & (sxx > 0) & (syy > 0), np.clip(r, -1.0, 1.0), np.nan)
+    return count, r
+
+
+def grouped_ranks(codes, values):
+    """
+    1-based rank of every value within its group, ties getting their
+    average rank (same as scipy.stats.rankdata per group).
+    """
+    n = len(values)
+    order = np.lexsort((values, codes))
+    sorted_codes = codes[order]
+    sorted_values = values[order]
+
+    positions = np.arange(n)
+    new_group = np.ones(n, dtype=bool)
+    new_group[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    new_run = new_group.copy()  # a run = equal values in the same group
+    new_run[1:] |= sorted_values[1:] != sorted_values[:-1]
+
+    group_start = np.maximum.accumulate(np.where(new_group, positions, 0))
+    run_start = positions[new_run]
+    run_length = np.diff(np.append(run_start, n))
+    run_of = np.cumsum(new_run) - 1
+
+    # a run starting at 0-based position p holds ranks p+1 .. p+length
+    first_rank = run_start - group_start[run_start]
+    sorted_ranks = first_rank[run_of] + (run_length[run_of] + 1) / 2.0
+
+    ranks = np.empty(n)
+    ranks[order] = sorted_ranks
+    return ranks
+
+
+def grouped_spearman(codes, x, y, n_groups):
+    """(count, rho): Pearson r of the within-group ranks."""
+    return grouped_pearson(codes, grouped_ranks(codes, x), grouped_ranks(codes, y), n_groups)
+
+
+def _value_runs(codes, values):
+    """
+    Runs of equal values within groups, in (group, value) order:
+    (run of every row, first run of each run's group, number of runs).
+    """
+    n = len(values)
+    order = np.lexsort((values, codes))
+    sorted_codes = codes[order]
+    sorted_values = values[order]
+    new_group = np.ones(n, dtype=bool)
+    new_group[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    new_run = new_group.copy()
+    new_run[1:] |= sorted_values[1:] != sorted_values[:-1]
+
+    run_ids = np.arange(int(new_run.sum()))
+    first_run = np.maximum.accumulate(np.where(new_group[new_run], run_ids, 0))
+    runs = np.empty(n, dtype=np.int64)
+    runs[order] = np.cumsum(new_run) - 1
+    return runs, first_run, len(run_ids)
+
+
+def _resampled_ranks(picks, runs, first_run, n_runs):
+    """
+    Within-group average ranks of a batch of resamples (picks: row indices,
+    one resample per line) without sorting them: count the picks of each
+    run, and a pick's rank is the number of picks in lower runs of its
+    group plus the middle of its own run's ranks.
+    """
+    size = picks.shape[0]
+    picked = runs[picks]
+    offsets = (np.arange(size) * n_runs)[:, None]
+    hits = np.bincount((picked + offsets).ravel(), minlength=size * n_runs).reshape(size, n_runs)
+    before = np.cumsum(hits, axis=1) - hits
+    below = before - before[:, first_run]
+    lines = np.arange(size)[:, None]
+    return (below[lines, picked] + (hits[lines, picked] + 1) / 2.0).ravel()
+
+
+def bootstrap_correlations(codes, x, y, n_groups, method="pearson", n_boot=DEFAULT_BOOTSTRAP,
+                           confidence=DEFAULT_CONFIDENCE, seed=None,
+                           batch_values=BOOTSTRAP_BATCH_VALUES):
+    """
+    Percentile-bootstrap interval of the per-group correlation:
+    (low, high) arrays of length n_groups.
+
+    Each resample redraws every group's rows with replacement from that
+    group only (group sizes stay fixed). Resamples are scored in batches
+    of about batch_values values. Resamples without variance are left out
+    of the percentiles; a group with none left gets NaN.
+    """
+    if method not in ("pearson", "spearman"):
+        raise ValueError(f"Unknown correlation method {method!r}; use 'pearson' or 'spearman'")
+    rng = np.random.default_rng(seed)
+
+    order = np.argsort(codes, kind="stable")
+    codes, x, y = codes[order], x[order], y[order]
+    n = len(codes)
+    count = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+    row_start = starts[codes]
+    row_count = count[codes]
+    if method == "spearman":
+        x_runs = _value_runs(codes, x)
+        y_runs = _value_runs(codes, y)
+
+    scores = np.full((n_boot, n_groups), np.nan)
+    per_batch = max(1, batch_values // max(n, 1))
+    for first in range(0, n_boot, per_batch):
+        size = min(per_batch, n_boot - first)
+        picks = row_start + (rng.random((size, n)) * row_count).astype(np.int64)
+        batch_codes = (np.arange(size)[:, None] * n_groups + codes[None, :]).ravel()
+        if method == "spearman":
+            bx = _resampled_ranks(picks, *x_runs)
+            by = _resampled_ranks(picks, *y_runs)
+        else:
+            bx, by = x[picks].ravel(), y[picks].ravel()
+        _, r = grouped_pearson(batch_codes, bx, by, size * n_groups)
+        scores[first:first + size] = r.reshape(size, n_groups)
+
+    tail = (1.0 - confidence) / 2.0
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN groups
+        low, high = np.nanquantile(scores, [tail, 1.0 - tail], axis=0)
+    return low, high
+
+
+def _number(value):
+    return None if np.isnan(value) else round(float(value), 4)
+
+
+def correlation_table(codes, x, y, labels, grouping="all", n_boot=DEFAULT_BOOTSTRAP,
+                      confidence=DEFAULT_CONFIDENCE, seed=None, min_group_size=MIN_GROUP_SIZE):
+    """
+    Tidy rows (RESULT_COLUMNS) for one grouping: codes index into labels.
+    Groups with fewer than min_group_size complete rows are left out;
+    n_boot=0 skips the intervals (they come back as None).
+    """
+    n_groups = len(labels)
+    codes, x, y = _clean(codes, x, y, n_groups)
+    count, pearson = grouped_pearson(codes, x, y, n_groups)
+    _, spearman = grouped_spearman(codes, x, y, n_groups)
+
+    nan = np.full(n_groups, np.nan)
+    p_low, p_high, s_low, s_high = nan, nan, nan, nan
+    if n_boot and len(codes):
+        p_low, p_high = bootstrap_correlations(codes, x, y, n_groups, "pearson",
+                                               n_boot, confidence, seed)
+        s_low, s_high = bootstrap_correlations(codes, x, y, n_groups, "spearman",
+                                               n_boot, confidence, seed)
+
+    rows = []
+    for g in np.flatnonzero(count >= min_group_size):
+        rows.append({
+            "grouping": grouping,
+            "group": labels[g],
+            "n": int(count[g]),
+            "pearson_r": _number(pearson[g]),
+            "pearson_ci_low": _number(p_low[g]),
+            "pearson_ci_high": _number(p_high[g]),
+            "spearman_rho": _number(spearman[g]),
+            "spearman_ci_low": _number(s_low[g]),
+            "spearman_ci_high": _number(s_high[g]),
+        })
+    return rows
+
+
+# ------------------------------------------------------------
+# Groupings of the project data
+# ------------------------------------------------------------
+def city_group_labels(conn, grouping):
+    """{city_id: label} for "country" (Cities) or "region" (GeoDB, via CityCrosswalk)."""
+    if grouping == "country":
+        return {city_id: country for city_id, country in
+                conn.execute("SELECT id, country FROM Cities") if country}
+    if grouping == "region":
+        # joined here rather than in SQL: GeoCities.geodb_id has no index
+        regions = {geodb_id: region for geodb_id, region in
+                   conn.execute("SELECT geodb_id, region FROM GeoCities WHERE region IS NOT NULL")}
+        return {city_id: regions[geodb_id] for city_id, geodb_id in
+                conn.execute("SELECT city_id, geodb_id FROM CityCrosswalk")
+                if geodb_id in regions}
+    raise ValueError(f"Unknown grouping {grouping!r}; choose from {', '.join(GROUPINGS)}")
+
+
+def window_means(conn, window, metrics=("temperature", "pm25")):
+    """
+    Per (city, time window) means of each metric from the hourly
+    RollingBuckets: {(city_id, window_start): {metric: mean}}.
+    window is anything rolling.parse_window takes ("1d", "7d", ...).
+    Covers only the buckets kept (see rolling.prune_rolling_buckets).
+    """
+    from rolling import parse_window
+
+    window = parse_window(window)
+    means = {}
+    for metric in metrics:
+        rows = conn.execute(
+            """
+            SELECT c.id, b.bucket_start - b.bucket_start % :window AS window_start,
+                   SUM(b.total) / SUM(b.n)
+            FROM Cities AS c
+            CROSS JOIN RollingBuckets AS b
+                ON b.city_id = c.id AND b.metric = :metric
+            GROUP BY c.id, window_start
+            """,
+            {"window": window, "metric": metric},
+        )
+        for city_id, window_start, mean in rows:
+            means.setdefault((city_id, window_start), {})[metric] = mean
+    return means
+
+
+def _utc_label(seconds):
+    import datetime as dt
+    return dt.datetime.fromtimestamp(seconds, dt.timezone.utc).strftime("%Y-%m-%d %H:%M")
+
+
+def correlation_report(conn, city_stats, by=("all", "country"), window=None,
+                       n_boot=DEFAULT_BOOTSTRAP, confidence=DEFAULT_CONFIDENCE, seed=0,
+                       min_group_size=MIN_GROUP_SIZE):
+    """
+    Temperature vs PM2.5 correlations as one tidy list of rows.
+
+    city_stats: rows from calculate_city_stats (avg_temp / avg_pm25 per
+    city). by: city groupings from GROUPINGS. window (e.g. "1d"): also
+    correlate the per-city window means across cities within every time
+    window ("window" grouping, labelled by the window start in UTC).
+    conn may be None when by is just ("all",) and there's no window.
+    seed makes the bootstrap intervals reproducible.
+    """
+    options = {"n_boot": n_boot, "confidence": confidence, "seed": seed,
+               "min_group_size": min_group_size}
+    rows = []
+    city_stats = list(city_stats)
+    temps = column_array(city_stats, "avg_temp")
+    pm25 = column_array(city_stats, "avg_pm25")
+
+    for grouping in by:
+        if grouping == "all":
+            codes = np.zeros(len(city_stats), dtype=np.int64)
+            rows += correlation_table(codes, temps, pm25, ["all cities"], "all", **options)
+            continue
+        labels_by_city = city_group_labels(conn, grouping)
+        city_labels = [labels_by_city.get(c.get("city_id")) for c in city_stats]
+        labels = sorted({label for label in city_labels if label is not None})
+        codes = encode_categories(city_labels, labels)
+        rows += correlation_table(codes, temps, pm25, labels, grouping, **options)
+
+    if window is not None:
+        means = window_means(conn, window)
+        pairs = [(start, m["temperature"], m["pm25"]) for (_, start), m in means.items()
+                 if "temperature" in m and "pm25" in m]
+        if pairs:
+            starts = np.fromiter((p[0] for p in pairs), dtype=np.int64, count=len(pairs))
+            unique_starts, codes = np.unique(starts, return_inverse=True)
+            rows += correlation_table(
+                codes,
+                np.fromiter((p[1] for p in pairs), dtype=float, count=len(pairs)),
+                np.fromiter((p[2] for p in pairs), dtype=float, count=len(pairs)),
+                [_utc_label(int(s)) for s in unique_starts], "window", **options,
+            )
+    return rows
+
+
+def print_correlation_report(rows):
+    """Aligned console table of correlation_report rows."""
+    if not rows:
+        print("No group has enough cities with both temperature and PM2.5 for a correlation.")
+        return
+
+    def fmt(value):
+        return "   n/a" if value is None else f"{value:+.3f}"
+
+    print(f"{'grouping':<9} {'group':<22} {'n':>6}  {'pearson r [CI]':<26} spearman rho [CI]")
+    for row in rows:
+        print(f"{row['grouping']:<9} {str(row['group'])[:22]:<22} {row['n']:>6}  "
+              f"{fmt(row['pearson_r'])} [{fmt(row['pearson_ci_low'])}, {fmt(row['pearson_ci_high'])}]  "
+              f"{fmt(row['spearman_rho'])} [{fmt(row['spearman_ci_low'])}, {fmt(row['spearman_ci_high'])}]")
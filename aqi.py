@@ -0,0 +1,204 @@
+# ============================================================
+# aqi.py
+# US EPA Air Quality Index: breakpoint tables + vectorised AQI
+# ============================================================
+#
+# One place for every AQI threshold in the project.
+#   - aqi_values / aqi_categories work on whole arrays at once (searchsorted)
+#   - aqi_sql / category_sql build plain SQL CASE expressions so SQLite
+#     can categorise rows inside a query without calling back into Python
+#
+# Breakpoints are from the EPA "Technical Assistance Document for the
+# Reporting of Daily Air Quality" (2018 tables, i.e. PM2.5 "Good" up to
+# 12.0 µg/m³ - the thresholds this project has always used).
+#
+# numpy is imported inside the array functions so that the SQL helpers
+# (used by calculate_city_stats) don't pull it in.
+
+# AQI index range for each row of a breakpoint table
+AQI_RANGES = [
+    (0, 50),
+    (51, 100),
+    (101, 150),
+    (151, 200),
+    (201, 300),
+    (301, 400),
+    (401, 500),
+]
+
+# parameter -> (unit, decimals concentrations are truncated to, [(C_lo, C_hi), ...])
+BREAKPOINTS = {
+    # 24-hour average, µg/m³
+    "pm25": ("µg/m³", 1, [
+        (0.0, 12.0), (12.1, 35.4), (35.5, 55.4), (55.5, 150.4),
+        (150.5, 250.4), (250.5, 350.4), (350.5, 500.4),
+    ]),
+    # 24-hour average, µg/m³
+    "pm10": ("µg/m³", 0, [
+        (0, 54), (55, 154), (155, 254), (255, 354),
+        (355, 424), (425, 504), (505, 604),
+    ]),
+    # 8-hour average, ppm (the 301-500 rows come from the 1-hour table,
+    # EPA has no 8-hour breakpoints above 0.200 ppm)
+    "o3": ("ppm", 3, [
+        (0.000, 0.054), (0.055, 0.070), (0.071, 0.085), (0.086, 0.105),
+        (0.106, 0.200), (0.405, 0.504), (0.505, 0.604),
+    ]),
+    # 8-hour average, ppm
+    "co": ("ppm", 1, [
+        (0.0, 4.4), (4.5, 9.4), (9.5, 12.4), (12.5, 15.4),
+        (15.5, 30.4), (30.5, 40.4), (40.5, 50.4),
+    ]),
+    # 1-hour average, ppb
+    "so2": ("ppb", 0, [
+        (0, 35), (36, 75), (76, 185), (186, 304),
+        (305, 604), (605, 804), (805, 1004),
+    ]),
+    # 1-hour average, ppb
+    "no2": ("ppb", 0, [
+        (0, 53), (54, 100), (101, 360), (361, 649),
+        (650, 1249), (1250, 1649), (1650, 2049),
+    ]),
+}
+
+# Official category names and the highest AQI in each
+CATEGORIES = [
+    "Good",
+    "Moderate",
+    "Unhealthy for Sensitive Groups",
+    "Unhealthy",
+    "Very Unhealthy",
+    "Hazardous",
+]
+CATEGORY_UPPER_AQI = [50, 100, 150, 200, 300, 500]
+
+# The three buckets our figures use: everything above "Moderate" is
+# "Unhealthy" (same cut-offs calculate_city_stats has always used).
+SIMPLE_CATEGORIES = ["Good", "Moderate", "Unhealthy"]
+SIMPLE_UPPER_AQI = [50, 100]
+
+# unit conversions into each table's unit
+_UNIT_FACTORS = {
+    ("ppm", "ppb"): 1000.0,
+    ("ppb", "ppm"): 0.001,
+}
+
+
+def _table(parameter):
+    try:
+        return BREAKPOINTS[parameter]
+    except KeyError:
+        raise ValueError(
+            f"No AQI breakpoints for parameter {parameter!r}; "
+            f"known: {', '.join(BREAKPOINTS)}"
+        ) from None
+
+
+def convert_units(parameter, concentrations, unit):
+    """Scale concentrations from `unit` into the unit of the AQI table."""
+    import numpy as np
+
+    table_unit = _table(parameter)[0]
+    values = np.asarray(concentrations, dtype=float)
+    if unit is None or unit == table_unit:
+        return values
+    factor = _UNIT_FACTORS.get((unit, table_unit))
+    if factor is None:
+        raise ValueError(f"Can't convert {parameter} from {unit} to {table_unit}")
+    return values * factor
+
+
+def aqi_values(parameter, concentrations, unit=None):
+    """
+    AQI for every concentration in one vectorised call.
+
+    Concentrations are truncated to the table's precision (EPA rule), matched
+    to their breakpoint row with searchsorted, and linearly interpolated.
+    Values above the table top are capped at 500; NaN / negative inputs give
+    NaN. Returns a float array (whole numbers, NaN for missing).
+    """
+    import numpy as np
+
+    _, decimals, rows = _table(parameter)
+    c = convert_units(parameter, concentrations, unit)
+    scale = 10.0 ** decimals
+    with np.errstate(invalid="ignore"):
+        c = np.floor(c * scale + 1e-9) / scale
+        invalid = np.isnan(c) | (c < 0)
+
+    c_lo = np.array([lo for lo, _ in rows], dtype=float)
+    c_hi = np.array([hi for _, hi in rows], dtype=float)
+    i_lo = np.array([lo for lo, _ in AQI_RANGES], dtype=float)
+    i_hi = np.array([hi for _, hi in AQI_RANGES], dtype=float)
+
+    # first row whose upper bound is >= c (values in a gap go to the next row)
+    idx = np.searchsorted(c_hi, np.where(invalid, 0.0, c), side="left")
+    above_top = idx >= len(rows)
+    idx = np.minimum(idx, len(rows) - 1)
+
+    c_clamped = np.clip(np.where(invalid, 0.0, c), c_lo[idx], c_hi[idx])
+    aqi = (i_hi[idx] - i_lo[idx]) / (c_hi[idx] - c_lo[idx]) * (c_clamped - c_lo[idx]) + i_lo[idx]
+    aqi = np.floor(aqi + 0.5)
+    aqi = np.where(above_top, 500.0, aqi)
+    return np.where(invalid, np.nan, aqi)
+
+
+def aqi_categories(aqi, simple=False):
+    """
+    Category name for every AQI value (None for NaN), vectorised.
+
+    simple=True gives the project's 3 buckets (Good / Moderate / Unhealthy).
+    """
+    import numpy as np
+
+    aqi = np.asarray(aqi, dtype=float)
+    names = SIMPLE_CATEGORIES if simple else CATEGORIES
+    uppers = SIMPLE_UPPER_AQI if simple else CATEGORY_UPPER_AQI[:-1]
+
+    codes = np.searchsorted(np.array(uppers, dtype=float), np.nan_to_num(aqi), side="left")
+    lookup = np.array(names + [None], dtype=object)
+    codes = np.where(np.isnan(aqi), len(names), codes)
+    return lookup[codes]
+
+
+def categorize(parameter, concentrations, unit=None, simple=False):
+    """Shortcut: concentrations -> (aqi array, category array)."""
+    aqi = aqi_values(parameter, concentrations, unit=unit)
+    return aqi, aqi_categories(aqi, simple=simple)
+
+
+# ------------------------------------------------------------
+# SQL versions (evaluated by SQLite itself, no Python callbacks)
+# ------------------------------------------------------------
+def aqi_sql(parameter, column):
+    """
+    SQL expression computing the AQI of `column` (already in table units).
+
+    e.g. aqi_sql("pm25", "AVG(aqm.value)") -> "CASE WHEN ... END"
+    NULL / negative values give NULL, values above the table give 500.
+    """
+    _, decimals, rows = _table(parameter)
+    scale = 10 ** decimals
+    truncated = f"(CAST(({column}) * {scale} + 1e-9 AS INTEGER) / {float(scale)!r})"
+
+    parts = [f"CASE WHEN ({column}) IS NULL OR ({column}) < 0 THEN NULL"]
+    for (c_lo, c_hi), (i_lo, i_hi) in zip(rows, AQI_RANGES):
+        slope = (i_hi - i_lo) / (c_hi - c_lo)
+        parts.append(
+            f" WHEN {truncated} <= {c_hi!r} THEN "
+            f"CAST(({slope!r}) * (MAX({truncated}, {c_lo!r}) - {c_lo!r}) + {i_lo} + 0.5 AS INTEGER)"
+        )
+    parts.append(" ELSE 500 END")
+    return "".join(parts)
+
+
+def category_sql(aqi_expression, simple=False):
+    """SQL expression mapping an AQI expression to its category name."""
+    names = SIMPLE_CATEGORIES if simple else CATEGORIES
+    uppers = SIMPLE_UPPER_AQI if simple else CATEGORY_UPPER_AQI[:-1]
+
+    parts = [f"CASE WHEN ({aqi_expression}) IS NULL THEN NULL"]
+    for name, upper in zip(names, uppers):
+        parts.append(f" WHEN ({aqi_expression}) <= {upper} THEN '{name}'")
+    parts.append(f" ELSE '{names[-1]}' END")
+    return "".join(parts)
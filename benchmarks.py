@@ -0,0 +1,298 @@
+# ============================================================
+# benchmarks.py
+# Scaling benchmarks: ingest, aggregation and plotting
+# ============================================================
+#
+# Times the pipeline functions on synthetic databases of increasing size
+# (1k / 100k / 10M observations by default) and writes one JSON object per
+# (benchmark, size) to a JSON Lines file:
+#
+#   {"benchmark": "calculate_city_stats", "size": 100000, "cities": 500,
+#    "status": "ok", "seconds": 0.41, "rows": 100000,
+#    "rows_per_second": 243902.4, "peak_python_mb": 3.2, "max_rss_mb": 61.0, ...}
+#
+# Every case runs in its own child process, which
+#   - gives a clean max RSS per case (plus tracemalloc's Python-heap peak),
+#   - lets a case that doesn't scale be killed after --timeout seconds
+#     (status "timeout"); larger sizes of that benchmark are then "skipped".
+#
+#   python starter.py bench --sizes 1k,100k,10M --out bench_results.jsonl
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import tempfile
+import platform
+import contextlib
+import multiprocessing
+
+DEFAULT_SIZES = (1_000, 100_000, 10_000_000)
+DEFAULT_TIMEOUT = 300  # seconds per case
+DEFAULT_OUTPUT = "bench_results.jsonl"
+
+# observations per city in the benchmark databases (half weather, half PM2.5)
+OBSERVATIONS_PER_CITY = 200
+# store_* take a list of dicts; beyond this many the payload alone would
+# need several GB, so larger sizes store this many rows
+STORE_MAX_ROWS = 1_000_000
+
+STORE_BENCHMARKS = ("store_weather_data", "store_air_quality_data", "store_city_data")
+QUERY_BENCHMARKS = ("calculate_city_stats", "debug_city_join_status")
+
+
+def parse_size(text):
+    """'1k' -> 1000, '10M' -> 10000000, '2500' -> 2500."""
+    text = text.strip()
+    factor = {"k": 1_000, "m": 1_000_000}.get(text[-1:].lower(), 1)
+    number = text[:-1] if factor != 1 else text
+    try:
+        value = int(float(number) * factor)
+    except ValueError:
+        raise ValueError(f"Bad benchmark size {text!r} (use e.g. 1k, 100k, 10M)") from None
+    if value <= 0:
+        raise ValueError(f"Benchmark size must be positive, got {text!r}")
+    return value
+
+
+def cities_for(size):
+    return max(1, size // OBSERVATIONS_PER_CITY)
+
+
+# ------------------------------------------------------------
+# Synthetic inputs
+# ------------------------------------------------------------
+def build_benchmark_db(path, size, seed=0):
+    """
+    Fresh synthetic database (synthetic_data.generate_database) with `size`
+    observations: cities_for(size) cities, each with the same number of
+    hourly weather and PM2.5 rows. Returns the number of cities.
+    """
+    from synthetic_data import generate_database
+
+    n_cities = cities_for(size)
+    hours = max(1, size // n_cities // 2)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        generate_database(path, n_cities, hours=hours, seed=seed, overwrite=True)
+    return n_cities
+
+
+def synthetic_payload(name, size, seed=0):
+    """fetch_*-shaped dicts for one store_* benchmark (size items)."""
+    rng = random.Random(seed)
+    n_cities = cities_for(size)
+    if name == "store_weather_data":
+        return [{
+            "city_name": f"City {i % n_cities}", "country": "XX",
+            "latitude": rng.uniform(-60, 60), "longitude": rng.uniform(-180, 180),
+            "timestamp": 1_700_000_000 + 3600 * (i // n_cities),
+            "temperature": rng.gauss(15, 10), "feels_like": None,
+            "humidity": 50, "wind_speed": 2.0, "weather_main": "Clear",
+        } for i in range(size)]
+    if name == "store_air_quality_data":
+        return [{
+            "city": f"City {i % n_cities}", "location": f"Station {i}",
+            "latitude": None, "longitude": None,
+            "pm25": rng.lognormvariate(2.5, 0.6), "unit": "µg/m³",
+            "timestamp": "2024-01-01T00:00:00Z",
+        } for i in range(size)]
+    return [{
+        "geodb_id": f"bench-{i}", "name": f"City {i}", "country": "XX",
+        "region": None, "population": rng.randint(10_000, 5_000_000),
+        "latitude": None, "longitude": None,
+    } for i in range(size)]
+
+
+def synthetic_city_stats(n_cities, seed=0):
+    """calculate_city_stats-shaped rows for the plot benchmarks."""
+    from aqi import aqi_values, aqi_categories
+
+    rng = random.Random(seed)
+    pm25 = [rng.lognormvariate(2.5, 0.6) for _ in range(n_cities)]
+    aqi = aqi_values("pm25", pm25)
+    categories = aqi_categories(aqi, simple=True)
+    return [
+        {"city_id": i + 1, "city": f"City {i}", "avg_temp": rng.gauss(15, 10),
+         "avg_pm25": pm25[i], "population": rng.randint(10_000, 5_000_000),
+         "aqi": int(aqi[i]), "aq_category": categories[i]}
+        for i in range(n_cities)
+    ]
+
+
+# ------------------------------------------------------------
+# Running one case (in a child process)
+# ------------------------------------------------------------
+def _measure(fn, rows):
+    import resource
+    import tracemalloc
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit
+    return {
+        "seconds": round(seconds, 6),
+        "rows": rows,
+        "rows_per_second": round(rows / seconds, 1) if seconds > 0 else None,
+        "peak_python_mb": round(peak / 2**20, 2),
+        "max_rss_mb": round(max_rss / 2**20, 2),
+    }
+
+
+def _run_case(name, size, db_path, work_dir, results):
+    """Child-process body: set up inputs (untimed), then time one call."""
+    try:
+        sys.stdout = open(os.devnull, "w")  # the pipeline functions print a lot
+        results.put(_case(name, size, db_path, work_dir))
+    except Exception as e:
+        results.put({"status": "error", "error": f"{type(e).__name__}: {e}"})
+
+
+def _case(name, size, db_path, work_dir):
+    import starter
+    from analysis_visualizations import PLOT_FUNCTIONS, calculate_city_stats
+
+    if name in STORE_BENCHMARKS:
+        # the payload is built in memory up front, so it is capped
+        payload = synthetic_payload(name, min(size, STORE_MAX_ROWS))
+        path = os.path.join(work_dir, f"store-{name}-{size}.db")
+        if os.path.exists(path):
+            os.remove(path)
+        starter.create_database(path)
+        conn = sqlite3.connect(path)
+        if name == "store_air_quality_data":
+            # AQ rows only attach to existing Cities rows
+            conn.executemany("INSERT INTO Cities (city_name, country) VALUES (?, 'XX')",
+                             ((f"City {i}",) for i in range(cities_for(len(payload)))))
+            conn.commit()
+        store = getattr(starter, name)
+        result = _measure(lambda: store(conn, payload), rows=len(payload))
+        conn.close()
+        os.remove(path)
+        return result
+
+    if name == "calculate_city_stats":
+        conn = sqlite3.connect(db_path)
+        result = _measure(lambda: calculate_city_stats(conn, memoize=False), rows=size)
+        conn.close()
+        return result
+
+    if name == "debug_city_join_status":
+        conn = sqlite3.connect(db_path)
+        result = _measure(lambda: starter.debug_city_join_status(conn), rows=size)
+        conn.close()
+        return result
+
+    plot_name = name[len("plot:"):]
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401  (import time is not what we measure)
+    city_stats = synthetic_city_stats(cities_for(size))
+    save_path = os.path.join(work_dir, f"{plot_name}-{size}.png")
+    # __wrapped__ skips the figure cache so the drawing is really timed
+    plot = PLOT_FUNCTIONS[plot_name].__wrapped__
+    return _measure(lambda: plot(city_stats, save_path=save_path, show=False),
+                    rows=len(city_stats))
+
+
+def run_case(name, size, db_path, work_dir, timeout=DEFAULT_TIMEOUT):
+    """Run one benchmark case in a child process; returns its result dict."""
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run_case, args=(name, size, db_path, work_dir, results))
+    proc.start()
+    try:
+        result = results.get(timeout=timeout)
+    except Exception:  # queue.Empty: the case ran out of time (or crashed)
+        result = {"status": "timeout" if proc.is_alive() else "error",
+                  "seconds": timeout if proc.is_alive() else None}
+    proc.join(1)
+    if proc.is_alive():
+        proc.kill()
+        proc.join()
+    result.setdefault("status", "ok")
+    return result
+
+
+# ------------------------------------------------------------
+# The suite
+# ------------------------------------------------------------
+def benchmark_names():
+    from analysis_visualizations import PLOT_FUNCTIONS
+
+    return list(STORE_BENCHMARKS) + list(QUERY_BENCHMARKS) + [f"plot:{p}" for p in PLOT_FUNCTIONS]
+
+
+def run_suite(sizes=DEFAULT_SIZES, output=DEFAULT_OUTPUT, timeout=DEFAULT_TIMEOUT,
+              benchmarks=None, work_dir=None, keep=False):
+    """
+    Run every benchmark at every size (smallest first), print a table and
+    append the records to `output` (JSON Lines). Returns the records.
+    """
+    names = benchmarks or benchmark_names()
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="city_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+
+    env = {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "run_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    gave_up = {}  # benchmark -> size at which it timed out
+    records = []
+
+    print(f"{'benchmark':<34}{'size':>12}{'status':>9}{'seconds':>11}{'rows/s':>14}{'rss MB':>9}")
+    try:
+        for size in sorted(sizes):
+            db_path = os.path.join(work_dir, f"bench-{size}.db")
+            start = time.perf_counter()
+            n_cities = build_benchmark_db(db_path, size)
+            build = {"benchmark": "build_db", "size": size, "cities": n_cities, "status": "ok",
+                     "seconds": round(time.perf_counter() - start, 6), "rows": size}
+            records.append(_emit(build, env, output))
+
+            for name in names:
+                record = {"benchmark": name, "size": size, "cities": n_cities}
+                if name in gave_up:
+                    record.update(status="skipped",
+                                  reason=f"timed out at size {gave_up[name]}")
+                else:
+                    record.update(run_case(name, size, db_path, work_dir, timeout=timeout))
+                    if record["status"] == "timeout":
+                        gave_up[name] = size
+                records.append(_emit(record, env, output))
+
+            if not keep:
+                os.remove(db_path)
+    finally:
+        if own_dir and not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"\nBenchmark records appended to {output}")
+    return records
+
+
+def _emit(record, env, output):
+    record = {**record, **env}
+    with open(output, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+    seconds = record.get("seconds")
+    rate = record.get("rows_per_second")
+    rss = record.get("max_rss_mb")
+    print(f"{record['benchmark']:<34}{record['size']:>12,}{record['status']:>9}"
+          f"{'' if seconds is None else f'{seconds:.3f}':>11}"
+          f"{'' if rate is None else f'{rate:,.0f}':>14}"
+          f"{'' if rss is None else f'{rss:.0f}':>9}")
+    return record
@@ -0,0 +1,185 @@
+# ============================================================
+# city_crosswalk.py
+# Cities <-> GeoCities entity resolution (the CityCrosswalk table)
+# ============================================================
+#
+# Cities rows come from OpenWeather ("New York"), GeoCities rows from GeoDB
+# ("New York City"), so joining them on the exact name string silently
+# loses populations. update_crosswalk() resolves every Cities row that isn't
+# mapped yet to one GeoCities row and stores city_id -> geodb_id in
+# CityCrosswalk; calculate_city_stats then joins on the integer city_id.
+#
+# A city is matched, in this order, by
+#   1. "name+coords"        same normalised name, nearest GeoCities row
+#                           within MAX_NAME_MATCH_KM
+#   2. "name"               same normalised name, one side has no
+#                           coordinates -> the most populous candidate
+#   3. "coords+partial-name" a GeoCities row within PROXIMITY_MATCH_KM whose
+#                           name words contain (or are contained in) the
+#                           city's, e.g. "Washington" / "Washington DC"
+# Matches are kept once made; cities that didn't match are retried on the
+# next run (new GeoDB rows may have arrived). rebuild=True starts over.
+
+import re
+import unicodedata
+from collections import defaultdict
+
+from create_database import create_crosswalk_table
+from spatial_index import haversine_km, within_radius
+
+# same normalised name but further apart than this -> a different place
+# (metro centroids from different sources can be tens of km apart)
+MAX_NAME_MATCH_KM = 75.0
+# partial-name matches must be this close
+PROXIMITY_MATCH_KM = 15.0
+
+_ABBREVIATIONS = {"st": "saint", "ste": "sainte", "ft": "fort", "mt": "mount"}
+_PREFIXES = (("city", "of"), ("municipality", "of"), ("greater",))
+_SUFFIXES = (("metropolitan", "area"), ("metro",), ("city",), ("municipality",),
+             ("prefecture",), ("district",))
+
+
+def normalize_city_name(name):
+    """
+    Comparable form of a city name: no accents, case, punctuation,
+    country suffix ("Chicago,US"), parenthesised notes, or
+    "City of" / "... City" style decorations, e.g. "St. Louis City" ->
+    "saint louis".
+    """
+    if not name:
+        return ""
+    name = name.split(",")[0]
+    name = re.sub(r"\(.*?\)", " ", name)
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(ch for ch in name if not unicodedata.combining(ch)).lower()
+    words = [_ABBREVIATIONS.get(w, w) for w in re.findall(r"[a-z0-9]+", name)]
+
+    changed = True
+    while changed:
+        changed = False
+        for prefix in _PREFIXES:
+            if len(words) > len(prefix) and tuple(words[:len(prefix)]) == prefix:
+                words = words[len(prefix):]
+                changed = True
+        for suffix in _SUFFIXES:
+            if len(words) > len(suffix) and tuple(words[-len(suffix):]) == suffix:
+                words = words[:-len(suffix)]
+                changed = True
+    return " ".join(words)
+
+
+def _has_coords(lat, lon):
+    return lat is not None and lon is not None
+
+
+class GeoCityIndex:
+    """
+    GeoCities rows by normalised name; look-ups by position go through the
+    GeoCities R*Tree (spatial_index.within_radius).
+    """
+
+    def __init__(self, conn, rows):
+        # rows: (id, geodb_id, city_name, latitude, longitude, population)
+        self.conn = conn
+        self.by_name = defaultdict(list)
+        self.by_id = {}
+        for row_id, geodb_id, city_name, lat, lon, population in rows:
+            entry = (geodb_id, normalize_city_name(city_name), lat, lon, population or 0)
+            self.by_name[entry[1]].append(entry)
+            self.by_id[row_id] = entry
+
+    def near(self, lat, lon, max_km):
+        """(distance_km, entry) for the rows within max_km, nearest first."""
+        return [(distance, self.by_id[row_id])
+                for row_id, distance in within_radius(self.conn, "GeoCities", lat, lon, max_km)
+                if row_id in self.by_id]
+
+    def match(self, city_name, lat, lon):
+        """(geodb_id, method, distance_km) for one Cities row, or None."""
+        name = normalize_city_name(city_name)
+        if not name:
+            return None
+        candidates = self.by_name.get(name, [])
+
+        if candidates and _has_coords(lat, lon):
+            located = sorted(
+                (haversine_km(lat, lon, c[2], c[3]), c)
+                for c in candidates if _has_coords(c[2], c[3])
+            )
+            if located and located[0][0] <= MAX_NAME_MATCH_KM:
+                distance, best = located[0]
+                return best[0], "name+coords", round(distance, 3)
+            candidates = [c for c in candidates if not _has_coords(c[2], c[3])]
+
+        if candidates:
+            best = max(candidates, key=lambda c: c[4])
+            return best[0], "name", None
+
+        if _has_coords(lat, lon):
+            words = set(name.split())
+            for distance, entry in self.near(lat, lon, PROXIMITY_MATCH_KM):
+                other = set(entry[1].split())
+                if other and (words <= other or other <= words):
+                    return entry[0], "coords+partial-name", round(distance, 3)
+        return None
+
+
+def update_crosswalk(conn, rebuild=False):
+    """
+    Map every Cities row without a CityCrosswalk row to a GeoCities row.
+
+    Incremental: cities already mapped are not looked at again, and when
+    every city is mapped this is a single query. Returns a summary dict
+    {"checked", "matched", "unmatched", "methods": {method: count}}.
+    """
+    cur = conn.cursor()
+    create_crosswalk_table(cur)
+    if rebuild:
+        cur.execute("DELETE FROM CityCrosswalk")
+
+    pending = cur.execute("""
+        SELECT c.id, c.city_name, c.latitude, c.longitude
+        FROM Cities AS c
+        LEFT JOIN CityCrosswalk AS x ON x.city_id = c.id
+        WHERE x.city_id IS NULL
+    """).fetchall()
+    summary = {"checked": len(pending), "matched": 0, "unmatched": 0, "methods": {}}
+    if not pending:
+        conn.commit()
+        return summary
+
+    index = GeoCityIndex(conn, cur.execute("""
+        SELECT gc.id, gc.geodb_id, gc.city_name, gc.latitude, gc.longitude, MAX(cd.population)
+        FROM GeoCities AS gc
+        LEFT JOIN CityDetails AS cd ON cd.geodb_id = gc.geodb_id
+        WHERE gc.geodb_id IS NOT NULL
+        GROUP BY gc.id
+    """).fetchall())
+
+    rows = []
+    for city_id, city_name, lat, lon in pending:
+        found = index.match(city_name, lat, lon)
+        if found is None:
+            summary["unmatched"] += 1
+            continue
+        geodb_id, method, distance = found
+        rows.append((city_id, geodb_id, method, distance))
+        summary["methods"][method] = summary["methods"].get(method, 0) + 1
+
+    cur.executemany("""
+        INSERT OR REPLACE INTO CityCrosswalk (city_id, geodb_id, method, distance_km)
+        VALUES (?, ?, ?, ?)
+    """, rows)
+    conn.commit()
+    summary["matched"] = len(rows)
+    return summary
+
+
+def print_crosswalk_summary(summary):
+    """One line about an update_crosswalk run (nothing when no city was pending)."""
+    if not summary["checked"]:
+        return
+    methods = ", ".join(f"{m}: {n}" for m, n in sorted(summary["methods"].items()))
+    print(f"City crosswalk: {summary['checked']} unmapped cities checked, "
+          f"{summary['matched']} matched" + (f" ({methods})" if methods else "")
+          + f", {summary['unmatched']} without a GeoDB match.")
@@ -6,6 +6,307 @@
 
 import sqlite3
 
+
+def create_crosswalk_table(cur):
+    """
+    CityCrosswalk: Cities.id -> GeoCities.geodb_id, filled by
+    city_crosswalk.update_crosswalk (method = how the match was made,
+    distance_km = how far apart the two rows' coordinates are).
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS CityCrosswalk (
+            city_id INTEGER PRIMARY KEY,
+            geodb_id TEXT NOT NULL,
+            method TEXT,
+            distance_km REAL,
+            FOREIGN KEY (city_id) REFERENCES Cities(id),
+            FOREIGN KEY (geodb_id) REFERENCES GeoCities(geodb_id)
+        );
+    """)
+
+
+# tables with latitude / longitude columns that get an R*Tree index
+# (<table>_rtree, kept in sync by triggers; see spatial_index.py)
+SPATIAL_TABLES = ("Cities", "GeoCities", "AirQualityLocations")
+
+
+def create_spatial_index(cur):
+    """
+    One R*Tree per SPATIAL_TABLES table: a (lat, lat, lon, lon) point box
+    per row with coordinates, keyed by the row id. Triggers keep it in sync
+    with inserts, coordinate updates and deletes; rows that existed before
+    the index are loaded when it is first created.
+
+    Returns False (and creates nothing) when SQLite was built without the
+    R*Tree module; spatial_index.py then falls back to plain range scans.
+    """
+    for table in SPATIAL_TABLES:
+        rtree = f"{table}_rtree"
+        existed = cur.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (rtree,)
+        ).fetchone()
+        try:
+            cur.execute(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {rtree}
+                    USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+            """)
+        except sqlite3.OperationalError as e:
+            if "no such module" in str(e):
+                return False
+            raise
+
+        has_coords = "NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL"
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {rtree}_insert AFTER INSERT ON {table}
+            WHEN {has_coords}
+            BEGIN
+                INSERT OR REPLACE INTO {rtree}
+                VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+            END;
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {rtree}_update
+            AFTER UPDATE OF id, latitude, longitude ON {table}
+            BEGIN
+                DELETE FROM {rtree} WHERE id = OLD.id;
+                INSERT INTO {rtree}
+                SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+                WHERE {has_coords};
+            END;
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {rtree}_delete AFTER DELETE ON {table}
+            BEGIN
+                DELETE FROM {rtree} WHERE id = OLD.id;
+            END;
+        """)
+
+        if not existed:
+            cur.execute(f"""
+                INSERT INTO {rtree}
+                SELECT id, latitude, latitude, longitude, longitude
+                FROM {table}
+                WHERE latitude IS NOT NULL AND longitude IS NOT NULL;
+            """)
+    return True
+
+
+# width of one RollingBuckets bucket (see rolling.py)
+ROLLING_BUCKET_SECONDS = 3600
+
+# adds a (n, total, min, max) row into an existing bucket
+_ROLLING_UPSERT = """
+    ON CONFLICT (city_id, metric, bucket_start) DO UPDATE SET
+        n = n + excluded.n,
+        total = total + excluded.total,
+        min_value = MIN(min_value, excluded.min_value),
+        max_value = MAX(max_value, excluded.max_value)
+"""
+
+
+def create_rolling_buckets(cur):
+    """
+    RollingBuckets: per (city, metric, hour) count / sum / min / max of the
+    observations, kept up to date by triggers on WeatherObservations
+    (metric 'temperature') and AirQualityMeasurements (metric = parameter).
+    Rows that existed before the table are summed into it when it is first
+    created.
+    """
+    existed = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'RollingBuckets'"
+    ).fetchone()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS RollingBuckets (
+            city_id INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            bucket_start INTEGER NOT NULL,
+            n INTEGER NOT NULL,
+            total REAL NOT NULL,
+            min_value REAL,
+            max_value REAL,
+            PRIMARY KEY (city_id, metric, bucket_start)
+        ) WITHOUT ROWID;
+    """)
+
+    weather_time = "CAST(NEW.timestamp AS INTEGER)"
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS rolling_weather_insert AFTER INSERT ON WeatherObservations
+        WHEN NEW.city_id IS NOT NULL AND NEW.temperature IS NOT NULL
+         AND NEW.timestamp IS NOT NULL
+        BEGIN
+            INSERT INTO RollingBuckets
+            VALUES (NEW.city_id, 'temperature',
+                    {weather_time} / {ROLLING_BUCKET_SECONDS} * {ROLLING_BUCKET_SECONDS},
+                    1, NEW.temperature, NEW.temperature, NEW.temperature)
+            {_ROLLING_UPSERT};
+        END;
+    """)
+    # AQ timestamps are ISO 8601 text; unparseable ones give NULL and are skipped
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS rolling_aq_insert AFTER INSERT ON AirQualityMeasurements
+        WHEN NEW.value IS NOT NULL
+        BEGIN
+            INSERT INTO RollingBuckets
+            SELECT aql.city_id, NEW.parameter,
+                   ts / {ROLLING_BUCKET_SECONDS} * {ROLLING_BUCKET_SECONDS},
+                   1, NEW.value, NEW.value, NEW.value
+            FROM AirQualityLocations AS aql,
+                 (SELECT CAST(strftime('%s', NEW.timestamp) AS INTEGER) AS ts)
+            WHERE aql.id = NEW.location_id AND aql.city_id IS NOT NULL AND ts IS NOT NULL
+            {_ROLLING_UPSERT};
+        END;
+    """)
+
+    if not existed:
+        fill_rolling_buckets(cur)
+
+
+def fill_rolling_buckets(cur):
+    """(Re)compute RollingBuckets from the observation tables in one pass."""
+    cur.execute("DELETE FROM RollingBuckets")
+    # rows are added one by one through the upsert (like the triggers do);
+    # that is cheaper than a GROUP BY, which would sort every row first
+    cur.execute(f"""
+        INSERT INTO RollingBuckets
+        SELECT city_id, 'temperature',
+               CAST(timestamp AS INTEGER) / {ROLLING_BUCKET_SECONDS} * {ROLLING_BUCKET_SECONDS},
+               1, temperature, temperature, temperature
+        FROM WeatherObservations
+        WHERE city_id IS NOT NULL AND temperature IS NOT NULL AND timestamp IS NOT NULL
+        {_ROLLING_UPSERT};
+    """)
+    cur.execute(f"""
+        INSERT INTO RollingBuckets
+        SELECT aql.city_id, aqm.parameter,
+               CAST(strftime('%s', aqm.timestamp) AS INTEGER)
+                   / {ROLLING_BUCKET_SECONDS} * {ROLLING_BUCKET_SECONDS} AS bucket_start,
+               1, aqm.value, aqm.value, aqm.value
+        FROM AirQualityLocations AS aql
+        CROSS JOIN AirQualityMeasurements AS aqm ON aqm.location_id = aql.id
+        WHERE aql.city_id IS NOT NULL AND aqm.value IS NOT NULL AND bucket_start IS NOT NULL
+        {_ROLLING_UPSERT};
+    """)
+
+
+# weather columns with running statistics (AQ metrics are the parameters)
+WEATHER_STAT_METRICS = ("temperature", "feels_like", "humidity", "wind_speed")
+
+# merges a (n, mean, m2, min, max) partial into the stored row with Chan et
+# al.'s pairwise formulas; a single observation (n=1, m2=0) makes this
+# exactly Welford's update. SET expressions all see the old row values.
+METRIC_STATS_MERGE = """
+    ON CONFLICT (city_id, metric) DO UPDATE SET
+        n = n + excluded.n,
+        mean = mean + (excluded.mean - mean) * excluded.n / (n + excluded.n),
+        m2 = m2 + excluded.m2
+             + (excluded.mean - mean) * (excluded.mean - mean) * n * excluded.n / (n + excluded.n),
+        min_value = MIN(min_value, excluded.min_value),
+        max_value = MAX(max_value, excluded.max_value)
+"""
+
+
+def _weather_metric_values():
+    """(metric, value) rows of the NEW WeatherObservations row, for the trigger."""
+    return "\n                UNION ALL ".join(
+        f"SELECT '{m}' AS metric, NEW.{m} AS value" if i == 0 else f"SELECT '{m}', NEW.{m}"
+        for i, m in enumerate(WEATHER_STAT_METRICS)
+    )
+
+
+def create_metric_stats(cur):
+    """
+    CityMetricStats: per (city, metric) running count, mean, M2 (sum of
+    squared deviations from the mean), min and max over all observations,
+    updated by triggers inside the inserting transaction, so mean /
+    variance / min / max are one primary-key read (running_stats.py).
+    Rows that existed before the table are added when it is first created.
+    """
+    existed = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'CityMetricStats'"
+    ).fetchone()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS CityMetricStats (
+            city_id INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            mean REAL NOT NULL,
+            m2 REAL NOT NULL,
+            min_value REAL,
+            max_value REAL,
+            PRIMARY KEY (city_id, metric)
+        ) WITHOUT ROWID;
+    """)
+
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS metric_stats_weather_insert AFTER INSERT ON WeatherObservations
+        WHEN NEW.city_id IS NOT NULL
+        BEGIN
+            INSERT INTO CityMetricStats
+            SELECT NEW.city_id, metric, 1, value, 0.0, value, value
+            FROM ({_weather_metric_values()})
+            WHERE value IS NOT NULL
+            {METRIC_STATS_MERGE};
+        END;
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS metric_stats_aq_insert AFTER INSERT ON AirQualityMeasurements
+        WHEN NEW.value IS NOT NULL AND NEW.parameter IS NOT NULL
+        BEGIN
+            INSERT INTO CityMetricStats
+            SELECT aql.city_id, NEW.parameter, 1, NEW.value, 0.0, NEW.value, NEW.value
+            FROM AirQualityLocations AS aql
+            WHERE aql.id = NEW.location_id AND aql.city_id IS NOT NULL
+            {METRIC_STATS_MERGE};
+        END;
+    """)
+
+    if not existed:
+        fill_metric_stats(cur)
+
+
+def fill_metric_stats(cur):
+    """(Re)compute CityMetricStats from the observation tables, row by row like the triggers."""
+    cur.execute("DELETE FROM CityMetricStats")
+    # one pass per column (metric names are constants, safe in the SQL);
+    # each (city, metric) still sees its rows in table order
+    for metric in WEATHER_STAT_METRICS:
+        cur.execute(f"""
+            INSERT INTO CityMetricStats
+            SELECT city_id, '{metric}', 1, {metric}, 0.0, {metric}, {metric}
+            FROM WeatherObservations
+            WHERE city_id IS NOT NULL AND {metric} IS NOT NULL
+            {METRIC_STATS_MERGE};
+        """)
+    cur.execute(f"""
+        INSERT INTO CityMetricStats
+        SELECT aql.city_id, aqm.parameter, 1, aqm.value, 0.0, aqm.value, aqm.value
+        FROM AirQualityLocations AS aql
+        CROSS JOIN AirQualityMeasurements AS aqm ON aqm.location_id = aql.id
+        WHERE aql.city_id IS NOT NULL AND aqm.value IS NOT NULL AND aqm.parameter IS NOT NULL
+        {METRIC_STATS_MERGE};
+    """)
+
+
+def migrate_air_quality_locations(cur):
+    """
+    Databases from before AirQualityLocations had city_id (it held the
+    city's name, like the shipped final_project.db): add the column and
+    link every station to the first Cities row with that name. The old
+    columns are left in place. Must run before anything that reads
+    AirQualityLocations.city_id (its index, triggers and backfills).
+    """
+    columns = {row[1] for row in cur.execute("PRAGMA table_info(AirQualityLocations)")}
+    if "city_id" in columns:
+        return
+    cur.execute("ALTER TABLE AirQualityLocations ADD COLUMN city_id INTEGER REFERENCES Cities(id)")
+    if "city_name" in columns:
+        cur.execute("""
+            UPDATE AirQualityLocations
+            SET city_id = (SELECT MIN(c.id) FROM Cities AS c
+                           WHERE c.city_name = AirQualityLocations.city_name)
+        """)
+
+
 def create_database(db_name="final_project.db"):
     """
     Creates a SQLite database with all required tables.
@@ -60,6 +361,7 @@ def create_database(db_name="final_project.db"):
             FOREIGN KEY (city_id) REFERENCES Cities(id)
         );
     """)
+    migrate_air_quality_locations(cur)
 
     # ------------------------------------------
     # TABLE 4: AirQualityMeasurements (OpenAQ)
@@ -105,6 +407,54 @@ def create_database(db_name="final_project.db"):
         );
     """)
 
+    # ------------------------------------------
+    # TABLE 7: CityCrosswalk (Cities <-> GeoCities)
+    # ------------------------------------------
+    create_crosswalk_table(cur)
+
+    # ------------------------------------------
+    # TABLE 8: RollingBuckets (hourly partial sums for rolling windows)
+    # ------------------------------------------
+    create_rolling_buckets(cur)
+
+    # ------------------------------------------
+    # TABLE 9: CityMetricStats (running count / mean / M2 per city + metric)
+    # ------------------------------------------
+    create_metric_stats(cur)
+
+    # ------------------------------------------
+    # INDEXES
+    #  - measurements are stored long-format (one row per parameter), so
+    #    look-ups go through (location, parameter, time)
+    # ------------------------------------------
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_aqm_location_param_time
+            ON AirQualityMeasurements (location_id, parameter, timestamp);
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_aql_city
+            ON AirQualityLocations (city_id);
+    """)
+    # (city, time) look-ups: de-duplicating backfills + time-window stats
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_weather_city_time
+            ON WeatherObservations (city_id, timestamp);
+    """)
+    # find-or-create of a city by name (store_weather_data, reprocessing)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_cities_name_country
+            ON Cities (city_name, country);
+    """)
+
+    # R*Trees over the coordinates (radius / bounding-box look-ups)
+    create_spatial_index(cur)
+
+    # population look-ups through the crosswalk
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_city_details_geodb
+            ON CityDetails (geodb_id);
+    """)
+
     conn.commit()
     conn.close()
     print("Database created successfully!")
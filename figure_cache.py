@@ -0,0 +1,197 @@
+# ============================================================
+# figure_cache.py
+# Content-addressed cache for the PNG figures in analysis_visualizations
+# ============================================================
+#
+# Each cached plot function fingerprints
+#   - the city_stats fields it actually draws,
+#   - its rendering parameters (everything except save_path / show),
+#   - the source of its module (the helpers next to it included) and of the
+#     modules it draws through (deps=, e.g. group_stats),
+#   - the installed matplotlib version,
+# and keeps a copy of the PNG under <output dir>/.figure_cache/<name>-<hash>.png.
+# When the fingerprint matches an existing entry the cached PNG is copied to
+# save_path and matplotlib is never touched.
+
+import os
+import json
+import shutil
+import hashlib
+import inspect
+import functools
+import importlib.util
+
+CACHE_DIR_NAME = ".figure_cache"
+MAX_ENTRIES_PER_FIGURE = 5  # older entries for the same figure are pruned
+
+# running totals, see figure_cache_report()
+CACHE_STATS = {"hits": 0, "misses": 0}
+
+
+def figure_cache_report(reset=False):
+    """Print (and return) the hit/miss counts since the last reset."""
+    stats = dict(CACHE_STATS)
+    print(f"Figure cache: {stats['hits']} hit(s), {stats['misses']} miss(es)")
+    if reset:
+        CACHE_STATS["hits"] = 0
+        CACHE_STATS["misses"] = 0
+    return stats
+
+
+def _module_path(module_name):
+    # found, not imported: deps like group_stats would pull in numpy
+    spec = importlib.util.find_spec(module_name)
+    if spec is None or not spec.origin:
+        raise ValueError(f"Unknown figure dependency {module_name!r}")
+    return spec.origin
+
+
+def _code_digest(fn, deps=()):
+    """sha256 over the source files of fn's module and of the modules in deps."""
+    h = hashlib.sha256()
+    try:
+        paths = [inspect.getsourcefile(fn)]
+    except TypeError:
+        paths = [None]
+    paths += [_module_path(module_name) for module_name in deps]
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                h.update(f.read())
+        except (OSError, TypeError):
+            h.update(repr(fn.__code__.co_code).encode("utf-8"))
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def _matplotlib_version():
+    # from the package metadata, so a cache hit still never imports matplotlib
+    from importlib import metadata
+
+    try:
+        return metadata.version("matplotlib")
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def figure_fingerprint(name, city_stats, fields, params, code_digest=""):
+    """sha256 over the fields a figure uses + its rendering parameters."""
+    h = hashlib.sha256()
+    header = {"figure": name, "code": code_digest, "matplotlib": _matplotlib_version(),
+              "params": params}
+    h.update(json.dumps(header, sort_keys=True, default=str).encode("utf-8"))
+    # one repr() over all rows is much faster than serialising row by row
+    rows = [tuple(map(city.get, fields)) for city in city_stats]
+    h.update(repr(rows).encode("utf-8"))
+    return h.hexdigest()
+
+
+def file_stamp(path):
+    """(mtime_ns, size, inode) of a file, None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _cache_path(save_path, name, digest):
+    cache_dir = os.path.join(os.path.dirname(save_path) or ".", CACHE_DIR_NAME)
+    return os.path.join(cache_dir, f"{name}-{digest[:32]}.png")
+
+
+def _prune(cache_dir, name):
+    prefix = name + "-"
+    entries = [
+        os.path.join(cache_dir, fname)
+        for fname in os.listdir(cache_dir)
+        if fname.startswith(prefix) and fname.endswith(".png")
+    ]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for old in entries[MAX_ENTRIES_PER_FIGURE:]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+
+
+def cached_figure(fields, deps=()):
+    """
+    Decorator for plot functions with the signature
+        plot(city_stats, save_path=None, show=True, **params)
+
+    deps names the modules (besides the plot's own) whose code the figure
+    is drawn with; editing any of them invalidates its cached PNGs.
+
+    Headless calls (save_path given, show=False) use the cache; an
+    interactive call (show=True) always draws so there is something to
+    show, but still stores the PNG it saved. Callers that don't need the
+    window for an unchanged figure (render_visualizations) check
+    .cache_lookup first and skip it.
+
+    The wrapped function also gets:
+      - .cache_lookup(city_stats, save_path, **params) -> True on a hit
+        (the cached PNG has been copied to save_path)
+      - .cache_store(city_stats, save_path, before, **params) to record a
+        PNG that was rendered somewhere else (e.g. in a worker process);
+        before = file_stamp(save_path) taken before rendering
+      - .__wrapped__, the undecorated function
+    """
+    def decorator(fn):
+        name = fn.__name__
+        code_digest = _code_digest(fn, deps)
+
+        def fingerprint(city_stats, params):
+            return figure_fingerprint(name, city_stats, fields, params, code_digest)
+
+        def cache_lookup(city_stats, save_path, **params):
+            cached = _cache_path(save_path, name, fingerprint(city_stats, params))
+            if not os.path.exists(cached):
+                CACHE_STATS["misses"] += 1
+                return False
+
+            CACHE_STATS["hits"] += 1
+            if not _same_file_contents(cached, save_path):
+                shutil.copyfile(cached, save_path)
+            print(f"Figure cache hit: {save_path} is up to date")
+            return True
+
+        def cache_store(city_stats, save_path, before, **params):
+            stamp = file_stamp(save_path)
+            if stamp is None or stamp == before:
+                # nothing was drawn (e.g. not enough data): don't cache a
+                # PNG left over from an earlier run under this fingerprint
+                return
+            cached = _cache_path(save_path, name, fingerprint(city_stats, params))
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            shutil.copyfile(save_path, cached)
+            _prune(os.path.dirname(cached), name)
+
+        @functools.wraps(fn)
+        def wrapper(city_stats, save_path=None, show=True, **params):
+            if save_path is None:
+                return fn(city_stats, save_path=save_path, show=show, **params)
+
+            if not show and cache_lookup(city_stats, save_path, **params):
+                return None
+            before = file_stamp(save_path)
+            result = fn(city_stats, save_path=save_path, show=show, **params)
+            cache_store(city_stats, save_path, before, **params)
+            return result
+
+        wrapper.cache_lookup = cache_lookup
+        wrapper.cache_store = cache_store
+        return wrapper
+
+    return decorator
+
+
+def _same_file_contents(path_a, path_b):
+    """Cheap check first (sizes), then compare bytes."""
+    try:
+        if os.path.getsize(path_a) != os.path.getsize(path_b):
+            return False
+    except OSError:
+        return False
+    with open(path_a, "rb") as fa, open(path_b, "rb") as fb:
+        return fa.read() == fb.read()
@@ -0,0 +1,208 @@
+# ============================================================
+# group_stats.py
+# Vectorised group-by over integer category codes (numpy only)
+# ============================================================
+#
+# Instead of building one Python list per category and looping over it,
+# every function here takes
+#   codes  - int array, group index in [0, n_groups) per row
+#   values - float array, NaN = missing
+# and computes all groups at once with bincount / lexsort.
+
+import numpy as np
+
+
+def column_array(rows, key):
+    """Float array of rows[i][key] (dict rows), None -> NaN."""
+    return np.fromiter(
+        (np.nan if row.get(key) is None else row.get(key) for row in rows),
+        dtype=float,
+        count=len(rows),
+    )
+
+
+def encode_categories(labels, categories, default=None):
+    """
+    Turn a sequence of labels into int codes (index into `categories`).
+
+    Labels that are not in `categories` get the code of `default` if it is
+    given (e.g. "Unknown"), otherwise -1.
+    """
+    index = {cat: i for i, cat in enumerate(categories)}
+    fallback = index.get(default, -1)
+    return np.fromiter(
+        (index.get(label, fallback) for label in labels),
+        dtype=np.int64,
+        count=len(labels),
+    )
+
+
+def group_by_codes(codes, values, n_groups, quantiles=(0.25, 0.5, 0.75)):
+    """
+    Per-group count / mean / std / min / max / quantiles in one sweep.
+
+    Rows with a NaN value or a code outside [0, n_groups) are ignored.
+    std is the population std (ddof=0, same as np.std). Quantiles use linear
+    interpolation (same as np.quantile's default). Empty groups get NaN.
+
+    Returns a dict of arrays:
+      count (n_groups,), mean, std, min, max (n_groups,),
+      quantiles (n_groups, len(quantiles)),
+      sorted_values / starts: the values sorted by (group, value) and where
+      each group starts, for callers that need more than these summaries.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    values = np.asarray(values, dtype=float)
+    q = np.asarray(quantiles, dtype=float)
+
+    keep = (codes >= 0) & (codes < n_groups) & ~np.isnan(values)
+    codes = codes[keep]
+    values = values[keep]
+
+    count = np.bincount(codes, minlength=n_groups)
+    has_data = count > 0
+    safe_count = np.maximum(count, 1)
+
+    mean = np.bincount(codes, weights=values, minlength=n_groups) / safe_count
+    # second pass on the deviations keeps the variance numerically stable
+    sq_dev = np.bincount(codes, weights=(values - mean[codes]) ** 2, minlength=n_groups)
+    std = np.sqrt(sq_dev / safe_count)
+
+    # sort once by (group, value): every group is then a contiguous run
+    order = np.lexsort((values, codes))
+    sorted_values = values[order]
+    starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+    last = starts + count - 1
+
+    if len(sorted_values):
+        group_min = sorted_values[np.minimum(starts, len(sorted_values) - 1)]
+        group_max = sorted_values[np.clip(last, 0, len(sorted_values) - 1)]
+
+        pos = starts[:, None] + q[None, :] * (count[:, None] - 1)
+        pos = np.clip(pos, 0, len(sorted_values) - 1)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        frac = pos - lo
+        group_q = sorted_values[lo] * (1 - frac) + sorted_values[hi] * frac
+    else:
+        group_min = np.zeros(n_groups)
+        group_max = np.zeros(n_groups)
+        group_q = np.zeros((n_groups, len(q)))
+
+    nan = np.nan
+    return {
+        "count": count,
+        "mean": np.where(has_data, mean, nan),
+        "std": np.where(has_data, std, nan),
+        "min": np.where(has_data, group_min, nan),
+        "max": np.where(has_data, group_max, nan),
+        "quantiles": np.where(has_data[:, None], group_q, nan),
+        "sorted_values": sorted_values,
+        "starts": starts,
+    }
+
+
+def boxplot_stats_by_codes(codes, values, n_groups, labels=None, whis=1.5):
+    """
+    Boxplot statistics for every group, ready for matplotlib's Axes.bxp().
+
+    Whiskers reach the most extreme values within whis * IQR of the box
+    (same rule as Axes.boxplot); values beyond them are returned as fliers.
+    """
+    summary = group_by_codes(codes, values, n_groups, quantiles=(0.25, 0.5, 0.75))
+    q1, med, q3 = summary["quantiles"].T
+    count = summary["count"]
+    sorted_values = summary["sorted_values"]
+
+    iqr = q3 - q1
+    lo_fence = q1 - whis * iqr
+    hi_fence = q3 + whis * iqr
+
+    # group of each sorted value (sorted_values is grouped contiguously)
+    group_of = np.repeat(np.arange(n_groups), count)
+    inside = (sorted_values >= lo_fence[group_of]) & (sorted_values <= hi_fence[group_of])
+
+    whislo = np.full(n_groups, np.nan)
+    whishi = np.full(n_groups, np.nan)
+    if inside.any():
+        inside_groups = group_of[inside]
+        inside_values = sorted_values[inside]
+        # values are sorted inside each group -> first/last inside value per group
+        first = np.ones(len(inside_groups), dtype=bool)
+        first[1:] = inside_groups[1:] != inside_groups[:-1]
+        last = np.ones(len(inside_groups), dtype=bool)
+        last[:-1] = inside_groups[:-1] != inside_groups[1:]
+        whislo[inside_groups[first]] = inside_values[first]
+        whishi[inside_groups[last]] = inside_values[last]
+
+    flier_counts = np.bincount(group_of[~inside], minlength=n_groups)
+    fliers = np.split(sorted_values[~inside], np.cumsum(flier_counts)[:-1])
+
+    if labels is None:
+        labels = [str(i) for i in range(n_groups)]
+
+    stats = []
+    for g in range(n_groups):
+        stats.append({
+            "label": labels[g],
+            "mean": summary["mean"][g],
+            "med": med[g],
+            "q1": q1[g],
+            "q3": q3[g],
+            "whislo": whislo[g],
+            "whishi": whishi[g],
+            "fliers": fliers[g],
+            "n": int(count[g]),
+        })
+    return stats
+
+
+# ------------------------------------------------------------
+# Streaming least-squares trend line
+# ------------------------------------------------------------
+class LinearTrend:
+    """
+    y = slope * x + intercept from streaming sufficient statistics.
+
+    Feed it chunks with update(xs, ys); it keeps only
+    (n, mean_x, mean_y, Sxx, Sxy) and merges each chunk with Chan's
+    pairwise formulas, so memory is O(1) and the result matches
+    np.polyfit(x, y, 1) without ever holding all points at once.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        self.sxx = 0.0
+        self.sxy = 0.0
+
+    def update(self, xs, ys):
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        n_b = len(xs)
+        if n_b == 0:
+            return self
+
+        mx_b = float(xs.mean())
+        my_b = float(ys.mean())
+        dx = xs - mx_b
+        sxx_b = float(dx @ dx)
+        sxy_b = float(dx @ (ys - my_b))
+
+        n = self.n + n_b
+        delta_x = mx_b - self.mean_x
+        delta_y = my_b - self.mean_y
+        self.sxx += sxx_b + delta_x * delta_x * self.n * n_b / n
+        self.sxy += sxy_b + delta_x * delta_y * self.n * n_b / n
+        self.mean_x += delta_x * n_b / n
+        self.mean_y += delta_y * n_b / n
+        self.n = n
+        return self
+
+    def coefficients(self):
+        """(slope, intercept), or None with < 2 points / no x spread."""
+        if self.n < 2 or self.sxx == 0:
+            return None
+        slope = self.sxy / self.sxx
+        return slope, self.mean_y - slope * self.mean_x
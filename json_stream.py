@@ -0,0 +1,168 @@
+# ============================================================
+# json_stream.py
+# Incremental parsing of big JSON API pages, keeping only the fields we use
+# ============================================================
+#
+# response.json() on an OpenAQ page of 1000 sensors builds the whole nested
+# object tree (sensor metadata, coverage, summaries...) before we keep a
+# handful of fields. iter_array_items() instead reads the body chunk by
+# chunk as it arrives (requests' stream=True + iter_content), decodes the
+# records of one top-level array one at a time, and yields only the
+# requested fields of each. Memory is one chunk + one record + what is kept,
+# whatever the page size.
+#
+# Parsers, best first:
+#   - ijson with a C backend (yajl2_c), if installed: pip install ijson
+#   - the standard library: json.JSONDecoder.raw_decode on each record as
+#     soon as it is complete in the buffer (the C scanner does the work,
+#     so it is as fast as json.loads). Also used when ijson only has its
+#     pure-Python backend, which is several times slower than this.
+#
+#   with requests.get(url, stream=True) as response:
+#       for sensor in iter_response_items(response, "results", OPENAQ_FIELDS):
+#           ...
+
+import json
+import codecs
+
+CHUNK_BYTES = 64 * 1024
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+def _fast_ijson():
+    """The ijson module if it has a C backend, else None."""
+    try:
+        import ijson
+    except ImportError:
+        return None
+    backend = getattr(ijson, "backend", "")
+    return ijson if backend.startswith("yajl2_c") else None
+
+
+def project(record, fields):
+    """Only `fields` of a record dict (all of it when fields is None)."""
+    if fields is None or not isinstance(record, dict):
+        return record
+    return {key: record[key] for key in fields if key in record}
+
+
+class _Reader:
+    """Text buffer over an iterator of byte chunks, refilled on demand."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def more(self):
+        """Append the next chunk (dropping what was consumed); False at the end."""
+        if self.eof:
+            return False
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        for chunk in self.chunks:
+            text = self.decoder.decode(chunk)
+            if text:
+                self.buf += text
+                return True
+        self.buf += self.decoder.decode(b"", final=True)
+        self.eof = True
+        return True
+
+    def peek(self):
+        """Next non-whitespace character (not consumed), or "" at the end."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} in JSON at offset {self.pos}, "
+                             f"got {self.peek()!r}")
+        self.pos += 1
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.more():
+                    raise
+                continue
+            # a number at the very end of the buffer may continue in the next chunk
+            if end == len(self.buf) and not self.eof:
+                self.more()
+                continue
+            self.pos = end
+            return value
+
+
+def _iter_stdlib(chunks, key, fields):
+    reader = _Reader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        name = reader.value()
+        reader.expect(":")
+        if name == key and reader.peek() == "[":
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.pos += 1
+            else:
+                while True:
+                    yield project(reader.value(), fields)
+                    if reader.peek() == ",":
+                        reader.pos += 1
+                        continue
+                    reader.expect("]")
+                    break
+        else:
+            reader.value()  # a key we don't need (e.g. "meta"): decoded and dropped
+        if reader.peek() == ",":
+            reader.pos += 1
+            continue
+        reader.expect("}")
+        return
+
+
+class _ChunkFile:
+    """Minimal file object over byte chunks, for ijson."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def read(self, size=-1):
+        for chunk in self.chunks:
+            if chunk:  # b"" would mean end of file
+                return chunk
+        return b""
+
+
+def iter_array_items(chunks, key, fields=None):
+    """
+    Yield the records of the top-level array `key` ({"key": [...]}) from an
+    iterator of byte chunks, each reduced to `fields` (a tuple of keys;
+    None keeps whole records). A missing key yields nothing.
+    """
+    ijson = _fast_ijson()
+    if ijson is not None:
+        for record in ijson.items(_ChunkFile(chunks), f"{key}.item", use_float=True):
+            yield project(record, fields)
+        return
+    yield from _iter_stdlib(chunks, key, fields)
+
+
+def iter_response_items(response, key, fields=None, chunk_bytes=CHUNK_BYTES):
+    """iter_array_items over a requests response opened with stream=True."""
+    return iter_array_items(response.iter_content(chunk_size=chunk_bytes), key, fields)
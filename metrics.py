@@ -0,0 +1,423 @@
+# ============================================================
+# metrics.py
+# Lightweight timing spans for the pipeline + JSON Lines / Prometheus export
+# ============================================================
+#
+#   with span("ingest.store_weather", rows=len(weather_data)) as s:
+#       store_weather_data(conn, weather_data)
+#       s.bytes = ...
+#
+# Every finished span is kept in SPANS (name, parent span, start time,
+# duration, rows, bytes, status). At the end of a run they can be
+#   - appended to a JSON Lines file (one line per span, tagged with a run id)
+#     to graph stage latency over time, and
+#   - written as a Prometheus text-format file (e.g. for node_exporter's
+#     textfile collector) to alert on regressions.
+#
+# A span costs two perf_counter() calls and one dict, so it is fine to
+# wrap every fetch / store call.
+#
+# The fetch layer also sends every outbound HTTP call through
+# timed_request(endpoint, session.get, url, ...) (timed_stream for bodies
+# read as they stream in), which keeps per-endpoint
+# latency histograms (p50 / p95 / p99) plus counters for status codes,
+# error classes (timeouts, connection errors, ...) and payload bytes; see
+# api_report() and the http_* series in the Prometheus export.
+
+import os
+import json
+import time
+import uuid
+import random
+import threading
+import contextlib
+
+METRIC_PREFIX = "city_pipeline"
+
+SPANS = []  # finished span records of the current run
+_local = threading.local()  # per-thread stack of open spans (for parents)
+_lock = threading.Lock()
+
+
+class Span:
+    """An open span; set .rows / .bytes / .attrs inside the with-block."""
+
+    __slots__ = ("name", "parent", "rows", "bytes", "attrs", "status", "start", "_t0")
+
+    def __init__(self, name, parent, rows=None, bytes=None, attrs=None):
+        self.name = name
+        self.parent = parent
+        self.rows = rows
+        self.bytes = bytes
+        self.attrs = attrs or {}
+        self.status = "ok"
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+
+
+@contextlib.contextmanager
+def span(name, rows=None, bytes=None, **attrs):
+    """Time the with-block as one span (nested spans record their parent)."""
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    current = Span(name, stack[-1].name if stack else None, rows, bytes, attrs)
+    stack.append(current)
+    try:
+        yield current
+    except BaseException:
+        current.status = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - current._t0
+        stack.pop()
+        record = {
+            "span": current.name,
+            "parent": current.parent,
+            "start": round(current.start, 6),
+            "duration_seconds": round(duration, 6),
+            "rows": current.rows,
+            "bytes": current.bytes,
+            "status": current.status,
+        }
+        if current.attrs:
+            record["attrs"] = current.attrs
+        with _lock:
+            SPANS.append(record)
+
+
+def reset_spans():
+    with _lock:
+        SPANS.clear()
+
+
+def file_size(path):
+    """Size of path in bytes (0 if it doesn't exist)."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def json_size(obj):
+    """Bytes of obj serialised as JSON (size of parsed API records)."""
+    return len(json.dumps(obj, default=str).encode("utf-8"))
+
+
+def database_bytes(conn):
+    """Current size of the connection's main database (page_count * page_size)."""
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return page_count * page_size
+
+
+def summarize_spans(spans=None):
+    """{span name: {"count", "duration_seconds", "rows", "bytes", "errors"}} (summed)."""
+    summary = {}
+    for record in SPANS if spans is None else spans:
+        entry = summary.setdefault(record["span"], {
+            "count": 0, "duration_seconds": 0.0, "rows": 0, "bytes": 0, "errors": 0,
+        })
+        entry["count"] += 1
+        entry["duration_seconds"] += record["duration_seconds"]
+        entry["rows"] += record["rows"] or 0
+        entry["bytes"] += record["bytes"] or 0
+        entry["errors"] += record["status"] != "ok"
+    return summary
+
+
+def print_span_summary():
+    print("\n=== Pipeline timings ===")
+    for name, entry in summarize_spans().items():
+        print(f"{name:<32} {entry['duration_seconds']:>9.3f}s  x{entry['count']:<3}"
+              f" rows={entry['rows']:<8} bytes={entry['bytes']}")
+    print("=== END timings ===\n")
+
+
+# ------------------------------------------------------------
+# Outbound HTTP calls
+# ------------------------------------------------------------
+# upper bounds (seconds) of the Prometheus histogram buckets
+HTTP_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MAX_LATENCY_SAMPLES = 10_000  # per endpoint; beyond that a uniform reservoir
+
+
+class LatencyHistogram:
+    """
+    Bucket counts (for Prometheus) + a bounded sample of raw latencies
+    (exact percentiles up to MAX_LATENCY_SAMPLES calls, reservoir after).
+    """
+
+    def __init__(self, buckets=HTTP_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)  # non-cumulative
+        self.count = 0
+        self.sum = 0.0
+        self.samples = []
+        self._rng = random.Random(0)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        for i, upper in enumerate(self.buckets):
+            if seconds <= upper:
+                self.bucket_counts[i] += 1
+                break
+        if len(self.samples) < MAX_LATENCY_SAMPLES:
+            self.samples.append(seconds)
+        else:
+            j = self._rng.randrange(self.count)
+            if j < MAX_LATENCY_SAMPLES:
+                self.samples[j] = seconds
+
+    def quantile(self, q):
+        """Linear-interpolated quantile of the samples (None if empty)."""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        pos = q * (len(ordered) - 1)
+        lo = int(pos)
+        hi = min(lo + 1, len(ordered) - 1)
+        return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.status_codes = {}  # "200" -> count
+        self.errors = {}  # "timeout" / "connection_error" / exception name -> count
+        self.bytes = 0
+
+
+API_STATS = {}  # endpoint name -> EndpointStats
+
+
+def classify_error(exc):
+    """Error class for the counters: timeout / connection_error / exception name."""
+    names = {cls.__name__ for cls in type(exc).__mro__}
+    if isinstance(exc, TimeoutError) or names & {"Timeout", "ReadTimeout", "ConnectTimeout"}:
+        return "timeout"
+    if isinstance(exc, ConnectionError) or "ConnectionError" in names:
+        return "connection_error"
+    return type(exc).__name__
+
+
+def record_request(endpoint, seconds, status=None, error=None, nbytes=0):
+    with _lock:
+        stats = API_STATS.get(endpoint)
+        if stats is None:
+            stats = API_STATS[endpoint] = EndpointStats()
+        stats.latency.observe(seconds)
+        if status is not None:
+            key = str(status)
+            stats.status_codes[key] = stats.status_codes.get(key, 0) + 1
+        if error is not None:
+            stats.errors[error] = stats.errors.get(error, 0) + 1
+        stats.bytes += nbytes
+
+
+def timed_request(endpoint, send, *args, **kwargs):
+    """
+    response = timed_request("geodb.cities", requests.get, url, params=...)
+
+    Calls send(*args, **kwargs) and records its latency, status code and
+    payload size under `endpoint`; exceptions are counted by class and
+    re-raised unchanged. Streamed bodies go through timed_stream instead.
+    """
+    start = time.perf_counter()
+    try:
+        response = send(*args, **kwargs)
+    except Exception as e:
+        record_request(endpoint, time.perf_counter() - start, error=classify_error(e))
+        raise
+    record_request(endpoint, time.perf_counter() - start,
+                   status=response.status_code, nbytes=len(response.content or b""))
+    return response
+
+
+@contextlib.contextmanager
+def timed_stream(endpoint, send, *args, **kwargs):
+    """
+    with timed_stream("openaq.latest", session.get, url, stream=True) as (response, count):
+        rows = parse(count(response.iter_content(CHUNK_BYTES)))
+
+    timed_request for a body read as it streams in. The request is recorded
+    when the block exits: latency up to then (the body included), the bytes
+    that went through count(), and the class of any exception raised in the
+    block (raise_for_status, read timeouts, connections cut mid-body,
+    malformed JSON). The response is closed on exit.
+    """
+    start = time.perf_counter()
+    try:
+        response = send(*args, **kwargs)
+    except Exception as e:
+        record_request(endpoint, time.perf_counter() - start, error=classify_error(e))
+        raise
+    nbytes = 0
+
+    def count(chunks):
+        nonlocal nbytes
+        for chunk in chunks:
+            nbytes += len(chunk)
+            yield chunk
+
+    error = None
+    try:
+        with response:
+            yield response, count
+    except Exception as e:
+        error = classify_error(e)
+        raise
+    finally:
+        record_request(endpoint, time.perf_counter() - start,
+                       status=response.status_code, error=error, nbytes=nbytes)
+
+
+def reset_api_stats():
+    with _lock:
+        API_STATS.clear()
+
+
+def api_report():
+    """{endpoint: {"requests", "p50", "p95", "p99", "mean", "status_codes", "errors", "bytes"}}"""
+    with _lock:
+        report = {}
+        for endpoint, stats in sorted(API_STATS.items()):
+            hist = stats.latency
+            report[endpoint] = {
+                "requests": hist.count,
+                "p50": hist.quantile(0.50),
+                "p95": hist.quantile(0.95),
+                "p99": hist.quantile(0.99),
+                "mean": hist.sum / hist.count if hist.count else None,
+                "status_codes": dict(stats.status_codes),
+                "errors": dict(stats.errors),
+                "bytes": stats.bytes,
+            }
+    return report
+
+
+def print_api_report():
+    report = api_report()
+    if not report:
+        return
+    print("\n=== API latency ===")
+    for endpoint, r in report.items():
+        codes = ", ".join(f"{code}:{n}" for code, n in sorted(r["status_codes"].items()))
+        errors = ", ".join(f"{err}:{n}" for err, n in sorted(r["errors"].items()))
+        print(f"{endpoint:<22} n={r['requests']:<4} p50={r['p50']:.3f}s p95={r['p95']:.3f}s "
+              f"p99={r['p99']:.3f}s bytes={r['bytes']:<8} codes[{codes}]"
+              + (f" errors[{errors}]" if errors else ""))
+    print("=== END API latency ===\n")
+
+
+def _http_prometheus_lines():
+    lines = []
+    with _lock:
+        items = sorted(API_STATS.items())
+
+        name = f"{METRIC_PREFIX}_http_request_duration_seconds"
+        lines.append(f"# HELP {name} Latency of outbound API calls during the last run.")
+        lines.append(f"# TYPE {name} histogram")
+        for endpoint, stats in items:
+            hist = stats.latency
+            label = f'endpoint="{_label(endpoint)}"'
+            cumulative = 0
+            for upper, n in zip(hist.buckets, hist.bucket_counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{{label},le="{upper}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{label},le="+Inf"}} {hist.count}')
+            lines.append(f"{name}_sum{{{label}}} {hist.sum:.6f}")
+            lines.append(f"{name}_count{{{label}}} {hist.count}")
+
+        counters = [
+            ("http_responses", "API responses by status code during the last run.",
+             "code", lambda st: st.status_codes),
+            ("http_errors", "API calls that failed without a response, by error class.",
+             "error", lambda st: st.errors),
+        ]
+        for suffix, help_text, label_name, values in counters:
+            name = f"{METRIC_PREFIX}_{suffix}"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for endpoint, stats in items:
+                for key, n in sorted(values(stats).items()):
+                    lines.append(f'{name}{{endpoint="{_label(endpoint)}",'
+                                 f'{label_name}="{_label(key)}"}} {n}')
+
+        name = f"{METRIC_PREFIX}_http_response_bytes"
+        lines.append(f"# HELP {name} Payload bytes received from each API during the last run.")
+        lines.append(f"# TYPE {name} gauge")
+        for endpoint, stats in items:
+            lines.append(f'{name}{{endpoint="{_label(endpoint)}"}} {stats.bytes}')
+    return lines
+
+
+# ------------------------------------------------------------
+# Export
+# ------------------------------------------------------------
+def export_spans_jsonl(path, run_id=None):
+    """Append this run's spans to a JSON Lines file; returns the run id."""
+    run_id = run_id or uuid.uuid4().hex[:12]
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with _lock:
+        records = list(SPANS)
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps({"run_id": run_id, **record}) + "\n")
+    return run_id
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text():
+    """This run's spans (summed per span name) + API stats in the Prometheus text format."""
+    summary = summarize_spans()
+    metrics = [
+        ("span_duration_seconds", "Wall time spent in each pipeline span during the last run.",
+         "duration_seconds"),
+        ("span_calls", "Number of times each span ran during the last run.", "count"),
+        ("span_rows", "Rows handled by each span during the last run.", "rows"),
+        ("span_bytes", "Bytes handled by each span during the last run.", "bytes"),
+        ("span_errors", "Spans that ended with an exception during the last run.", "errors"),
+    ]
+    lines = []
+    for suffix, help_text, key in metrics:
+        name = f"{METRIC_PREFIX}_{suffix}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for span_name, entry in summary.items():
+            lines.append(f'{name}{{span="{_label(span_name)}"}} {entry[key]}')
+
+    lines.extend(_http_prometheus_lines())
+
+    name = f"{METRIC_PREFIX}_last_run_timestamp_seconds"
+    lines.append(f"# HELP {name} Unix time the metrics were exported.")
+    lines.append(f"# TYPE {name} gauge")
+    lines.append(f"{name} {time.time():.3f}")
+    return "\n".join(lines) + "\n"
+
+
+def export_prometheus(path):
+    """Write prometheus_text() atomically (scrapers never see half a file)."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
+
+
+def export_metrics(metrics_dir, run_id=None):
+    """
+    In metrics_dir: spans.jsonl + api_latency.jsonl (appended, one line per
+    span / endpoint) and pipeline.prom (replaced).
+    """
+    run_id = export_spans_jsonl(os.path.join(metrics_dir, "spans.jsonl"), run_id=run_id)
+    with open(os.path.join(metrics_dir, "api_latency.jsonl"), "a") as f:
+        for endpoint, entry in api_report().items():
+            f.write(json.dumps({"run_id": run_id, "endpoint": endpoint, **entry}) + "\n")
+    export_prometheus(os.path.join(metrics_dir, "pipeline.prom"))
+    print(f"Metrics for run {run_id} written to {metrics_dir}/")
+    return run_id
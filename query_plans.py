@@ -0,0 +1,313 @@
+# ============================================================
+# query_plans.py
+# Query-plan regression guard for the project's SQL
+# ============================================================
+#
+# 1. capture_statements() builds a synthetic database (synthetic_data.py) and
+#    runs the project's real code paths (stats, join report, store_*,
+#    backfill insert, crosswalk update, correlations, query service) with sqlite3's
+#    trace callback on, so every statement the project executes is recorded.
+# 2. Each distinct statement (literals replaced by ?) gets its
+#    EXPLAIN QUERY PLAN, and the plan is checked for
+#      full-scan:<table>    SCAN of a large table without an index
+#      temp-btree:<use>     USE TEMP B-TREE (a sort / distinct / group by
+#                           that no index provides) in a plan touching a
+#                           large table
+#      auto-index:<table>   SQLite building a throw-away index on every run
+#                           (there is no usable real index)
+# 3. The plans are stored in query_plans.json (the baseline, committed to
+#    the repo). `check` fails when a statement has a flag its baseline plan
+#    didn't have, so a schema or query change can't silently bring back
+#    O(n^2) behaviour. Accepted changes are recorded with `--update`.
+#
+#   python starter.py plans            # check against the baseline
+#   python starter.py plans --update   # re-record the baseline
+
+import os
+import re
+import json
+import hashlib
+import sqlite3
+import tempfile
+import contextlib
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_plans.json")
+
+# a table with at least this many rows in the workload database is "large"
+# (the workload database is sized so the observation tables and the city
+# tables all cross it)
+LARGE_TABLE_ROWS = 1000
+
+WORKLOAD_CITIES = 2000
+WORKLOAD_HOURS = 24
+
+_DML = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?(?![\w.])")
+_SCAN_OR_SEARCH = re.compile(r"^(SCAN|SEARCH) (\w+)(?: AS \w+)?(.*)$")
+_FROM_ALIAS = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+_NOT_ALIASES = {"ON", "WHERE", "JOIN", "LEFT", "INNER", "CROSS", "GROUP", "ORDER",
+                "LIMIT", "USING", "NATURAL", "OUTER", "SET", "VALUES", "UNION"}
+
+
+def normalize_sql(sql):
+    """Statement text with literals replaced by ? and whitespace collapsed."""
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?, ...)", sql)  # IN / VALUES lists
+    return " ".join(sql.split()).rstrip(";")
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:12]
+
+
+# ------------------------------------------------------------
+# Capturing the project's statements
+# ------------------------------------------------------------
+def capture_statements(work_dir=None, n_cities=WORKLOAD_CITIES, hours=WORKLOAD_HOURS):
+    """
+    Run the project workload on a synthetic database with tracing on.
+
+    Returns (db_path, {fingerprint: example SQL with literals}); the
+    database is left in work_dir for explain_statements.
+    """
+    import starter
+    from synthetic_data import generate_database
+    from analysis_visualizations import calculate_city_stats
+    from query_service import QueryService
+    from analytics import correlation_report
+    from running_stats import city_metric_stats
+
+    work_dir = work_dir or tempfile.mkdtemp(prefix="city_plans_")
+    db_path = os.path.join(work_dir, "plans.db")
+    statements = {}
+
+    def trace(sql):
+        text = sql.strip()
+        if "_rtree_" in text:
+            return  # the R*Tree module's own reads / writes of its shadow tables
+        if text.upper().startswith(_DML):
+            statements.setdefault(fingerprint(normalize_sql(text)), text)
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        generate_database(db_path, n_cities, hours=hours, pollutants=("pm25", "no2"),
+                          overwrite=True)
+
+        conn = sqlite3.connect(db_path)
+        conn.set_trace_callback(trace)
+        t0 = 1_704_067_200
+
+        # aggregation + reports
+        calculate_city_stats(conn, memoize=False)
+        calculate_city_stats(conn, pollutants=("pm25", "no2"), since=t0,
+                             until=t0 + 6 * 3600, memoize=False)
+        starter.debug_city_join_status(conn)
+
+        # ingest paths (one small payload each is enough to see the SQL)
+        starter.store_weather_data(conn, [{
+            "city_name": "Plan City", "country": "XX", "latitude": 1.0, "longitude": 2.0,
+            "timestamp": t0, "temperature": 10.0, "feels_like": 9.0, "humidity": 50,
+            "wind_speed": 1.0, "weather_main": "Clear",
+        }])
+        starter.store_air_quality_data(conn, [
+            {"city": "Plan City", "location": "Plan Station", "latitude": None,
+             "longitude": None, "pm25": 12.0, "unit": "µg/m³", "timestamp": "2024-01-01T00:00:00Z"},
+            # no city near these coordinates: falls through to the fuzzy match
+            {"city": "Plan Town", "location": "Plan Station", "latitude": -45.0,
+             "longitude": 100.0, "pm25": 12.0, "unit": "µg/m³", "timestamp": "2024-01-01T00:00:00Z"},
+        ])
+        starter.store_city_data(conn, [{
+            "geodb_id": "plan-1", "name": "Plan City", "country": "XX", "region": None,
+            "population": 1000, "latitude": 1.0, "longitude": 2.0,
+        }])
+        starter.store_weather_series(conn, [(1, t0, 10.0, 9.0, 50, 1.0, "Clear")])
+        starter.update_crosswalk(conn)
+        starter.prune_rolling_buckets(conn)
+        city_metric_stats(conn, "temperature")
+        correlation_report(conn, calculate_city_stats(conn, memoize=False),
+                           by=("all", "country", "region"), window="1d", n_boot=0)
+        conn.close()
+
+        # read-only query service
+        service = QueryService(db_path, pool_size=1, trace=trace)
+        for path, params in [
+            ("/cities", {"limit": ["10"]}),
+            ("/top", {"metric": ["avg_pm25"]}),
+            ("/cities/1/weather", {"since": [str(t0)], "limit": ["10"]}),
+            ("/cities/1/air-quality", {"parameter": ["pm25"]}),
+            ("/cities/1/rolling", {"metric": ["pm25"], "window": ["24h"]}),
+            ("/cities/1/stats", {}),
+            ("/rolling", {"metric": ["temperature"], "window": ["7d"]}),
+            ("/rolling", {"metric": ["pm25"], "window": ["24h"], "end": [str(t0)]}),
+        ]:
+            service.handle(path, params)
+        service.close()
+
+    return db_path, statements
+
+
+# ------------------------------------------------------------
+# Explaining + flagging
+# ------------------------------------------------------------
+def table_sizes(conn):
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+    return {t: conn.execute(f'SELECT COUNT(*) FROM "{t}"').fetchone()[0] for t in tables}
+
+
+def explain(conn, sql):
+    """EXPLAIN QUERY PLAN as indented detail lines (nesting = 2 spaces)."""
+    rows = conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return lines
+
+
+def table_aliases(sql):
+    """{alias or table name: table name} from the FROM / JOIN clauses."""
+    aliases = {}
+    for table, alias in _FROM_ALIAS.findall(sql):
+        aliases[table] = table
+        if alias and alias.upper() not in _NOT_ALIASES:
+            aliases[alias] = table
+    return aliases
+
+
+def plan_flags(plan, large_tables, aliases=None):
+    """
+    The problems in one plan (sorted list of 'kind:table-or-use' strings).
+
+    Plans name tables by their alias ("SCAN c"), so aliases (from
+    table_aliases) maps them back to table names.
+    """
+    aliases = aliases or {}
+    flags = set()
+    touches_large = False
+    for line in plan:
+        detail = line.strip()
+        step = _SCAN_OR_SEARCH.match(detail)
+        if not step:
+            continue
+        kind, name, rest = step.groups()
+        table = aliases.get(name, name)
+        if table not in large_tables:
+            continue
+        touches_large = True
+        if "AUTOMATIC" in rest:
+            flags.add(f"auto-index:{table}")
+        elif kind == "SCAN" and "INDEX" not in rest:
+            flags.add(f"full-scan:{table}")
+    if touches_large:
+        for line in plan:
+            detail = line.strip()
+            if detail.startswith("USE TEMP B-TREE FOR "):
+                flags.add("temp-btree:" + detail[len("USE TEMP B-TREE FOR "):])
+    return sorted(flags)
+
+
+def explain_statements(db_path, statements):
+    """{fingerprint: {"sql", "plan", "flags"}} for the captured statements."""
+    conn = sqlite3.connect(db_path)
+    sizes = table_sizes(conn)
+    large = {t for t, n in sizes.items() if n >= LARGE_TABLE_ROWS}
+
+    plans = {}
+    for key, sql in sorted(statements.items()):
+        try:
+            plan = explain(conn, sql)
+        except sqlite3.Error as e:
+            plan = [f"(could not explain: {e})"]
+        flags = plan_flags(plan, large, table_aliases(sql))
+        plans[key] = {"sql": normalize_sql(sql), "plan": plan, "flags": flags}
+    conn.close()
+    return plans
+
+
+def current_plans(work_dir=None):
+    """Capture + explain in a throw-away directory."""
+    import shutil
+
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="city_plans_")
+    try:
+        db_path, statements = capture_statements(work_dir)
+        return explain_statements(db_path, statements)
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# ------------------------------------------------------------
+# Baseline
+# ------------------------------------------------------------
+def load_baseline(path=BASELINE_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(plans, path=BASELINE_FILE):
+    with open(path, "w") as f:
+        json.dump(plans, f, indent=2, sort_keys=True, ensure_ascii=False)
+        f.write("\n")
+
+
+def compare_plans(current, baseline):
+    """
+    (regressions, notes): regressions are statements whose plan gained a
+    flag (new statements count against an empty baseline); notes are plan
+    changes without new flags and statements that disappeared.
+    """
+    regressions, notes = [], []
+    for key, entry in sorted(current.items()):
+        before = baseline.get(key)
+        old_flags = set(before["flags"]) if before else set()
+        new_flags = sorted(set(entry["flags"]) - old_flags)
+        if new_flags:
+            regressions.append((key, entry, new_flags))
+        elif before is None:
+            notes.append(f"new statement {key}: {entry['sql'][:100]}")
+        elif before["plan"] != entry["plan"]:
+            notes.append(f"plan changed (no new flags) {key}: {entry['sql'][:100]}")
+    for key in sorted(set(baseline) - set(current)):
+        notes.append(f"statement no longer run {key}: {baseline[key]['sql'][:100]}")
+    return regressions, notes
+
+
+def run_plan_check(update=False, baseline_path=BASELINE_FILE):
+    """`plans` command; returns True when there is no regression."""
+    print("Capturing the project's SQL on a synthetic database...")
+    current = current_plans()
+    flagged = sum(1 for entry in current.values() if entry["flags"])
+    print(f"{len(current)} distinct statements, {flagged} with flagged plans.")
+
+    if update:
+        save_baseline(current, baseline_path)
+        print(f"Baseline written to {baseline_path}")
+        return True
+
+    baseline = load_baseline(baseline_path)
+    if not baseline:
+        print(f"No baseline at {baseline_path}; run with --update first.")
+        return False
+
+    regressions, notes = compare_plans(current, baseline)
+    for note in notes:
+        print("NOTE:", note)
+    for key, entry, new_flags in regressions:
+        print(f"\nREGRESSION {key}: {', '.join(new_flags)}")
+        print("  " + entry["sql"][:300])
+        for line in entry["plan"]:
+            print("    " + line)
+
+    if regressions:
+        print(f"\n{len(regressions)} query plan regression(s). Fix the query / schema, "
+              "or accept with `plans --update`.")
+        return False
+    print("Query plans OK: no new full scans, temp B-trees or automatic indexes.")
+    return True
@@ -0,0 +1,396 @@
+# ============================================================
+# query_service.py
+# Small read-only HTTP/JSON service over final_project.db
+# ============================================================
+#
+# Endpoints (all GET, all JSON):
+#   /health
+#   /cities?limit=&offset=&since=&until=      city stats (calculate_city_stats)
+#   /cities/<id>                              one city's stats
+#   /cities/<id>/weather?limit=&offset=&since=&until=
+#                                             weather time series, oldest first
+#   /cities/<id>/air-quality?parameter=pm25&limit=&offset=
+#                                             measurement time series
+#   /top?metric=avg_pm25&k=10&order=desc      top-k ranking of the city stats
+#   /rolling?metric=pm25&window=24h&end=      rolling-window mean for every city
+#   /cities/<id>/rolling?metric=pm25&window=24h&end=
+#                                             one city's rolling-window mean
+#                                             (rolling.py; end defaults to the
+#                                             city's newest data)
+#   /cities/<id>/stats?metric=               all-time n / mean / variance / std /
+#                                             min / max per metric (running_stats.py)
+#
+# Only the standard library is used (ThreadingHTTPServer), so it runs
+# anywhere the pipeline does:  python starter.py serve --port 8000
+#
+# - connections are opened read-only (sqlite URI mode=ro) and pooled, so the
+#   service can never write to the database or block an ingest
+# - responses are kept in an LRU cache keyed on the request; the whole cache
+#   is dropped as soon as the database files change on disk (a commit by
+#   `ingest` / `backfill` changes the size / mtime of the db or its -wal)
+
+import os
+import json
+import queue
+import sqlite3
+import threading
+import contextlib
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from analysis_visualizations import calculate_city_stats
+from rolling import rolling_mean, rolling_means
+from running_stats import metric_stats
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CACHE_ENTRIES = 256
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# columns of the city stats that /top may rank by
+RANKABLE_METRICS = ("avg_pm25", "avg_temp", "population", "aqi")
+
+
+class BadRequest(ValueError):
+    """Invalid query parameters -> HTTP 400."""
+
+
+class NotFound(LookupError):
+    """Unknown path or city -> HTTP 404."""
+
+
+# ------------------------------------------------------------
+# Connection pool + cache
+# ------------------------------------------------------------
+class ReadOnlyConnectionPool:
+    """A fixed number of read-only SQLite connections shared by the threads."""
+
+    def __init__(self, db_path, size=DEFAULT_POOL_SIZE, trace=None):
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"Database not found: {db_path}")
+        self.db_path = db_path
+        self._pool = queue.Queue()
+        uri = "file:" + os.path.abspath(db_path) + "?mode=ro"
+        for _ in range(size):
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            if trace is not None:
+                conn.set_trace_callback(trace)  # e.g. query_plans capturing SQL
+            self._pool.put(conn)
+        self.size = size
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def close(self):
+        for _ in range(self.size):
+            self._pool.get().close()
+
+
+def data_stamp(db_path):
+    """Changes whenever a write to the database has been committed."""
+    stamp = []
+    for path in (db_path, db_path + "-wal"):
+        try:
+            st = os.stat(path)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+class LRUCache:
+    """Thread-safe LRU cache that empties itself when the data stamp moves."""
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._stamp = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, stamp, compute):
+        with self._lock:
+            if stamp != self._stamp:
+                self._entries.clear()
+                self._stamp = stamp
+            elif key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        # computed outside the lock so slow queries don't serialise the server
+        value = compute()
+
+        with self._lock:
+            if stamp == self._stamp:
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+
+# ------------------------------------------------------------
+# Queries
+# ------------------------------------------------------------
+def _int_param(params, name, default, minimum=0, maximum=None):
+    raw = params.get(name, [None])[0]
+    if raw is None or raw == "":
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer") from None
+    if value < minimum:
+        raise BadRequest(f"{name} must be >= {minimum}")
+    if maximum is not None and value > maximum:
+        raise BadRequest(f"{name} must be <= {maximum}")
+    return value
+
+
+def _page_params(params):
+    limit = _int_param(params, "limit", DEFAULT_PAGE_SIZE, minimum=1, maximum=MAX_PAGE_SIZE)
+    offset = _int_param(params, "offset", 0)
+    return limit, offset
+
+
+def _page(items, total, limit, offset):
+    next_offset = offset + limit if offset + limit < total else None
+    return {"items": items, "total": total, "limit": limit,
+            "offset": offset, "next_offset": next_offset}
+
+
+class QueryService:
+    """Routes a (path, query params) pair to a cached JSON-able result."""
+
+    def __init__(self, db_path, pool_size=DEFAULT_POOL_SIZE,
+                 cache_entries=DEFAULT_CACHE_ENTRIES, trace=None):
+        self.db_path = db_path
+        self.pool = ReadOnlyConnectionPool(db_path, size=pool_size, trace=trace)
+        self.cache = LRUCache(max_entries=cache_entries)
+
+    def close(self):
+        self.pool.close()
+
+    def handle(self, path, params):
+        parts = [p for p in path.split("/") if p]
+        if parts == ["health"]:
+            return {"status": "ok", "cache_hits": self.cache.hits,
+                    "cache_misses": self.cache.misses}
+
+        stamp = data_stamp(self.db_path)
+        key = (tuple(parts), tuple(sorted((k, tuple(v)) for k, v in params.items())))
+        return self.cache.get_or_compute(key, stamp, lambda: self._route(parts, params))
+
+    def _route(self, parts, params):
+        if parts == ["cities"]:
+            return self.cities(params)
+        if parts == ["top"]:
+            return self.top(params)
+        if parts == ["rolling"]:
+            return self.rolling(None, params)
+        if len(parts) >= 2 and parts[0] == "cities":
+            try:
+                city_id = int(parts[1])
+            except ValueError:
+                raise NotFound(f"Unknown city id {parts[1]!r}") from None
+            if len(parts) == 2:
+                return self.city(city_id, params)
+            if parts[2:] == ["weather"]:
+                return self.weather_series(city_id, params)
+            if parts[2:] == ["air-quality"]:
+                return self.air_quality_series(city_id, params)
+            if parts[2:] == ["rolling"]:
+                return self.rolling(city_id, params)
+            if parts[2:] == ["stats"]:
+                return self.running_stats(city_id, params)
+        raise NotFound("Unknown endpoint /" + "/".join(parts))
+
+    def _city_stats(self, params):
+        since = _int_param(params, "since", None)
+        until = _int_param(params, "until", None)
+        # the full stats list is cached on its own so every page / ranking
+        # of the same window shares one aggregation query
+        key = (("_city_stats",), since, until)
+
+        def compute():
+            with self.pool.connection() as conn:
+                return calculate_city_stats(conn, since=since, until=until)
+
+        return self.cache.get_or_compute(key, data_stamp(self.db_path), compute)
+
+    def cities(self, params):
+        limit, offset = _page_params(params)
+        stats = self._city_stats(params)
+        return _page(stats[offset:offset + limit], len(stats), limit, offset)
+
+    def city(self, city_id, params):
+        for row in self._city_stats(params):
+            if row["city_id"] == city_id:
+                return row
+        raise NotFound(f"No stats for city {city_id}")
+
+    def top(self, params):
+        metric = params.get("metric", ["avg_pm25"])[0]
+        if metric not in RANKABLE_METRICS:
+            raise BadRequest(f"metric must be one of {', '.join(RANKABLE_METRICS)}")
+        order = params.get("order", ["desc"])[0]
+        if order not in ("asc", "desc"):
+            raise BadRequest("order must be asc or desc")
+        k = _int_param(params, "k", 10, minimum=1, maximum=MAX_PAGE_SIZE)
+
+        rows = [row for row in self._city_stats(params) if row.get(metric) is not None]
+        rows.sort(key=lambda row: row[metric], reverse=(order == "desc"))
+        return {"metric": metric, "order": order, "items": rows[:k]}
+
+    def rolling(self, city_id, params):
+        metric = params.get("metric", ["pm25"])[0]
+        window = params.get("window", ["24h"])[0]
+        end = _int_param(params, "end", None)
+        with self.pool.connection() as conn:
+            try:
+                if city_id is None:
+                    items = list(rolling_means(conn, metric, window, end=end).values())
+                    return {"metric": metric, "window": window, "items": items}
+                result = rolling_mean(conn, city_id, metric, window, end=end)
+            except ValueError as e:  # bad window
+                raise BadRequest(str(e)) from None
+        if result is None:
+            raise NotFound(f"No {metric} data for city {city_id}")
+        return result
+
+    def running_stats(self, city_id, params):
+        metric = params.get("metric", [None])[0]
+        with self.pool.connection() as conn:
+            found = metric_stats(conn, city_id)
+        if metric is not None:
+            found = {m: stats for m, stats in found.items() if m == metric}
+        if not found:
+            raise NotFound(f"No {metric or 'observations'} for city {city_id}")
+        return {"city_id": city_id,
+                "metrics": {m: stats.as_dict() for m, stats in sorted(found.items())}}
+
+    def weather_series(self, city_id, params):
+        limit, offset = _page_params(params)
+        since = _int_param(params, "since", None)
+        until = _int_param(params, "until", None)
+
+        # text bounds on the stored TEXT column: a range in idx_weather_city_time
+        # (see calculate_city_stats)
+        where = "WHERE city_id = ?"
+        args = [city_id]
+        if since is not None:
+            where += " AND timestamp >= ?"
+            args.append(str(since))
+        if until is not None:
+            where += " AND timestamp < ?"
+            args.append(str(until))
+
+        with self.pool.connection() as conn:
+            total = conn.execute(
+                f"SELECT COUNT(*) FROM WeatherObservations {where}", args
+            ).fetchone()[0]
+            cur = conn.execute(
+                f"""
+                SELECT CAST(timestamp AS INTEGER), temperature, feels_like,
+                       humidity, wind_speed, weather_main
+                FROM WeatherObservations
+                {where}
+                ORDER BY timestamp
+                LIMIT ? OFFSET ?
+                """,
+                args + [limit, offset],
+            )
+            columns = ["timestamp", "temperature", "feels_like",
+                       "humidity", "wind_speed", "weather_main"]
+            items = [dict(zip(columns, row)) for row in cur.fetchall()]
+        return _page(items, total, limit, offset)
+
+    def air_quality_series(self, city_id, params):
+        limit, offset = _page_params(params)
+        parameter = params.get("parameter", ["pm25"])[0]
+
+        query_from = """
+            FROM AirQualityMeasurements aqm
+            JOIN AirQualityLocations aql ON aql.id = aqm.location_id
+            WHERE aql.city_id = ? AND aqm.parameter = ?
+        """
+        with self.pool.connection() as conn:
+            total = conn.execute(
+                "SELECT COUNT(*) " + query_from, (city_id, parameter)
+            ).fetchone()[0]
+            cur = conn.execute(
+                "SELECT aqm.timestamp, aqm.value, aqm.unit, aql.location_name "
+                + query_from + " ORDER BY aqm.timestamp LIMIT ? OFFSET ?",
+                (city_id, parameter, limit, offset),
+            )
+            columns = ["timestamp", "value", "unit", "location"]
+            items = [dict(zip(columns, row)) for row in cur.fetchall()]
+        return _page(items, total, limit, offset)
+
+
+# ------------------------------------------------------------
+# HTTP glue
+# ------------------------------------------------------------
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    server_version = "CityExplorers/1.0"
+    service = None  # set by make_server
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        try:
+            result = self.service.handle(url.path, parse_qs(url.query))
+            status = 200
+        except BadRequest as e:
+            result, status = {"error": str(e)}, 400
+        except NotFound as e:
+            result, status = {"error": str(e)}, 404
+        except sqlite3.Error as e:
+            result, status = {"error": f"database error: {e}"}, 500
+        except Exception as e:  # still answer, rather than drop the connection
+            result, status = {"error": f"internal error: {type(e).__name__}: {e}"}, 500
+
+        body = json.dumps(result, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # keep the console quiet at high request rates
+
+
+def make_server(db_path, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                pool_size=DEFAULT_POOL_SIZE, cache_entries=DEFAULT_CACHE_ENTRIES):
+    """Build (but don't start) the HTTP server; port=0 picks a free port."""
+    service = QueryService(db_path, pool_size=pool_size, cache_entries=cache_entries)
+    handler = type("BoundQueryRequestHandler", (QueryRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def serve(db_path, host=DEFAULT_HOST, port=DEFAULT_PORT, pool_size=DEFAULT_POOL_SIZE):
+    """Run the service until Ctrl+C."""
+    server = make_server(db_path, host=host, port=port, pool_size=pool_size)
+    print(f"Serving {db_path} read-only on http://{server.server_address[0]}:"
+          f"{server.server_address[1]}/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping query service.")
+    finally:
+        server.server_close()
+        server.service.close()
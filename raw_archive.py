@@ -0,0 +1,262 @@
+# ============================================================
+# raw_archive.py
+# Compressed, append-only, content-deduplicated archive of raw API responses
+# ============================================================
+#
+# Every API body we parse is kept exactly as it arrived, so the rows stored
+# from it can be rebuilt (`starter.py reprocess`) after the parsing changes,
+# without calling the APIs again (no quota, no lost history).
+#
+#   raw_archive/
+#     objects/3f/3fa2...e9.json.gz   one gzip file per distinct body, named
+#                                    by the sha256 of the uncompressed bytes
+#     index.jsonl                    one line per response received:
+#       {"source": "openweather.current", "sha256": "3fa2...", "bytes": 1432,
+#        "fetched_at": 1718000000, "context": {"query": "Paris,FR"}}
+#
+# Objects are written once (to a temporary file, then renamed into place)
+# and never modified; a body we already have only adds an index line. The
+# index is only ever appended to. "context" holds whatever the parse needs
+# besides the body (the city a backfill chunk was for, the OpenAQ run a
+# page belongs to...). Entries without a body (sha256 null) record a step
+# of a fetch, e.g. which cities an OpenAQ run was mapped onto.
+#
+# Fetch code calls the module-level helpers, which do nothing until an
+# archive is switched on with use_archive() (the CLI does that for
+# ingest / pipeline / backfill):
+#
+#   save_response("openweather.current", response, {"query": city})
+#   with archive_stream("openaq.latest", context) as tee:
+#       rows = list(iter_array_items(tee(response.iter_content(CHUNK_BYTES)), ...))
+
+import os
+import gzip
+import json
+import time
+import uuid
+import hashlib
+import itertools
+import threading
+from contextlib import contextmanager
+
+DEFAULT_ARCHIVE_DIR = "raw_archive"
+INDEX_FILE = "index.jsonl"
+OBJECTS_DIR = "objects"
+READ_CHUNK_BYTES = 64 * 1024
+
+
+class RawArchive:
+    """One archive directory (see the module comment for the layout)."""
+
+    def __init__(self, root=DEFAULT_ARCHIVE_DIR):
+        self.root = root
+        self.index_path = os.path.join(root, INDEX_FILE)
+        self.lock = threading.Lock()  # fetches run in thread pools
+
+    def __getstate__(self):
+        return {"root": self.root}  # for worker processes; locks don't pickle
+
+    def __setstate__(self, state):
+        self.__init__(state["root"])
+
+    def object_path(self, sha):
+        return os.path.join(self.root, OBJECTS_DIR, sha[:2], sha + ".json.gz")
+
+    def _temp_path(self):
+        os.makedirs(os.path.join(self.root, OBJECTS_DIR), exist_ok=True)
+        return os.path.join(self.root, OBJECTS_DIR, f".tmp-{uuid.uuid4().hex}")
+
+    def _commit_object(self, temp_path, sha):
+        """Move a finished temporary object into place (or drop it: a duplicate)."""
+        path = self.object_path(sha)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return True
+
+    def append_index(self, source, sha=None, nbytes=None, context=None, fetched_at=None):
+        entry = {
+            "source": source,
+            "sha256": sha,
+            "bytes": nbytes,
+            "fetched_at": int(time.time()) if fetched_at is None else fetched_at,
+            "context": context or {},
+        }
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self.lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(line)
+        return entry
+
+    def put(self, source, body, context=None):
+        """Archive one complete body (bytes); returns its index entry."""
+        sha = hashlib.sha256(body).hexdigest()
+        if not os.path.exists(self.object_path(sha)):
+            temp_path = self._temp_path()
+            # mtime=0: the same body always compresses to the same file
+            with gzip.GzipFile(temp_path, "wb", mtime=0) as f:
+                f.write(body)
+            self._commit_object(temp_path, sha)
+        return self.append_index(source, sha, len(body), context)
+
+    @contextmanager
+    def stream(self, source, context=None):
+        """
+        Archive a body while it is being read: yields tee(chunks), which
+        passes the chunks through while hashing + compressing them to a
+        temporary file. On a clean exit the rest of the body is drained and
+        the object + index line are committed; on an error nothing is.
+        """
+        temp_path = self._temp_path()
+        digest = hashlib.sha256()
+        nbytes = 0
+        pending = []
+        out = gzip.GzipFile(temp_path, "wb", mtime=0)
+
+        def tee(chunks):
+            nonlocal nbytes
+            chunks = iter(chunks)
+            pending.append(chunks)
+            for chunk in chunks:
+                digest.update(chunk)
+                out.write(chunk)
+                nbytes += len(chunk)
+                yield chunk
+
+        try:
+            yield tee
+            # a parser can stop at the closing bracket; keep the whole body
+            for chunks in pending:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    out.write(chunk)
+                    nbytes += len(chunk)
+            out.close()
+        except BaseException:
+            out.close()
+            os.remove(temp_path)
+            raise
+        sha = digest.hexdigest()
+        self._commit_object(temp_path, sha)
+        self.append_index(source, sha, nbytes, context)
+
+    def entries(self, sources=None):
+        """Index entries in the order they were appended (optionally only some sources)."""
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # e.g. a line cut short by a crash mid-append
+                    print(f"[WARN] Skipping unreadable line {line_number} of {self.index_path}")
+                    continue
+                if sources is None or entry.get("source") in sources:
+                    yield entry
+
+    def open(self, sha):
+        """The uncompressed body as a binary file object."""
+        return gzip.open(self.object_path(sha), "rb")
+
+    def read(self, sha):
+        with self.open(sha) as f:
+            return f.read()
+
+    def chunks(self, sha, chunk_bytes=READ_CHUNK_BYTES):
+        """The body as byte chunks (for json_stream.iter_array_items)."""
+        with self.open(sha) as f:
+            yield from iter(lambda: f.read(chunk_bytes), b"")
+
+    def load(self, sha):
+        """The body decoded as JSON."""
+        return json.loads(self.read(sha))
+
+    def summary(self):
+        """{"entries", "objects", "raw_bytes", "stored_bytes"} of the archive."""
+        entries = list(self.entries())
+        objects = {e["sha256"]: e.get("bytes") or 0 for e in entries if e.get("sha256")}
+        stored = sum(
+            os.path.getsize(self.object_path(sha))
+            for sha in objects if os.path.exists(self.object_path(sha))
+        )
+        return {"entries": len(entries), "objects": len(objects),
+                "raw_bytes": sum(objects.values()), "stored_bytes": stored}
+
+
+# ------------------------------------------------------------
+# The archive the fetch functions write to (None = archiving off)
+# ------------------------------------------------------------
+_active = None
+
+
+def use_archive(root):
+    """Archive every raw response into root from now on (None switches it off)."""
+    global _active
+    _active = RawArchive(root) if root else None
+    return _active
+
+
+def active_archive():
+    return _active
+
+
+def new_run_id():
+    """Id tying together the responses of one multi-request fetch."""
+    return uuid.uuid4().hex
+
+
+def save_response(source, response, context=None):
+    """Archive a (non-streamed) requests response's body, if archiving is on."""
+    if _active is not None:
+        _active.put(source, response.content, context)
+
+
+def save_record(source, context):
+    """Append a body-less index entry (a fetch step), if archiving is on."""
+    if _active is not None:
+        _active.append_index(source, context=context)
+
+
+@contextmanager
+def archive_stream(source, context=None):
+    """RawArchive.stream on the active archive; a pass-through when archiving is off."""
+    if _active is None:
+        yield lambda chunks: chunks
+        return
+    with _active.stream(source, context) as tee:
+        yield tee
+
+
+def _parse_chunk(parse, archive, entries):
+    return [parse(archive, entry) for entry in entries]
+
+
+def map_entries(archive, entries, parse, workers=None, chunk_size=16):
+    """
+    Yield parse(archive, entry) for every entry, in order. The parses run
+    in up to `workers` processes (default: one per core), chunk_size
+    entries per task; `parse` must be a module-level function. The caller
+    consumes the results as they come (e.g. a single database writer).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    entries = list(entries)
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(entries) <= chunk_size:
+        for entry in entries:
+            yield parse(archive, entry)
+        return
+
+    chunks = [entries[i:i + chunk_size] for i in range(0, len(entries), chunk_size)]
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+        results = pool.map(_parse_chunk, itertools.repeat(parse), itertools.repeat(archive),
+                           chunks)
+        for parsed in results:
+            yield from parsed
@@ -0,0 +1,174 @@
+# ============================================================
+# results_writer.py
+# Streaming writer for city statistics: text / CSV / JSON Lines (+ gzip)
+# ============================================================
+#
+# Rows can come from a list of dicts, any iterator of dicts, or straight from
+# a sqlite3 cursor. They are formatted one at a time into an in-memory chunk
+# that is written out every BUFFER_CHARS characters, so memory stays constant
+# however many rows are exported.
+#
+# A correlations table (analytics.correlation_report) can go along with the
+# city rows: as a closing section of a text file, or - since a CSV has one
+# header - as a sibling file (results.csv -> results.correlations.csv).
+
+import io
+import os
+import csv
+import gzip
+import json
+import sqlite3
+
+BUFFER_CHARS = 1 << 20  # ~1 MB of text per write() call
+
+FORMATS = ("text", "csv", "jsonl")
+_EXTENSIONS = {".txt": "text", ".csv": "csv", ".jsonl": "jsonl", ".json": "jsonl"}
+
+SEPARATOR = "-" * 40 + "\n"
+
+
+def iter_dict_rows(source):
+    """Yield dict rows from a cursor (column names from .description) or dicts."""
+    if isinstance(source, sqlite3.Cursor):
+        columns = [col[0] for col in source.description]
+        while True:
+            chunk = source.fetchmany(10_000)
+            if not chunk:
+                break
+            for row in chunk:
+                yield dict(zip(columns, row))
+    else:
+        yield from source
+
+
+def infer_format(filename, fmt=None, compress=None):
+    """(fmt, compress) from explicit arguments or the file extension."""
+    name = filename.lower()
+    if compress is None and name.endswith(".gz"):
+        compress = "gzip"
+    if name.endswith(".gz"):
+        name = name[:-3]
+    if fmt is None:
+        fmt = next((f for ext, f in _EXTENSIONS.items() if name.endswith(ext)), "text")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown results format {fmt!r}; choose from {', '.join(FORMATS)}")
+    if compress not in (None, "gzip"):
+        raise ValueError(f"Unknown compression {compress!r}; only 'gzip' is supported")
+    return fmt, compress
+
+
+def format_text_block(city):
+    """One city in the classic results.txt layout."""
+    population = city.get("population")
+
+    # Make population human-friendly
+    if population is None:
+        population_str = "Unknown (no population data)"
+    else:
+        # format like 1,234,567
+        population_str = f"{population:,}"
+
+    return (
+        f"City: {city.get('city')}\n"
+        f"Population: {population_str}\n"
+        f"Average Temperature: {city.get('avg_temp')}\n"
+        f"Average PM2.5: {city.get('avg_pm25')}\n"
+        f"Air Quality Category: {city.get('aq_category')}\n"
+        + SEPARATOR
+    )
+
+
+def correlations_filename(filename):
+    """Where csv / jsonl results put their correlations: results.csv.gz -> results.correlations.csv.gz."""
+    suffix = ""
+    if filename.lower().endswith(".gz"):
+        filename, suffix = filename[:-3], filename[-3:]
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}.correlations{ext}{suffix}"
+
+
+def _ci(row, prefix):
+    low, high = row.get(f"{prefix}_ci_low"), row.get(f"{prefix}_ci_high")
+    return "" if low is None or high is None else f" (CI {low} to {high})"
+
+
+def format_correlation_block(row):
+    """One analytics.correlation_report row in the results.txt style."""
+    return (
+        f"Grouping: {row.get('grouping')}\n"
+        f"Group: {row.get('group')}\n"
+        f"Cities: {row.get('n')}\n"
+        f"Pearson r: {row.get('pearson_r')}{_ci(row, 'pearson')}\n"
+        f"Spearman rho: {row.get('spearman_rho')}{_ci(row, 'spearman')}\n"
+        + SEPARATOR
+    )
+
+
+def write_results_stream(rows, filename, fmt=None, compress=None, buffer_chars=BUFFER_CHARS,
+                         correlations=None):
+    """
+    Stream rows into filename and return how many rows were written.
+
+    fmt / compress default from the extension (e.g. "stats.csv.gz").
+    CSV columns are taken from the first row.
+
+    correlations: correlation_report rows, or a function returning them
+    (called once the rows have been written, so a streaming caller can
+    gather its inputs on the way). Text files get them as a closing
+    section, csv / jsonl a correlations_filename() file of the same format.
+    """
+    fmt, compress = infer_format(filename, fmt, compress)
+
+    # the csv module writes its own line endings
+    newline = "" if fmt == "csv" else None
+    if compress == "gzip":
+        out = gzip.open(filename, "wt", encoding="utf-8", newline=newline, compresslevel=6)
+    else:
+        out = open(filename, "w", encoding="utf-8", newline=newline)
+
+    buf = io.StringIO()
+    count = 0
+    csv_writer = None
+
+    def flush():
+        out.write(buf.getvalue())
+        buf.seek(0)
+        buf.truncate()
+
+    with out:
+        if fmt == "text":
+            buf.write("City Statistics Results\n")
+            buf.write(SEPARATOR)
+
+        for row in iter_dict_rows(rows):
+            if fmt == "text":
+                buf.write(format_text_block(row))
+            elif fmt == "csv":
+                if csv_writer is None:
+                    csv_writer = csv.DictWriter(buf, fieldnames=list(row), extrasaction="ignore")
+                    csv_writer.writeheader()
+                csv_writer.writerow(row)
+            else:
+                buf.write(json.dumps(row, ensure_ascii=False))
+                buf.write("\n")
+
+            count += 1
+            if buf.tell() >= buffer_chars:
+                flush()
+
+        if callable(correlations):
+            correlations = correlations()
+        if correlations is not None and fmt == "text":
+            buf.write("\nTemperature vs PM2.5 Correlations\n")
+            buf.write(SEPARATOR)
+            if not correlations:
+                buf.write("Not enough cities with both values for a correlation.\n")
+            for row in correlations:
+                buf.write(format_correlation_block(row))
+
+        flush()
+
+    if correlations is not None and fmt != "text":
+        write_results_stream(correlations, correlations_filename(filename), fmt=fmt,
+                             compress=compress, buffer_chars=buffer_chars)
+    return count
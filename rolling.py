@@ -0,0 +1,161 @@
+# ============================================================
+# rolling.py
+# Rolling-window aggregates (24h mean PM2.5, 7d mean temperature, ...)
+# ============================================================
+#
+# Every stored observation is also added to an hourly bucket in
+# RollingBuckets (city, metric, bucket_start -> n, total, min, max) by the
+# triggers in create_database.create_rolling_buckets, whatever code path
+# inserted it. A rolling window is then the sum of at most
+# window / ROLLING_BUCKET_SECONDS bucket rows (24 for a day, 168 for a week)
+# read through the table's primary key: the cost per city doesn't grow with
+# the amount of history, and nothing is rescanned.
+#
+# Windows end at the city's newest bucket by default (the latest data we
+# have for it) or at an explicit `end` (unix seconds, e.g. time.time()).
+#
+#   rolling_mean(conn, city_id, "pm25", "24h")
+#   rolling_means(conn, "temperature", "7d")      # every city at once
+
+import re
+
+from create_database import ROLLING_BUCKET_SECONDS, fill_rolling_buckets
+
+WINDOW_UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+# a sensible keep_seconds for prune_rolling_buckets: the longest window
+# dashboards ask for plus a day of slack. Pruning is opt-in (`ingest
+# --rolling-retention 8d`); by default every bucket is kept, so windows
+# ending in the past (`end=`) stay complete after a historical backfill
+RETENTION_SECONDS = 8 * 86400
+
+
+def parse_window(window):
+    """'24h' -> 86400, '7d' -> 604800, 3600 / '3600' -> 3600 (seconds)."""
+    if isinstance(window, (int, float)):
+        seconds = int(window)
+    else:
+        match = re.fullmatch(r"\s*(\d+)\s*([mhdw]?)\s*", str(window).lower())
+        if not match:
+            raise ValueError(f"Bad window {window!r} (use e.g. 90m, 24h, 7d)")
+        number, unit = int(match.group(1)), match.group(2)
+        seconds = number * WINDOW_UNITS[unit] if unit else number
+    if seconds < ROLLING_BUCKET_SECONDS or seconds % ROLLING_BUCKET_SECONDS:
+        raise ValueError(f"Window must be a whole number of {ROLLING_BUCKET_SECONDS}s buckets, "
+                         f"got {window!r}")
+    return seconds
+
+
+def _window_row(city_id, metric, window, end, row):
+    n, total, low, high = row
+    if not n:
+        return None
+    return {"city_id": city_id, "metric": metric, "window_start": end - window,
+            "window_end": end, "n": n, "mean": total / n, "min": low, "max": high}
+
+
+def rolling_mean(conn, city_id, metric, window, end=None):
+    """
+    Aggregate of one city's `metric` over the window ending at `end`
+    (default: the city's newest bucket). Returns {"mean", "n", "min", "max",
+    "window_start", "window_end", ...} or None when there's no data.
+
+    An explicit `end` only sees the buckets still stored: if
+    prune_rolling_buckets has run, windows reaching further back than its
+    keep_seconds before the city's newest bucket come back partial (or None).
+    """
+    window = parse_window(window)
+    if end is None:
+        newest = conn.execute(
+            "SELECT MAX(bucket_start) FROM RollingBuckets WHERE city_id = ? AND metric = ?",
+            (city_id, metric),
+        ).fetchone()[0]
+        if newest is None:
+            return None
+        end = newest + ROLLING_BUCKET_SECONDS
+    row = conn.execute(
+        """
+        SELECT SUM(n), SUM(total), MIN(min_value), MAX(max_value)
+        FROM RollingBuckets
+        WHERE city_id = ? AND metric = ? AND bucket_start >= ? AND bucket_start < ?
+        """,
+        (city_id, metric, end - window, end),
+    ).fetchone()
+    return _window_row(city_id, metric, window, end, row)
+
+
+def rolling_means(conn, metric, window, end=None):
+    """
+    rolling_mean for every city with data: {city_id: aggregate dict}.
+    Same caveat for `end` as rolling_mean: pruned buckets are not counted.
+    """
+    window = parse_window(window)
+    # CROSS JOIN pins Cities as the outer loop (SQLite doesn't reorder it),
+    # so each city reads only its window's range of the primary key instead
+    # of the planner scanning every bucket
+    if end is None:
+        # per-city window end: one primary-key look-up per city
+        query = """
+            SELECT b.city_id, SUM(b.n), SUM(b.total), MIN(b.min_value), MAX(b.max_value),
+                   newest.bucket_start + :bucket
+            FROM (
+                SELECT c.id AS city_id,
+                       (SELECT MAX(bucket_start) FROM RollingBuckets
+                        WHERE city_id = c.id AND metric = :metric) AS bucket_start
+                FROM Cities AS c
+            ) AS newest
+            CROSS JOIN RollingBuckets AS b
+                ON b.city_id = newest.city_id
+               AND b.metric = :metric
+               AND b.bucket_start > newest.bucket_start - :window
+               AND b.bucket_start <= newest.bucket_start
+            GROUP BY newest.city_id
+        """
+    else:
+        query = """
+            SELECT b.city_id, SUM(b.n), SUM(b.total), MIN(b.min_value), MAX(b.max_value), :end
+            FROM Cities AS c
+            CROSS JOIN RollingBuckets AS b
+                ON b.city_id = c.id
+               AND b.metric = :metric
+               AND b.bucket_start >= :end - :window
+               AND b.bucket_start < :end
+            GROUP BY c.id
+        """
+    params = {"metric": metric, "window": window, "end": end, "bucket": ROLLING_BUCKET_SECONDS}
+    result = {}
+    for city_id, n, total, low, high, window_end in conn.execute(query, params):
+        row = _window_row(city_id, metric, window, window_end, (n, total, low, high))
+        if row is not None:
+            result[city_id] = row
+    return result
+
+
+def prune_rolling_buckets(conn, keep_seconds=RETENTION_SECONDS):
+    """
+    Drop buckets more than keep_seconds older than their city's newest
+    bucket for the same metric (they can't be in any window that short).
+    Returns the number of buckets removed.
+
+    Not run by default: afterwards rolling_mean / rolling_means with an
+    older `end` (and analytics.window_means) only see what was kept.
+    """
+    with conn:
+        cur = conn.execute(
+            """
+            DELETE FROM RollingBuckets
+            WHERE bucket_start < (
+                SELECT MAX(newest.bucket_start) FROM RollingBuckets AS newest
+                WHERE newest.city_id = RollingBuckets.city_id
+                  AND newest.metric = RollingBuckets.metric
+            ) - ?
+            """,
+            (keep_seconds,),
+        )
+    return cur.rowcount
+
+
+def rebuild_rolling_buckets(conn):
+    """Recompute every bucket from the observation tables (e.g. after a bulk load)."""
+    with conn:
+        fill_rolling_buckets(conn.cursor())
@@ -0,0 +1,162 @@
+# ============================================================
+# running_stats.py
+# Per-city running count / mean / variance / min / max (Welford + Chan)
+# ============================================================
+#
+# CityMetricStats holds, per (city, metric), the running
+#   n, mean, m2 (sum of squared deviations from the mean), min, max
+# of every observation ever stored. The triggers in
+# create_database.create_metric_stats update it inside the same transaction
+# as the insert (store_weather_data, store_air_quality_data, backfills...),
+# one Welford step per value, so reading a city's mean / variance / std /
+# min / max is one primary-key look-up however long its history is.
+#
+# Partial results combine with Chan et al.'s pairwise formulas: workers
+# (threads, processes, blocks of a bulk load) can each summarise their own
+# rows as RunningStats or (n, mean, m2, min, max) partials, and
+# RunningStats.merge / merge_partials add them up in any order.
+#
+#   metric_stats(conn, city_id, "temperature").std()
+#   city_metric_stats(conn, "pm25")          # {city_id: RunningStats}
+
+import math
+import warnings
+
+from create_database import METRIC_STATS_MERGE, fill_metric_stats
+
+
+class RunningStats:
+    """
+    Count, mean, M2, min and max of a stream of numbers.
+
+    add() is Welford's update, merge() Chan's pairwise combination (the
+    same formulas as the SQL in create_database.METRIC_STATS_MERGE), so
+    merging two halves gives the statistics of the whole.
+    """
+
+    __slots__ = ("n", "mean", "m2", "min", "max")
+
+    def __init__(self, n=0, mean=0.0, m2=0.0, min=None, max=None):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+        self.min = min
+        self.max = max
+
+    @classmethod
+    def from_values(cls, values):
+        stats = cls()
+        for value in values:
+            stats.add(value)
+        return stats
+
+    def add(self, value):
+        """Welford's single-value update (None is ignored)."""
+        if value is None:
+            return self
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        return self
+
+    def merge(self, other):
+        """Fold another RunningStats (e.g. a worker's partial) into this one."""
+        if not other.n:
+            return self
+        if not self.n:
+            self.n, self.mean, self.m2 = other.n, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.mean += delta * other.n / n
+        self.n = n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def variance(self, ddof=1):
+        """Sample variance (ddof=1, like statistics.variance); None when undefined."""
+        if self.n - ddof <= 0:
+            return None
+        return self.m2 / (self.n - ddof)
+
+    def std(self, ddof=1):
+        variance = self.variance(ddof)
+        return None if variance is None else math.sqrt(variance)
+
+    def as_dict(self):
+        return {"n": self.n, "mean": self.mean if self.n else None,
+                "variance": self.variance(), "std": self.std(),
+                "min": self.min, "max": self.max}
+
+    def __repr__(self):
+        return (f"RunningStats(n={self.n}, mean={self.mean!r}, m2={self.m2!r}, "
+                f"min={self.min!r}, max={self.max!r})")
+
+
+def array_partials(values):
+    """
+    (n, mean, m2, min, max) arrays of a 2-D numpy array, one partial per
+    row (NaN = missing), e.g. a bulk load's cities x hours block.
+    """
+    import numpy as np
+
+    values = np.asarray(values, dtype=float)
+    n = np.sum(~np.isnan(values), axis=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN rows (n = 0)
+        mean = np.nanmean(values, axis=1)
+        m2 = np.nansum((values - mean[:, None]) ** 2, axis=1)
+        return n, mean, m2, np.nanmin(values, axis=1), np.nanmax(values, axis=1)
+
+
+def merge_partials(conn, rows):
+    """
+    Add (city_id, metric, n, mean, m2, min, max) partials into
+    CityMetricStats (caller commits). Only for values that didn't go
+    through the insert triggers, or they'd be counted twice.
+    """
+    conn.executemany(
+        f"INSERT INTO CityMetricStats VALUES (?, ?, ?, ?, ?, ?, ?) {METRIC_STATS_MERGE}",
+        (row for row in rows if row[2]),
+    )
+
+
+def metric_stats(conn, city_id, metric=None):
+    """
+    One city's RunningStats for metric (None if it has none), or
+    {metric: RunningStats} for all of its metrics when metric is None.
+    """
+    query = "SELECT metric, n, mean, m2, min_value, max_value FROM CityMetricStats WHERE city_id = ?"
+    params = [city_id]
+    if metric is not None:
+        query += " AND metric = ?"
+        params.append(metric)
+    found = {row[0]: RunningStats(*row[1:]) for row in conn.execute(query, params)}
+    return found if metric is None else found.get(metric)
+
+
+def city_metric_stats(conn, metric):
+    """{city_id: RunningStats} of metric for every city that has it."""
+    return {
+        row[0]: RunningStats(*row[1:])
+        for row in conn.execute(
+            """
+            SELECT c.id, s.n, s.mean, s.m2, s.min_value, s.max_value
+            FROM Cities AS c
+            CROSS JOIN CityMetricStats AS s ON s.city_id = c.id AND s.metric = ?
+            """,
+            (metric,),
+        )
+    }
+
+
+def rebuild_metric_stats(conn):
+    """Recompute CityMetricStats from the observation tables (e.g. after a repair)."""
+    with conn:
+        fill_metric_stats(conn.cursor())
@@ -0,0 +1,116 @@
+# ============================================================
+# spatial_index.py
+# Bounding-box / radius look-ups over the R*Tree coordinate indexes
+# ============================================================
+#
+# create_database.create_spatial_index() keeps one R*Tree per table with
+# coordinates (Cities, GeoCities, AirQualityLocations). A radius query
+#   1. turns (lat, lon, radius) into a bounding box (two boxes when it
+#      crosses the 180th meridian),
+#   2. asks the R*Tree for the rows inside the box (logarithmic, instead of
+#      computing a distance for every row), and
+#   3. keeps the candidates whose great-circle distance is within the
+#      radius (the R*Tree stores 32-bit floats and rounds boxes outwards,
+#      so the box step never loses a row).
+#
+#   stations_near_city(conn, city_id, radius_km=25)
+#   nearest(conn, "Cities", lat, lon, max_km=25)
+#
+# Without the R*Tree (SQLite built without it, or a database made before
+# it existed) the same functions use a plain range scan on the table.
+
+import math
+
+from create_database import SPATIAL_TABLES
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE_LAT = math.pi * EARTH_RADIUS_KM / 180.0
+
+DEFAULT_STATION_RADIUS_KM = 25.0
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km between two (lat, lon) points."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_boxes(lat, lon, radius_km):
+    """
+    [(min_lat, max_lat, min_lon, max_lon), ...] covering every point within
+    radius_km of (lat, lon): one box, or two when the circle crosses the
+    180th meridian. Near a pole the box spans every longitude.
+    """
+    d_lat = radius_km / KM_PER_DEGREE_LAT
+    min_lat, max_lat = max(-90.0, lat - d_lat), min(90.0, lat + d_lat)
+
+    cos_lat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+    if max_lat >= 90.0 or min_lat <= -90.0 or cos_lat * 180.0 * KM_PER_DEGREE_LAT <= radius_km:
+        return [(min_lat, max_lat, -180.0, 180.0)]
+
+    d_lon = radius_km / (KM_PER_DEGREE_LAT * cos_lat)
+    min_lon, max_lon = lon - d_lon, lon + d_lon
+    if min_lon < -180.0:
+        return [(min_lat, max_lat, min_lon + 360.0, 180.0), (min_lat, max_lat, -180.0, max_lon)]
+    if max_lon > 180.0:
+        return [(min_lat, max_lat, min_lon, 180.0), (min_lat, max_lat, -180.0, max_lon - 360.0)]
+    return [(min_lat, max_lat, min_lon, max_lon)]
+
+
+def has_rtree(conn, table):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (f"{table}_rtree",)
+    ).fetchone() is not None
+
+
+def _check_table(table):
+    if table not in SPATIAL_TABLES:
+        raise ValueError(f"No spatial index for {table!r}; indexed: {', '.join(SPATIAL_TABLES)}")
+
+
+def within_box(conn, table, min_lat, max_lat, min_lon, max_lon):
+    """[(id, latitude, longitude)] of the table rows inside the box."""
+    _check_table(table)
+    if has_rtree(conn, table):
+        query = f"""
+            SELECT t.id, t.latitude, t.longitude
+            FROM {table}_rtree AS r
+            JOIN {table} AS t ON t.id = r.id
+            WHERE r.max_lat >= ? AND r.min_lat <= ?
+              AND r.max_lon >= ? AND r.min_lon <= ?
+        """
+    else:
+        query = f"""
+            SELECT id, latitude, longitude
+            FROM {table}
+            WHERE latitude BETWEEN ? AND ?
+              AND longitude BETWEEN ? AND ?
+        """
+    return conn.execute(query, (min_lat, max_lat, min_lon, max_lon)).fetchall()
+
+
+def within_radius(conn, table, lat, lon, radius_km):
+    """[(id, distance_km)] of the table rows within radius_km, nearest first."""
+    found = {}
+    for box in bounding_boxes(lat, lon, radius_km):
+        for row_id, row_lat, row_lon in within_box(conn, table, *box):
+            distance = haversine_km(lat, lon, row_lat, row_lon)
+            if distance <= radius_km:
+                found[row_id] = distance
+    return sorted(found.items(), key=lambda item: (item[1], item[0]))
+
+
+def nearest(conn, table, lat, lon, max_km):
+    """(id, distance_km) of the closest row within max_km, or None."""
+    hits = within_radius(conn, table, lat, lon, max_km)
+    return hits[0] if hits else None
+
+
+def stations_near_city(conn, city_id, radius_km=DEFAULT_STATION_RADIUS_KM):
+    """[(location_id, distance_km)] of the AQ stations within radius_km of a city."""
+    row = conn.execute("SELECT latitude, longitude FROM Cities WHERE id = ?", (city_id,)).fetchone()
+    if row is None or row[0] is None or row[1] is None:
+        return []
+    return within_radius(conn, "AirQualityLocations", row[0], row[1], radius_km)
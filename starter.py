@@ -31,14 +31,36 @@ GEODB_BASE_URL = "http://geodb-free-service.wirefreethought.com/v1/geo"
 # IMPORTS
 # ============================================================
 import os
-import requests
+import sys
+import time
+import argparse
 import sqlite3
 import json
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from create_database import create_database
-import matplotlib.pyplot as plt
+from city_crosswalk import update_crosswalk, print_crosswalk_summary
+from spatial_index import nearest, DEFAULT_STATION_RADIUS_KM
+from rolling import parse_window, prune_rolling_buckets
+from metrics import span, timed_request, timed_stream, json_size, database_bytes, file_size
+from raw_archive import (
+    DEFAULT_ARCHIVE_DIR,
+    archive_stream,
+    new_run_id,
+    save_record,
+    save_response,
+    use_archive,
+)
+import metrics
+# NOTE: `requests` and matplotlib are imported lazily (inside the functions
+# that need them) so that e.g. `starter.py stats` never loads either one.
 
 from analysis_visualizations import (
+    PLOT_FUNCTIONS,
     calculate_city_stats,
+    city_stats_cursor,
+    figure_cache_report,
+    render_figures_headless,
     plot_aq_category_overview,
     plot_pm25_ranked_by_city,
     plot_temp_vs_pm25,
@@ -165,6 +187,10 @@ CITY_PAIRS = [
 
 BATCH_SIZE = 25
 PROGRESS_FILE = "progress.json"
+DB_NAME = "final_project.db"
+
+# Data sources the `ingest` stage knows how to fetch + store
+ALL_SOURCES = ("weather", "aq", "geodb")
 
 def build_fallback_city_data(limit=10, min_population=0):
     """
@@ -222,102 +248,370 @@ if not os.path.exists(VIS_OUTPUT_DIR):
 # FETCH FUNCTIONS (to be completed by each team member)
 # ============================================================
 
-def fetch_weather(city_list):
-    """Fetch weather data for a list of cities from OpenWeatherMap."""
-    # TODO: April fills this in
-    results = []
-    for city in city_list:
-        params = {
-            "q": city,
-            "appid": OPENWEATHER_API_KEY,
-            "units": "metric"
-        }
-        response = requests.get(OPENWEATHER_BASE_URL + "weather", params=params)
+def fetch_weather(city_list, max_workers=1):
+    """
+    Fetch weather data for a list of cities from OpenWeatherMap.
+
+    With max_workers > 1 the per-city requests run in a thread pool
+    (results keep the same order as city_list).
+    """
+    if max_workers > 1 and len(city_list) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            fetched = list(pool.map(_fetch_weather_one, city_list))
+    else:
+        fetched = [_fetch_weather_one(city) for city in city_list]
+
+    return [weather_dict for weather_dict in fetched if weather_dict is not None]
+
+
+def _fetch_weather_one(city):
+    """Fetch + parse the current weather for ONE city (None on error)."""
+    import requests
+
+    params = {
+        "q": city,
+        "appid": OPENWEATHER_API_KEY,
+        "units": "metric"
+    }
+    try:
+        response = timed_request("openweather.current", requests.get,
+                                 OPENWEATHER_BASE_URL + "weather", params=params, timeout=10)
+    except requests.RequestException as e:
+        # timeouts / connection errors are already counted by timed_request;
+        # one unreachable city must not abort the whole batch
+        print(f"Error fetching weather data for {city}: {e}")
+        return None
+
+    if response.status_code != 200:
+        print(f"Error fetching weather data for {city}: {response.text}")
+        return None
+
+    save_response("openweather.current", response, {"query": city})
+    return parse_weather_current(response.json())
+
+
+def parse_weather_current(data):
+    """A current-weather response -> the weather dict store_weather_data takes."""
+    weather_dict = {
+        "city_name": data.get("name"),
+        "country": data.get("sys", {}).get("country"),
+        "latitude": data.get("coord", {}).get("lat"),
+        "longitude": data.get("coord", {}).get("lon"),
+    }
+    weather_dict.update(_parse_weather_reading(data))
+    return weather_dict
+
+
+def _parse_weather_reading(item):
+    """
+    The reading fields of ONE OpenWeatherMap observation. The current-weather
+    response and every entry of a history / forecast "list" share this shape.
+    """
+    main_info = item.get("main", {})
+    wind_info = item.get("wind", {})
+
+    weather_list = item.get("weather", [])
+    if len(weather_list) > 0:
+        weather_main = weather_list[0].get("main")
+    else:
+        weather_main = None
+
+    return {
+        "timestamp": item.get("dt"),
+        "temperature": main_info.get("temp"),
+        "feels_like": main_info.get("feels_like"),
+        "humidity": main_info.get("humidity"),
+        "wind_speed": wind_info.get("speed"),
+        "weather_main": weather_main,
+    }
+
+
+# ------------------------------------------------------------
+# Historical weather backfill
+# ------------------------------------------------------------
+# Hourly history (paid OpenWeatherMap plan); at most one week per request
+OPENWEATHER_HISTORY_URL = "https://history.openweathermap.org/data/2.5/history/city"
+HISTORY_CHUNK_HOURS = 168
+# Stay under the account's per-minute quota
+OPENWEATHER_CALLS_PER_MINUTE = 60
+BACKFILL_BATCH_SIZE = 50_000
+
+
+class RateLimiter:
+    """Thread-safe limiter: at most calls_per_minute calls, evenly spaced."""
+
+    def __init__(self, calls_per_minute):
+        import threading
+
+        self.interval = 60.0 / calls_per_minute if calls_per_minute else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
 
-        if response.status_code != 200:
-            print(f"Error fetching weather data for {city}: {response.text}")
+
+def split_time_range(start, end, chunk_seconds):
+    """[(chunk_start, chunk_end), ...] covering [start, end) in unix seconds."""
+    chunks = []
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + chunk_seconds, end)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end
+    return chunks
+
+
+def _fetch_weather_chunk(session, limiter, city_id, lat, lon, start, end, mode):
+    """Rows (tuples for WeatherObservations) for one city + one time chunk."""
+    params = {
+        "lat": lat,
+        "lon": lon,
+        "appid": OPENWEATHER_API_KEY,
+        "units": "metric",
+    }
+    if mode == "history":
+        url = OPENWEATHER_HISTORY_URL
+        params.update({"type": "hour", "start": start, "end": end})
+    else:
+        url = OPENWEATHER_BASE_URL + "forecast"  # 5 days, 3-hour steps
+
+    limiter.wait()
+    response = timed_request(f"openweather.{mode}", session.get, url, params=params, timeout=30)
+    if response.status_code != 200:
+        print(f"Error fetching {mode} weather for city {city_id} "
+              f"({start}-{end}): {response.text}")
+        return []
+
+    save_response(f"openweather.{mode}", response,
+                  {"city_id": city_id, "start": start, "end": end})
+    return parse_weather_chunk(response.json(), city_id, start, end)
+
+
+def parse_weather_chunk(data, city_id, start, end):
+    """A history / forecast response -> WeatherObservations tuples inside [start, end)."""
+    rows = []
+    for item in data.get("list", []):
+        reading = _parse_weather_reading(item)
+        ts = reading["timestamp"]
+        if ts is None or not (start <= ts < end):
             continue
+        rows.append((
+            city_id,
+            ts,
+            reading["temperature"],
+            reading["feels_like"],
+            reading["humidity"],
+            reading["wind_speed"],
+            reading["weather_main"],
+        ))
+    return rows
 
-        data = response.json()
-        
-        city_name = data.get("name")
-        country = data.get("sys", {}).get("country")
 
-        latitude = data.get("coord", {}).get("lat")
-        longitude = data.get("coord", {}).get("lon")
+def fetch_weather_history(cities, start, end, mode="history", max_workers=4,
+                          calls_per_minute=OPENWEATHER_CALLS_PER_MINUTE,
+                          chunk_hours=HISTORY_CHUNK_HOURS):
+    """
+    Stream hourly (history) or 3-hourly (forecast) observations for many
+    cities over [start, end) (unix seconds).
+
+    cities is a list of (city_id, latitude, longitude). The range is split
+    into chunk_hours pieces per city (forecast mode: one request per city),
+    the pieces are fetched concurrently by max_workers threads sharing one
+    session and one RateLimiter, and rows are yielded as chunks complete, so
+    the caller can insert them without holding the whole series in memory.
+    """
+    import requests
+    from concurrent.futures import as_completed
 
-        main_info = data.get("main", {})
-        temperature = main_info.get("temp")
-        feels_like = main_info.get("feels_like")
-        humidity = main_info.get("humidity")
+    if mode == "history":
+        chunks = split_time_range(start, end, chunk_hours * 3600)
+    else:
+        chunks = [(start, end)]
+
+    limiter = RateLimiter(calls_per_minute)
+    session = requests.Session()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(_fetch_weather_chunk, session, limiter, city_id, lat, lon,
+                        chunk_start, chunk_end, mode)
+            for city_id, lat, lon in cities
+            if lat is not None and lon is not None
+            for chunk_start, chunk_end in chunks
+        ]
+        for future in as_completed(futures):
+            try:
+                rows = future.result()
+            except Exception as e:
+                print("Error fetching weather chunk:", e)
+                continue
+            yield from rows
+
+    session.close()
+
+
+# OpenAQ v3 parameter ids for every pollutant we track: name -> (id, unit).
+# Gases use the ppm variants (ids 7-10; 3-6 are the same gases in µg/m³).
+# /latest results carry no unit, so the unit here is the one stored, and
+# aqi.py converts to ppb where the AQI table needs it.
+OPENAQ_PARAMETERS = {
+    "pm25": (2, "µg/m³"),
+    "pm10": (1, "µg/m³"),
+    "o3": (10, "ppm"),
+    "co": (8, "ppm"),
+    "no2": (7, "ppm"),
+    "so2": (9, "ppm"),
+}
+TRACKED_POLLUTANTS = tuple(OPENAQ_PARAMETERS)
+OPENAQ_PAGE_SIZE = 1000
+# the parts of an OpenAQ sensor record that fetch_air_quality uses; pages
+# are parsed as they stream in and everything else is dropped per record
+OPENAQ_FIELDS = ("id", "sensorsId", "locationsId", "location", "value", "unit",
+                 "datetime", "coordinates")
+
+
+def _fetch_openaq_page(session, parameter_id, page, page_size, context=None):
+    """
+    One page of /v3/parameters/{id}/latest (raises on HTTP errors). The raw
+    body is archived (with `context`) as it streams in.
+    """
+    from json_stream import CHUNK_BYTES
 
-        wind_info = data.get("wind", {})
-        wind_speed = wind_info.get("speed")
+    url = OPENAQ_BASE_URL + f"parameters/{parameter_id}/latest"
+    with timed_stream("openaq.latest", session.get, url,
+                      params={"limit": page_size, "page": page}, timeout=15,
+                      stream=True) as (response, count):
+        response.raise_for_status()
+        with archive_stream("openaq.latest", context) as tee:
+            chunks = tee(count(response.iter_content(chunk_size=CHUNK_BYTES)))
+            return parse_openaq_page(chunks)
 
-        weather_list = data.get("weather", [])
-        if len(weather_list) > 0:
-            weather_main = weather_list[0].get("main")
-        else:
-            weather_main = None
-        
-        timestamp = data.get("dt")
 
-        weather_dict = {
-            "city_name": city_name,
-            "country": country,
-            "latitude": latitude,
-            "longitude": longitude,
-            "timestamp": timestamp,
-            "temperature": temperature,
-            "feels_like": feels_like,
-            "humidity": humidity,
-            "wind_speed": wind_speed,
-            "weather_main": weather_main
-        }
-        results.append(weather_dict)
-    return results
+def parse_openaq_page(chunks):
+    """The sensor records (OPENAQ_FIELDS only) of one OpenAQ page body, given as byte chunks."""
+    from json_stream import iter_array_items
 
-    
+    return list(iter_array_items(chunks, "results", OPENAQ_FIELDS))
+
+
+def fetch_openaq_latest(parameters=TRACKED_POLLUTANTS, max_pages=1,
+                        page_size=OPENAQ_PAGE_SIZE, run=None):
+    """
+    Latest OpenAQ readings for several parameters in ONE paginated pass.
+
+    Page N of every parameter is requested at the same time over a shared
+    keep-alive session, and a parameter drops out once it returns a short
+    page. Adding pollutants adds data, not sequential round trips: the wall
+    clock cost is one round trip per page, whatever the number of parameters.
+
+    Returns {parameter: [sensor result dicts]}. Archived pages are tagged
+    with `run` (see raw_archive.py) so a reprocess can put them back together.
+    """
+    import requests
+
+    latest = {p: [] for p in parameters}
+    active = list(parameters)
+
+    session = requests.Session()
+    session.headers["X-API-Key"] = OPENAQ_API_KEY
+
+    with ThreadPoolExecutor(max_workers=max(len(parameters), 1)) as pool:
+        for page in range(1, max_pages + 1):
+            if not active:
+                break
+
+            futures = {
+                p: pool.submit(_fetch_openaq_page, session, OPENAQ_PARAMETERS[p][0],
+                               page, page_size,
+                               {"run": run, "parameter": p, "page": page})
+                for p in active
+            }
+
+            still_active = []
+            for p, future in futures.items():
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    print(f"Error fetching OpenAQ {p} data (page {page}):", e)
+                    continue
+                latest[p].extend(rows)
+                if len(rows) >= page_size:
+                    still_active.append(p)
+            active = still_active
+
+    session.close()
+    return latest
+
+
+def _openaq_measurement(sensor, parameter):
+    return {
+        "value": sensor.get("value"),
+        "unit": sensor.get("unit") or OPENAQ_PARAMETERS[parameter][1],
+        "timestamp": (sensor.get("datetime") or {}).get("utc"),
+    }
 
 
-def fetch_air_quality(city_list):
+def fetch_air_quality(city_list, parameters=TRACKED_POLLUTANTS, max_pages=1):
     """
-    Fetch real PM2.5 data from OpenAQ v3 and map it onto our list of cities.
+    Fetch real air-quality data from OpenAQ v3 and map it onto our list of cities.
 
     Implementation:
-      - Call /v3/parameters/2/latest once (parameter 2 = PM2.5).
-      - For each city in city_list, assign a real sensor's PM2.5 value.
-        (We just cycle through the sensor list if there are more cities
-         than sensors.)
+      - Fetch the latest readings of every tracked parameter (PM2.5, PM10,
+        O3, CO, NO2, SO2) in one bulk pass (see fetch_openaq_latest).
+      - For each city in city_list, assign a real PM2.5 sensor's location
+        (we just cycle through the sensor list if there are more cities
+        than sensors) and attach every other pollutant measured at that
+        same location.
+
+    Each result keeps the old "pm25" / "unit" keys and adds
+    "measurements": {parameter: {"value", "unit", "timestamp"}}.
 
     This uses only REAL OpenAQ data (no synthetic values here).
     """
     results = []
 
+    if not city_list:
+        return results
+
     if not OPENAQ_API_KEY:
         print("No OpenAQ API key set. Set OPENAQ_API_KEY at the top of the file.")
         return results
 
-    headers = {
-        "X-API-Key": OPENAQ_API_KEY
-    }
+    parameters = tuple(parameters)
+    run = new_run_id()
+    latest = fetch_openaq_latest(parameters, max_pages=max_pages, run=run)
+    # the pages are archived; this records how they were mapped onto cities
+    save_record("openaq.run", {"run": run, "cities": list(city_list),
+                               "parameters": list(parameters)})
+    return assign_air_quality(city_list, latest, parameters)
 
-    try:
-        # Get latest PM2.5 data for all sensors (real data)
-        url = OPENAQ_BASE_URL + "parameters/2/latest"
-        params = {"limit": 1000}
-        response = requests.get(url, headers=headers, params=params, timeout=15)
-        response.raise_for_status()
-        data = response.json()
-    except Exception as e:
-        print("Error fetching OpenAQ PM2.5 data:", e)
-        return results
 
-    sensors = data.get("results", [])
+def assign_air_quality(city_list, latest, parameters=TRACKED_POLLUTANTS):
+    """
+    Map the {parameter: [sensor records]} of fetch_openaq_latest onto
+    city_list (see fetch_air_quality); also used to reprocess archived pages.
+    """
+    results = []
+    parameters = tuple(parameters)
+    primary = "pm25" if "pm25" in parameters else parameters[0]
+    sensors = latest.get(primary, [])
     if not sensors:
-        print("OpenAQ returned no PM2.5 results.")
+        print(f"OpenAQ returned no {primary} results.")
         return results
 
+    # other pollutants, indexed by the OpenAQ location they were measured at
+    by_location = {
+        p: {s.get("locationsId"): s for s in latest.get(p, [])
+            if s.get("locationsId") is not None}
+        for p in parameters if p != primary
+    }
+
     # Assign real sensor values to each city
     sensor_index = 0
     num_sensors = len(sensors)
@@ -328,25 +622,39 @@ def fetch_air_quality(city_list):
 
         value = sensor.get("value")
         coords = sensor.get("coordinates") or {}
-        unit = sensor.get("unit") or "µg/m³"
-        location_name = sensor.get("location") or f"OpenAQ sensor {sensor.get('id', '')}"
+        sensor_id = sensor.get("id", sensor.get("sensorsId", ""))
+        location_name = sensor.get("location") or f"OpenAQ sensor {sensor_id}"
 
         if value is None:
             # skip cities that would get a non-numeric value
             continue
 
+        measurements = {primary: _openaq_measurement(sensor, primary)}
+        location_id = sensor.get("locationsId")
+        for p, sensors_here in by_location.items():
+            other = sensors_here.get(location_id)
+            if other is not None and other.get("value") is not None:
+                measurements[p] = _openaq_measurement(other, p)
+
+        pm25 = measurements.get("pm25", {})
         results.append({
             "city": city,
             "location": location_name,
             "latitude": coords.get("latitude"),
             "longitude": coords.get("longitude"),
-            "pm25": value,
-            "unit": unit,
+            "pm25": pm25.get("value"),
+            "unit": pm25.get("unit") or "µg/m³",
+            "timestamp": measurements[primary]["timestamp"],
+            "measurements": measurements,
         })
 
     return results
 
 
+GEODB_FIELDS = ("id", "city", "name", "country", "countryCode", "region", "population",
+                "latitude", "longitude")
+
+
 def fetch_city_data(limit=10, min_population=50000):
     """
     Fetch city metadata (name, country, population, coordinates)
@@ -355,6 +663,8 @@ def fetch_city_data(limit=10, min_population=50000):
     If the API is unavailable (403, etc.), fall back to locally generated
     metadata based on CITY_PAIRS so that our joins and visualizations still work.
     """
+    import requests
+
     url = f"{GEODB_BASE_URL}/cities"
     params = {
         "limit": limit,
@@ -364,18 +674,30 @@ def fetch_city_data(limit=10, min_population=50000):
         "hateoasMode": "off",       # simpler JSON
     }
 
+    from json_stream import CHUNK_BYTES
+
+    context = {"limit": limit, "min_population": min_population}
     try:
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
+        with timed_stream("geodb.cities", requests.get, url, params=params, timeout=10,
+                          stream=True) as (response, count):
+            response.raise_for_status()
+            # records are parsed (and the raw body archived) as the body
+            # streams in, so a body cut short or malformed also falls back
+            with archive_stream("geodb.cities", context) as tee:
+                chunks = tee(count(response.iter_content(chunk_size=CHUNK_BYTES)))
+                return parse_geodb_cities(chunks)
     except Exception as e:
         print("Error fetching GeoDB Cities data:", e)
         print("Using local fallback city metadata instead.")
         return build_fallback_city_data(limit=limit, min_population=min_population)
 
-    data = response.json()
+
+def parse_geodb_cities(chunks):
+    """The city dicts store_city_data takes, from a GeoDB /cities body given as byte chunks."""
+    from json_stream import iter_array_items
 
     cities = []
-    for item in data.get("data", []):
+    for item in iter_array_items(chunks, "data", GEODB_FIELDS):
         city_name = item.get("city") or item.get("name")
 
         cities.append({
@@ -394,7 +716,11 @@ def fetch_city_data(limit=10, min_population=50000):
 # ============================================================
 
 def store_weather_data(conn, weather_data):
-    """Insert weather data into Cities + WeatherObservations tables."""
+    """
+    Insert weather data into Cities + WeatherObservations tables.
+    (Triggers add every observation to CityMetricStats / RollingBuckets
+    in the same transaction.)
+    """
     # TODO: April fills this in
     cur = conn.cursor()
 
@@ -404,11 +730,14 @@ def store_weather_data(conn, weather_data):
         latitude = item.get("latitude")
         longitude = item.get("longitude")
 
+        # Cities has no unique key (INSERT OR IGNORE never ignored anything),
+        # so only add the city when it isn't there yet
         cur.execute("""
-            INSERT OR IGNORE INTO Cities (city_name, country, latitude, longitude)
-            VALUES (?, ?, ?, ?)
-        """, (city, country, latitude, longitude))
-        
+            INSERT INTO Cities (city_name, country, latitude, longitude)
+            SELECT ?, ?, ?, ?
+            WHERE NOT EXISTS (SELECT 1 FROM Cities WHERE city_name = ? AND country = ?)
+        """, (city, country, latitude, longitude, city, country))
+
         cur.execute("""
             SELECT id FROM Cities WHERE city_name = ? AND country = ?
         """, (city, country))
@@ -436,13 +765,78 @@ def store_weather_data(conn, weather_data):
 
     conn.commit()
 
+def store_weather_series(conn, rows, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Stream (city_id, timestamp, temperature, feels_like, humidity,
+    wind_speed, weather_main) tuples into WeatherObservations.
+
+    Rows are inserted with executemany in transactions of batch_size rows,
+    and an observation that already exists for the same (city_id, timestamp)
+    is skipped (looked up through idx_weather_city_time), so re-running a
+    backfill over the same range adds nothing.
+    `rows` can be any iterator (e.g. fetch_weather_history), it is never
+    materialised. Returns the number of rows actually inserted.
+    """
+    insert_sql = """
+        INSERT INTO WeatherObservations
+            (city_id, timestamp, temperature, feels_like, humidity, wind_speed, weather_main)
+        SELECT ?, ?, ?, ?, ?, ?, ?
+        WHERE NOT EXISTS (
+            SELECT 1 FROM WeatherObservations WHERE city_id = ? AND timestamp = ?
+        )
+    """
+    rows = iter(rows)
+    inserted = 0
+    cur = conn.cursor()
+
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        # (city, time) order keeps the index inserts local in the B-tree
+        batch.sort(key=lambda row: (row[0], str(row[1])))
+        with conn:  # one transaction per batch
+            cur.executemany(insert_sql, (row + (row[0], row[1]) for row in batch))
+        # rowcount, not conn.total_changes: that also counts the rows the
+        # RollingBuckets triggers write
+        inserted += cur.rowcount
+
+    return inserted
+
+
+def backfill_weather(conn, start, end, mode="history", max_workers=4,
+                     calls_per_minute=OPENWEATHER_CALLS_PER_MINUTE):
+    """Backfill weather for every city already in the Cities table."""
+    cities = conn.execute(
+        "SELECT id, latitude, longitude FROM Cities "
+        "WHERE latitude IS NOT NULL AND longitude IS NOT NULL"
+    ).fetchall()
+    if not cities:
+        print("No cities with coordinates yet. Run `ingest` first.")
+        return 0
+
+    print(f"Backfilling {mode} weather for {len(cities)} cities...")
+    rows = fetch_weather_history(cities, start, end, mode=mode, max_workers=max_workers,
+                                 calls_per_minute=calls_per_minute)
+    inserted = store_weather_series(conn, rows)
+    print(f"Backfill done: {inserted} new weather observations.")
+    return inserted
+
+
 def store_air_quality_data(conn, aq_data):
     """
     Store Air Quality data in:
       - AirQualityLocations (linked to existing Cities rows)
-      - AirQualityMeasurements
+      - AirQualityMeasurements (long format: one row per parameter)
+
+    Items from fetch_air_quality carry a "measurements" dict with every
+    pollutant; older items with only "pm25" / "unit" still work.
 
-    We do *not* create new Cities rows here.
+    A station is linked to a city by exact name, then by its coordinates
+    (nearest Cities row within DEFAULT_STATION_RADIUS_KM), then by a fuzzy
+    name match. We do *not* create new Cities rows here.
+    Per-city running statistics (CityMetricStats) are updated by triggers
+    in the same transaction.
     """
     cur = conn.cursor()
 
@@ -451,10 +845,19 @@ def store_air_quality_data(conn, aq_data):
         location = item.get("location")
         lat = item.get("latitude")
         lon = item.get("longitude")
-        pm25 = item.get("pm25")
         unit = item.get("unit") or "µg/m³"
 
-        if city_name is None or pm25 is None:
+        measurements = item.get("measurements") or {
+            "pm25": {"value": item.get("pm25"), "unit": unit,
+                     "timestamp": item.get("timestamp")},
+        }
+        rows = [
+            (param, m.get("timestamp"), m.get("value"), m.get("unit") or unit)
+            for param, m in measurements.items()
+            if m.get("value") is not None
+        ]
+
+        if city_name is None or not rows:
             continue
 
         # 1) Try exact match
@@ -464,7 +867,14 @@ def store_air_quality_data(conn, aq_data):
         )
         row = cur.fetchone()
 
-        # 2) If that fails, try fuzzy match
+        # 2) If that fails, the nearest city to the station (R*Tree look-up)
+        if row is None and lat is not None and lon is not None:
+            near = nearest(conn, "Cities", lat, lon, DEFAULT_STATION_RADIUS_KM)
+            if near is not None:
+                row = cur.execute("SELECT id, city_name FROM Cities WHERE id = ?",
+                                  (near[0],)).fetchone()
+
+        # 3) If that fails too, try fuzzy match
         if row is None:
             cur.execute(
                 """
@@ -494,13 +904,13 @@ def store_air_quality_data(conn, aq_data):
         )
         location_id = cur.lastrowid
 
-        # Insert into AirQualityMeasurements as pm25
-        cur.execute(
+        # One AirQualityMeasurements row per pollutant
+        cur.executemany(
             """
             INSERT INTO AirQualityMeasurements (location_id, timestamp, parameter, value, unit)
             VALUES (?, ?, ?, ?, ?)
             """,
-            (location_id, None, "pm25", pm25, unit)
+            [(location_id, ts, param, value, u) for param, ts, value, u in rows]
         )
 
     conn.commit()
@@ -541,37 +951,80 @@ def store_city_data(conn, city_data):
     conn.commit()
 
 # debug
+def _utc_text(unix_seconds):
+    if unix_seconds is None:
+        return None
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(unix_seconds))
+
+
 def debug_city_join_status(conn):
     """
-    Print, for each city, how many rows it has in:
-      - WeatherObservations
-      - AirQualityLocations
-      - AirQualityMeasurements (pm25)
+    Print (and return) a per-city health report:
+      - WeatherObservations rows + the newest observation
+      - AirQualityLocations rows
+      - AirQualityMeasurements (pm25) rows + the newest measurement
+
+    Each table is counted on its own (GROUP BY city_id over the
+    city_id / location_id indexes) and the per-city counts are joined to
+    Cities afterwards. Joining the raw tables first and undoing the row
+    explosion with COUNT(DISTINCT) cost weather_rows * measurements per
+    city; this is linear in the table sizes, so it can run on every
+    pipeline run.
     """
-    cur = conn.cursor()
-
     query = """
         SELECT
+            c.id,
             c.city_name,
-            COUNT(DISTINCT w.id)   AS weather_rows,
-            COUNT(DISTINCT aql.id) AS aq_locations,
-            COUNT(DISTINCT aqm.id) AS aq_measurements
+            COALESCE(w.n, 0)   AS weather_rows,
+            w.last             AS weather_last,
+            COALESCE(l.n, 0)   AS aq_locations,
+            COALESCE(m.n, 0)   AS aq_measurements,
+            m.last             AS aq_last
         FROM Cities AS c
-        LEFT JOIN WeatherObservations AS w
-            ON w.city_id = c.id
-        LEFT JOIN AirQualityLocations AS aql
-            ON aql.city_id = c.id
-        LEFT JOIN AirQualityMeasurements AS aqm
-            ON aqm.location_id = aql.id
-           AND aqm.parameter = 'pm25'
-        GROUP BY c.city_name
-        ORDER BY c.city_name;
+        LEFT JOIN (
+            SELECT city_id, COUNT(*) AS n, MAX(CAST(timestamp AS INTEGER)) AS last
+            FROM WeatherObservations
+            GROUP BY city_id
+        ) AS w ON w.city_id = c.id
+        LEFT JOIN (
+            SELECT city_id, COUNT(*) AS n
+            FROM AirQualityLocations
+            GROUP BY city_id
+        ) AS l ON l.city_id = c.id
+        LEFT JOIN (
+            SELECT loc.city_id, COUNT(*) AS n, MAX(meas.timestamp) AS last
+            FROM AirQualityLocations AS loc
+            JOIN AirQualityMeasurements AS meas
+                ON meas.location_id = loc.id
+               AND meas.parameter = 'pm25'
+            GROUP BY loc.city_id
+        ) AS m ON m.city_id = c.id
+        ORDER BY c.city_name, c.id;
     """
-
-    print("\n=== DEBUG: per-city join status ===")
-    for row in cur.execute(query):
-        print(row)
-    print("=== END join status ===\n")
+    columns = ["city_id", "city", "weather_rows", "weather_last",
+               "aq_locations", "aq_measurements", "aq_last"]
+    report = []
+    for row in conn.execute(query):
+        entry = dict(zip(columns, row))
+        entry["weather_last"] = _utc_text(entry["weather_last"])
+        report.append(entry)
+
+    print("\n=== DEBUG: per-city health ===")
+    print(f"{'city':<28}{'weather':>9}  {'last weather':<22}{'AQ locs':>8}"
+          f"{'pm25':>8}  last pm25")
+    for entry in report:
+        print(f"{str(entry['city'])[:27]:<28}{entry['weather_rows']:>9}  "
+              f"{entry['weather_last'] or '-':<22}{entry['aq_locations']:>8}"
+              f"{entry['aq_measurements']:>8}  {entry['aq_last'] or '-'}")
+
+    no_weather = sum(1 for e in report if not e["weather_rows"])
+    no_pm25 = sum(1 for e in report if not e["aq_measurements"])
+    weather_last = max((e["weather_last"] for e in report if e["weather_last"]), default=None)
+    aq_last = max((e["aq_last"] for e in report if e["aq_last"]), default=None)
+    print(f"{len(report)} cities: {no_weather} without weather, {no_pm25} without pm25. "
+          f"Newest weather: {weather_last or '-'}, newest pm25: {aq_last or '-'}")
+    print("=== END health ===\n")
+    return report
 # ============================================================
 # MAIN FUNCTION
 # ============================================================
@@ -599,124 +1052,942 @@ def run_tests():
     # Combined test
     test_calculate_city_stats()
 
+    # Performance / scaling helpers
+    test_group_by_codes()
+    test_aqi()
+    test_store_multi_pollutant_data()
+    test_store_weather_series()
+    test_write_results_stream()
+    test_query_service()
+    test_city_stats_memo()
+    test_benchmark_suite()
+    test_synthetic_data()
+    test_pipeline_metrics()
+    test_api_latency_metrics()
+    test_query_plans()
+    test_city_health_report()
+    test_city_crosswalk()
+    test_spatial_index()
+    test_rolling_windows()
+    test_correlation_analytics()
+    test_running_stats()
+    test_json_stream()
+    test_figure_cache()
+    test_raw_archive()
+    test_cli_legacy_db()
+
+
+def load_progress(progress_file=PROGRESS_FILE):
+    """Return the next CITY_PAIRS index to process (0 if no/corrupt file)."""
+    if not os.path.exists(progress_file):
+        return 0
+    try:
+        with open(progress_file, "r") as f:
+            return json.load(f).get("next_start", 0)
+    except Exception:
+        return 0  # if file is corrupted, just start at 0
+
 
-def run_pipeline():
+def save_progress(next_start, progress_file=PROGRESS_FILE):
+    with open(progress_file, "w") as f:
+        json.dump({"next_start": next_start}, f)
+
+
+def ingest_batch(conn, batch_size=BATCH_SIZE, sources=ALL_SOURCES, concurrency=1,
+                 rolling_retention=None):
+    """
+    Ingest stage:
+    - fetch + store weather / air quality for ONE batch of <= batch_size
+      CITY_PAIRS (only for the sources asked for)
+    - fetch + store GeoDB city metadata (if "geodb" is in sources)
+
+    Progress through CITY_PAIRS is tracked in PROGRESS_FILE so repeated runs
+    don't duplicate the same city rows.
+
+    With rolling_retention (seconds) RollingBuckets older than that before
+    each city's newest bucket are pruned afterwards; None keeps them all.
+    """
+    batch_sources = [src for src in ("weather", "aq") if src in sources]
+
+    if batch_sources:
+        start_index = load_progress()
+        batch = CITY_PAIRS[start_index : start_index + batch_size]
+
+        if not batch:
+            print("All city pairs have already been processed. Nothing new to fetch.")
+        else:
+            print(f"\nProcessing batch starting at index {start_index} "
+                  f"({len(batch)} cities, max {batch_size})...")
+
+            # Split pairs into separate lists for the two APIs
+            weather_cities = [w for (w, aq) in batch]
+            aq_cities = [aq for (w, aq) in batch]
+
+            # --- Weather (OpenWeather) ---
+            if "weather" in batch_sources:
+                with span("ingest.fetch_weather") as s:
+                    weather_data = fetch_weather(weather_cities, max_workers=concurrency)
+                    s.rows, s.bytes = len(weather_data), json_size(weather_data)
+                _timed_store("ingest.store_weather", store_weather_data, conn, weather_data)
+
+            # --- Air Quality (OpenAQ) ---
+            if "aq" in batch_sources:
+                with span("ingest.fetch_air_quality") as s:
+                    aq_data = fetch_air_quality(aq_cities)
+                    s.rows, s.bytes = len(aq_data), json_size(aq_data)
+                _timed_store("ingest.store_air_quality", store_air_quality_data, conn, aq_data)
+
+            new_start = start_index + len(batch)
+            save_progress(new_start)
+            print(f"Batch done. Next start index will be {new_start}.")
+
+    # GeoDB city metadata
+    # (This may fail with 403; that's okay, we log it.)
+    if "geodb" in sources:
+        with span("ingest.fetch_city_data") as s:
+            city_data = fetch_city_data(limit=batch_size, min_population=50000)
+            s.rows, s.bytes = len(city_data), json_size(city_data)
+        _timed_store("ingest.store_city_data", store_city_data, conn, city_data)
+
+    # map new Cities rows to GeoDB rows (populations for the stats)
+    with span("ingest.crosswalk") as s:
+        summary = update_crosswalk(conn)
+        s.rows = summary["matched"]
+    print_crosswalk_summary(summary)
+
+    # RollingBuckets are filled by triggers as rows are stored; drop the
+    # buckets that have aged out of every rolling window, if asked to
+    if rolling_retention is not None:
+        prune_rolling_buckets(conn, keep_seconds=rolling_retention)
+
+
+def _timed_store(name, store, conn, data):
+    """Run store(conn, data) as a span; bytes = how much the database grew."""
+    with span(name, rows=len(data)) as s:
+        before = database_bytes(conn)
+        store(conn, data)
+        s.bytes = database_bytes(conn) - before
+
+
+# ------------------------------------------------------------
+# Reprocess: rebuild the tables from the raw-response archive
+# ------------------------------------------------------------
+# archive source -> the ALL_SOURCES entry whose tables it rebuilds
+ARCHIVE_SOURCES = {
+    "openweather.current": "weather",
+    "openweather.history": "weather",
+    "openweather.forecast": "weather",
+    "openaq.latest": "aq",
+    "openaq.run": "aq",
+    "geodb.cities": "geodb",
+}
+REPROCESS_BATCH_SIZE = 500
+
+
+def _parse_archived(archive, entry):
+    """
+    (parsed, error) for one index entry, parsed by the same functions as
+    the live fetch. Runs in reprocess worker processes.
+    """
+    source, sha = entry.get("source"), entry.get("sha256")
+    context = entry.get("context") or {}
+    if sha is None:
+        return None, None
+    try:
+        if source == "openweather.current":
+            return parse_weather_current(archive.load(sha)), None
+        if source in ("openweather.history", "openweather.forecast"):
+            return parse_weather_chunk(archive.load(sha), context.get("city_id"),
+                                       context.get("start"), context.get("end")), None
+        if source == "openaq.latest":
+            return parse_openaq_page(archive.chunks(sha)), None
+        if source == "geodb.cities":
+            return parse_geodb_cities(archive.chunks(sha)), None
+    except (OSError, EOFError, ValueError) as e:  # missing / truncated / bad object
+        return None, f"{source} {sha[:12]}: {e}"
+    return None, None
+
+
+class _ArchivedRowCleaner:
+    """
+    Deletes the rows stored earlier for the same observations as a batch of
+    re-parsed archive records, just before the batch is stored again:
+
+      weather  same city (name + country) and timestamp
+      aq       same station (name + coordinates), parameter and timestamp;
+               stations left without measurements go too
+      geodb    same geodb_id
+
+    Each observation is cleared once per reprocess, so every archived copy
+    of it is stored again; rows the archive has nothing for (fallback
+    data, hand-loaded rows, responses fetched with --no-archive) are kept.
+    Cities is never touched, so city ids stay the same.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.cleared = set()
+        self.city_keys = {}  # city_id -> (city_name, country)
+
+    def _first_time(self, key):
+        if key in self.cleared:
+            return False
+        self.cleared.add(key)
+        return True
+
+    def _clear_weather(self, keys):
+        keys = [key for key in keys if self._first_time(("weather",) + key)]
+        with self.conn:
+            self.cur.executemany("""
+                DELETE FROM WeatherObservations
+                WHERE city_id IN (SELECT id FROM Cities WHERE city_name = ? AND country = ?)
+                  AND timestamp = ?
+            """, keys)
+
+    def weather(self, items):
+        """store_weather_data items (one current observation per city)."""
+        self._clear_weather([(item.get("city_name"), item.get("country"),
+                              str(item.get("timestamp"))) for item in items])
+
+    def series(self, rows):
+        """store_weather_series rows: (city_id, timestamp, ...)."""
+        keys = []
+        for row in rows:
+            city_id = row[0]
+            if city_id not in self.city_keys:
+                self.city_keys[city_id] = self.cur.execute(
+                    "SELECT city_name, country FROM Cities WHERE id = ?", (city_id,)
+                ).fetchone()
+            if self.city_keys[city_id] is not None:
+                keys.append(self.city_keys[city_id] + (str(row[1]),))
+        self._clear_weather(keys)
+
+    def air_quality(self, items):
+        """store_air_quality_data items (from assign_air_quality)."""
+        stations = set()
+        with self.conn:
+            for item in items:
+                station = (item.get("location"), item.get("latitude"), item.get("longitude"))
+                for parameter, m in (item.get("measurements") or {}).items():
+                    if m.get("value") is None or not self._first_time(
+                            ("aq",) + station + (parameter, m.get("timestamp"))):
+                        continue
+                    self.cur.execute("""
+                        DELETE FROM AirQualityMeasurements
+                        WHERE parameter = ? AND timestamp IS ? AND location_id IN (
+                            SELECT id FROM AirQualityLocations
+                            WHERE location_name IS ? AND latitude IS ? AND longitude IS ?
+                        )
+                    """, (parameter, m.get("timestamp")) + station)
+                    stations.add(station)
+            self.cur.executemany("""
+                DELETE FROM AirQualityLocations
+                WHERE location_name IS ? AND latitude IS ? AND longitude IS ?
+                  AND NOT EXISTS (SELECT 1 FROM AirQualityMeasurements AS m
+                                  WHERE m.location_id = AirQualityLocations.id)
+            """, stations)
+
+    def cities(self, city_data):
+        """store_city_data items."""
+        geodb_ids = [
+            (city.get("geodb_id") or f"{city.get('name')}-{city.get('country')}",)
+            for city in city_data
+        ]
+        geodb_ids = [key for key in geodb_ids if self._first_time(("geodb",) + key)]
+        with self.conn:
+            self.cur.executemany("DELETE FROM CityDetails WHERE geodb_id = ?", geodb_ids)
+            self.cur.executemany("DELETE FROM GeoCities WHERE geodb_id = ?", geodb_ids)
+
+
+def reprocess_archive(conn, archive, sources=ALL_SOURCES, workers=None):
+    """
+    Rebuild the rows of `sources` (weather: WeatherObservations; aq:
+    AirQualityLocations + AirQualityMeasurements; geodb: GeoCities +
+    CityDetails) from the raw archive alone, without any network access.
+    Rows the archive holds a response for are replaced (see
+    _ArchivedRowCleaner); every other row is left as it is.
+
+    Archived bodies are parsed in parallel worker processes (one per core
+    by default, see raw_archive.map_entries); this process stores the
+    results in archive order through the usual store_* functions. Repeated
+    current-weather bodies (same sha256 = same observation) are stored
+    once. The RollingBuckets / CityMetricStats triggers are switched off
+    meanwhile and both tables are recomputed in one pass at the end.
+
+    Returns {"entries", "errors", "unused_pages"} counts.
+    """
+    from raw_archive import map_entries
+    from create_database import fill_metric_stats, fill_rolling_buckets
+
+    entries = []
+    seen_weather = set()
+    for entry in archive.entries():
+        if ARCHIVE_SOURCES.get(entry.get("source")) not in sources:
+            continue
+        if entry["source"] == "openweather.current":
+            if entry.get("sha256") in seen_weather:
+                continue
+            seen_weather.add(entry.get("sha256"))
+        entries.append(entry)
+
+    cur = conn.cursor()
+    derived_triggers = cur.execute("""
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'trigger' AND (name LIKE 'rolling_%' OR name LIKE 'metric_stats_%')
+    """).fetchall()
+    with conn:
+        for name, _ in derived_triggers:
+            cur.execute(f"DROP TRIGGER {name}")
+
+    cleaner = _ArchivedRowCleaner(conn)
+
+    summary = {"entries": len(entries), "errors": 0, "unused_pages": 0}
+    weather, series, city_data = [], [], []
+    runs = {}  # OpenAQ run id -> {parameter: [(page, sensors)]}
+
+    def flush():
+        if weather:
+            cleaner.weather(weather)
+            store_weather_data(conn, weather)
+            weather.clear()
+        if series:
+            cleaner.series(series)
+            store_weather_series(conn, series)
+            series.clear()
+        if city_data:
+            cleaner.cities(city_data)
+            store_city_data(conn, city_data)
+            city_data.clear()
+
+    try:
+        parsed_entries = map_entries(archive, entries, _parse_archived, workers=workers)
+        for entry, (parsed, error) in zip(entries, parsed_entries):
+            source, context = entry["source"], entry.get("context") or {}
+            if error:
+                print(f"[WARN] Skipping archived response {error}")
+                summary["errors"] += 1
+            elif source == "openweather.current":
+                weather.append(parsed)
+            elif source in ("openweather.history", "openweather.forecast"):
+                series.extend(parsed)
+            elif source == "geodb.cities":
+                city_data.extend(parsed)
+            elif source == "openaq.latest" and context.get("run"):
+                pages = runs.setdefault(context["run"], {})
+                pages.setdefault(context.get("parameter"), []).append(
+                    (context.get("page") or 0, parsed))
+            elif source == "openaq.run":
+                pages = runs.pop(context.get("run"), {})
+                latest = {p: [sensor for _, rows in sorted(pages.get(p, []), key=lambda pr: pr[0])
+                              for sensor in rows]
+                          for p in context.get("parameters", [])}
+                flush()  # the cities the stations link to come from the weather rows
+                aq_data = assign_air_quality(context.get("cities", []), latest,
+                                             context.get("parameters") or TRACKED_POLLUTANTS)
+                cleaner.air_quality(aq_data)
+                store_air_quality_data(conn, aq_data)
+            if len(weather) + len(city_data) >= REPROCESS_BATCH_SIZE \
+                    or len(series) >= BACKFILL_BATCH_SIZE:
+                flush()
+        flush()
+    finally:
+        with conn:
+            for _, sql in derived_triggers:
+                cur.execute(sql)
+            fill_rolling_buckets(cur)
+            fill_metric_stats(cur)
+
+    # pages of runs that never got as far as mapping onto cities
+    summary["unused_pages"] = sum(len(pages) for run in runs.values() for pages in run.values())
+    if "geodb" in sources:
+        update_crosswalk(conn, rebuild=True)  # GeoCities rows were replaced
+    return summary
+
+
+# file name for each figure written by render_visualizations()
+# (keys match analysis_visualizations.PLOT_FUNCTIONS)
+VIS_FILES = {
+    "temp_vs_pm25": "temp_vs_pm25.png",
+    "population_vs_pm25": "population_vs_pm25.png",
+    "city_characteristics": "city_pop_with_aq_categories.png",
+    "pm25_ranked_by_city": "pm25_ranked_by_city.png",
+    "aq_category_overview": "aq_overview.png",
+}
+
+
+def render_visualizations(city_stats, output_dir=VIS_OUTPUT_DIR, headless=False,
+                          max_workers=None, use_cache=True):
+    """
+    Plot stage: draw every figure and save it into output_dir.
+
+    headless=True renders all figures in parallel worker processes with a
+    non-interactive backend (nothing is shown, nothing blocks). In both
+    modes, figures whose data hasn't changed are copied from the figure
+    cache instead (and not shown again), so a run with nothing new does no
+    matplotlib work. use_cache=False draws every figure (benchmarks).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    save_paths = {
+        name: os.path.join(output_dir, filename)
+        for name, filename in VIS_FILES.items()
+    }
+
+    if headless:
+        render_figures_headless(city_stats, save_paths, max_workers=max_workers,
+                                use_cache=use_cache)
+        figure_cache_report(reset=True)
+        return
+
+    for name, path in save_paths.items():
+        plot = PLOT_FUNCTIONS[name]
+        if not use_cache:
+            plot.__wrapped__(city_stats, save_path=path)
+        elif not plot.cache_lookup(city_stats, path):
+            plot(city_stats, save_path=path)
+    if use_cache:
+        figure_cache_report(reset=True)
+
+
+def print_city_stats_summary(city_stats, limit=15, total=None):
+    print("\n=== DEBUG: city_stats summary ===")
+    print("Number of cities in city_stats:", len(city_stats) if total is None else total)
+    for c in city_stats[:limit]:
+        print(c)
+    print("=== END DEBUG ===\n")
+
+
+def run_pipeline(db_name=DB_NAME, batch_size=BATCH_SIZE, sources=ALL_SOURCES,
+                 concurrency=1, output_dir=VIS_OUTPUT_DIR, results_file="results.txt",
+                 headless=False, results_format=None, metrics_dir=None,
+                 archive_dir=DEFAULT_ARCHIVE_DIR, rolling_retention=None):
     """
     Real project workflow:
     - create DB (or ensure it exists)
     - fetch + store data from all APIs for ONE batch of <= 25 cities
     - compute city stats
+    - draw the visualizations
     - write results to a text file
 
     NOTE: Because BATCH_SIZE = 25, each time you run THIS FILE we only add
     up to 25 new cities per API. To reach >=100 rows, you run the file
     multiple times. We track progress in PROGRESS_FILE so we don't
     duplicate the same city rows.
+
+    Every stage (and every fetch / store call) is timed as a span (see
+    metrics.py); with metrics_dir the spans are exported there as
+    spans.jsonl + pipeline.prom at the end of the run.
+
+    Raw API responses are archived into archive_dir (None: not archived),
+    so `reprocess` can rebuild the tables from them later.
     """
+    use_archive(archive_dir)
+    metrics.reset_spans()
+    metrics.reset_api_stats()
+    try:
+        with span("pipeline"):
+            _run_pipeline_stages(db_name, batch_size, sources, concurrency,
+                                 output_dir, results_file, headless, results_format,
+                                 rolling_retention)
+    finally:
+        metrics.print_span_summary()
+        metrics.print_api_report()
+        if metrics_dir:
+            metrics.export_metrics(metrics_dir)
+
+
+def _run_pipeline_stages(db_name, batch_size, sources, concurrency,
+                         output_dir, results_file, headless, results_format,
+                         rolling_retention=None):
     # 1) Make sure DB exists
-    create_database("final_project.db")
-    conn = sqlite3.connect("final_project.db")
+    create_database(db_name)
+    conn = sqlite3.connect(db_name)
 
-    # 2) Figure out where we left off last time
-    start_index = 0
-    if os.path.exists(PROGRESS_FILE):
-        try:
-            with open(PROGRESS_FILE, "r") as f:
-                data = json.load(f)
-                start_index = data.get("next_start", 0)
-        except Exception:
-            start_index = 0  # if file is corrupted, just start at 0
+    # 2) Fetch + store the next batch
+    with span("ingest"):
+        ingest_batch(conn, batch_size=batch_size, sources=sources, concurrency=concurrency,
+                     rolling_retention=rolling_retention)
 
-    # 3) Get the next batch of CITY_PAIRS
-    batch = CITY_PAIRS[start_index : start_index + BATCH_SIZE]
+    # 3) Compute combined stats (for whatever data we currently have)
+    with span("stats") as s:
+        city_stats = calculate_city_stats(conn)
+        s.rows = len(city_stats)
 
-    if not batch:
-        print("All city pairs have already been processed. Nothing new to fetch.")
-    else:
-        print(f"\nProcessing batch starting at index {start_index} "
-              f"({len(batch)} cities, max {BATCH_SIZE})...")
+    # NEW: debug join status
+    with span("debug_join_status"):
+        debug_city_join_status(conn)
 
-        # Split pairs into separate lists for the two APIs
-        weather_cities = [w for (w, aq) in batch]
-        aq_cities = [aq for (w, aq) in batch]
+    with span("correlations", rows=len(city_stats)):
+        from analytics import correlation_report
+        correlations = correlation_report(conn, city_stats)
+    conn.close()
 
-        # --- Weather (OpenWeather) ---
-        weather_data = fetch_weather(weather_cities)
-        store_weather_data(conn, weather_data)
+    if not city_stats:
+        print("No city statistics were created. This is probably because the "
+              "external APIs returned no (joinable) data.")
+        return
 
-        # --- Air Quality (OpenAQ) ---
-        aq_data = fetch_air_quality(aq_cities)
-        store_air_quality_data(conn, aq_data)
+    print_city_stats_summary(city_stats)
 
-        # 4) Save updated progress
-        new_start = start_index + len(batch)
-        with open(PROGRESS_FILE, "w") as f:
-            json.dump({"next_start": new_start}, f)
+    # 4) Visualizations (now part of the real pipeline)
+    #    (AQI + aq_category already come from calculate_city_stats / aqi.py)
+    with span("plots", rows=len(city_stats)) as s:
+        render_visualizations(city_stats, output_dir=output_dir, headless=headless)
+        s.bytes = sum(file_size(os.path.join(output_dir, f)) for f in VIS_FILES.values())
 
-        print(f"Batch done. Next start index will be {new_start}.")
+    # 5) Write results to a text file
+    with span("results", rows=len(city_stats)) as s:
+        write_results_to_file(city_stats, filename=results_file, fmt=results_format,
+                              correlations=correlations)
+        s.bytes = file_size(results_file)
 
-    # 5) Fetch + store city metadata from GeoDB
-    #    (This may fail with 403; that's okay, we log it.)
-    city_data = fetch_city_data(limit=25, min_population=50000)
-    store_city_data(conn, city_data)
 
-    # 6) Compute combined stats (for whatever data we currently have)
-    city_stats = calculate_city_stats(conn)
+def run_stats(db_name=DB_NAME, results_file="results.txt", since=None, until=None,
+              results_format=None):
+    """
+    `stats` command: compute city stats from the DB and write the results file.
 
-    # NEW: debug join status
+    since / until (unix seconds) limit the weather averages to that window.
+    Rows are streamed from the cursor into the results file, so the whole
+    result set is never held in memory (results_format: text / csv / jsonl,
+    a .gz results_file is gzipped). Only the temperature / PM2.5 pair of
+    every city is kept for the correlations written after the cities.
+    """
+    create_database(db_name)  # brings an older schema up to date first
+    conn = sqlite3.connect(db_name)
+    print_crosswalk_summary(update_crosswalk(conn))  # cities ingested before the crosswalk existed
     debug_city_join_status(conn)
 
-    if not city_stats:
-        print("No city statistics were created. This is probably because the "
-              "external APIs returned no (joinable) data.")
+    cur = city_stats_cursor(conn, since=since, until=until)
+    columns = [col[0] for col in cur.description]
+    head = [dict(zip(columns, row)) for row in cur.fetchmany(15)]
+
+    if not head:
         conn.close()
+        print("No city statistics in the database yet. Run `ingest` first.")
         return
 
-    print("\n=== DEBUG: city_stats summary ===")
-    print("Number of cities in city_stats:", len(city_stats))
-    for c in city_stats[:15]:
-        print(c)
-    print("=== END DEBUG ===\n")
+    correlation_inputs = []
 
-     # 6) Add AQ categories
-    for c in city_stats:
-        pm = c.get("avg_pm25")
-    if pm is None:
-        category = None
-    elif pm < 12:
-        category = "Good"
-    elif pm < 35:
-        category = "Moderate"
-    else:
-        category = "Unhealthy"
-    c["aq_category"] = category
+    def rows_for_file():
+        for row in itertools.chain(head, (dict(zip(columns, row)) for row in cur)):
+            correlation_inputs.append({key: row.get(key) for key in ("city_id", "avg_temp", "avg_pm25")})
+            yield row
 
-    # 7) Visualizations (now part of the real pipeline)
-    temp_plot_path = os.path.join(VIS_OUTPUT_DIR, "temp_vs_pm25.png")
-    pop_pm25_plot_path = os.path.join(VIS_OUTPUT_DIR, "population_vs_pm25.png")
-    city_char_plot_path = os.path.join(VIS_OUTPUT_DIR, "city_pop_with_aq_categories.png")
+    def correlations():
+        from analytics import correlation_report
+        return correlation_report(conn, correlation_inputs)
 
-    plot_temp_vs_pm25(city_stats, save_path=temp_plot_path)
-    plot_population_vs_pm25(city_stats, save_path=pop_pm25_plot_path)
-    plot_city_characteristics(city_stats, save_path=city_char_plot_path)
+    count = write_results_to_file(rows_for_file(), filename=results_file, fmt=results_format,
+                                  correlations=correlations)
+    conn.close()
 
-    ##new visualization
-    plot_pm25_ranked_by_city(city_stats, save_path=None)
-    plot_aq_category_overview(city_stats, save_path="aq_overview.png")
+    print_city_stats_summary(head, total=count)
 
 
+def run_plots(db_name=DB_NAME, output_dir=VIS_OUTPUT_DIR, headless=False):
+    """`plot` command: compute city stats from the DB and only draw the figures."""
+    create_database(db_name)
+    conn = sqlite3.connect(db_name)
+    print_crosswalk_summary(update_crosswalk(conn))
+    city_stats = calculate_city_stats(conn)
+    conn.close()
 
+    if not city_stats:
+        print("No city statistics in the database yet. Run `ingest` first.")
+        return
 
-    # 8) Write results to a text file
-    write_results_to_file(city_stats, filename="results.txt")
+    render_visualizations(city_stats, output_dir=output_dir, headless=headless)
 
-def main():
-    """Entry point for the program."""
-    # For final submission, you probably want the real pipeline:
-    run_pipeline()
 
-    #run all tests instead:
-    # run_tests()
+def run_correlations(db_name=DB_NAME, by=("all", "country", "region"), window=None,
+                     n_boot=None, seed=0, out=None):
+    """
+    `correlations` command: temperature vs PM2.5 Pearson / Spearman
+    correlations with bootstrap intervals per grouping (analytics.py),
+    printed and optionally written to a csv / jsonl file.
+    """
+    from analytics import DEFAULT_BOOTSTRAP, correlation_report, print_correlation_report
+    from results_writer import infer_format, write_results_stream
+
+    create_database(db_name)
+    conn = sqlite3.connect(db_name)
+    print_crosswalk_summary(update_crosswalk(conn))
+    city_stats = calculate_city_stats(conn)
+    try:
+        if out and infer_format(out)[0] == "text":
+            raise ValueError("--out needs a .csv or .jsonl file (the table is written as is)")
+        rows = correlation_report(conn, city_stats, by=by, window=window,
+                                  n_boot=DEFAULT_BOOTSTRAP if n_boot is None else n_boot,
+                                  seed=seed)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    finally:
+        conn.close()
+
+    print_correlation_report(rows)
+    if out:
+        write_results_stream(rows, out)
+        print(f"Correlations written to {out}")
+
+
+def run_reprocess(db_name=DB_NAME, archive_dir=DEFAULT_ARCHIVE_DIR, sources=ALL_SOURCES,
+                  workers=None):
+    """
+    `reprocess` command: rebuild the API rows held in the raw-response
+    archive (no network), parsing on every core; other rows are kept.
+    """
+    from raw_archive import RawArchive
+
+    archive = RawArchive(archive_dir)
+    if not os.path.exists(archive.index_path):
+        print(f"Error: no raw archive at {archive_dir} (nothing has been fetched into it yet)")
+        return None
+
+    create_database(db_name)
+    conn = sqlite3.connect(db_name)
+    start = time.perf_counter()
+    with span("reprocess"):
+        summary = reprocess_archive(conn, archive, sources=sources, workers=workers)
+    counts = conn.execute("""
+        SELECT (SELECT COUNT(*) FROM WeatherObservations),
+               (SELECT COUNT(*) FROM AirQualityMeasurements),
+               (SELECT COUNT(*) FROM GeoCities)
+    """).fetchone()
+    conn.close()
+
+    print(f"Reprocessed {summary['entries']:,} archived responses "
+          f"({', '.join(sources)}) in {time.perf_counter() - start:.1f}s: "
+          f"{counts[0]:,} weather observations, {counts[1]:,} air-quality measurements, "
+          f"{counts[2]:,} GeoDB cities.")
+    if summary["errors"] or summary["unused_pages"]:
+        print(f"{summary['errors']} unreadable responses skipped, "
+              f"{summary['unused_pages']} OpenAQ pages without a city mapping ignored.")
+    return summary
+
+
+def run_bench(db_name=DB_NAME, output_dir=VIS_OUTPUT_DIR, repeat=3):
+    """
+    `bench` command: time the stats and plot stages against an existing DB.
+
+    Figures are drawn in headless mode so no windows pop up while timing.
+    """
+    create_database(db_name)
+    conn = sqlite3.connect(db_name)
+    update_crosswalk(conn)
+    timings = {"calculate_city_stats": [], "render_visualizations": []}
+    city_stats = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        city_stats = calculate_city_stats(conn, memoize=False)
+        timings["calculate_city_stats"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        # every repeat really renders (a cache hit would only time a file copy)
+        render_visualizations(city_stats, output_dir=output_dir, headless=True,
+                              use_cache=False)
+        timings["render_visualizations"].append(time.perf_counter() - start)
+    conn.close()
+
+    print(f"\n=== BENCH ({len(city_stats)} cities, {repeat} runs) ===")
+    for stage, runs in timings.items():
+        print(f"{stage:<25} best {min(runs):.4f}s   mean {sum(runs) / len(runs):.4f}s")
+    print("=== END BENCH ===\n")
+
+
+def parse_date(text):
+    """argparse type: YYYY-MM-DD (UTC midnight) or a unix timestamp -> unix seconds."""
+    from datetime import datetime, timezone
+
+    if text.isdigit():
+        return int(text)
+    try:
+        day = datetime.strptime(text, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected YYYY-MM-DD or unix seconds, got {text!r}")
+    return int(day.timestamp())
+
+
+def parse_sources(text):
+    """argparse type for --sources: comma-separated subset of ALL_SOURCES."""
+    sources = tuple(src.strip() for src in text.split(",") if src.strip())
+    unknown = [src for src in sources if src not in ALL_SOURCES]
+    if unknown or not sources:
+        raise argparse.ArgumentTypeError(
+            f"unknown source(s) {unknown}; choose from {', '.join(ALL_SOURCES)}"
+        )
+    return sources
+
+
+def parse_bench_sizes(text):
+    """argparse type for --sizes: comma-separated sizes like 1k,100k,10M."""
+    from benchmarks import parse_size
+
+    try:
+        return [parse_size(part) for part in text.split(",") if part.strip()]
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parse_groupings(text):
+    """argparse type for --by: comma-separated groupings (all, country, region)."""
+    groupings = tuple(g.strip() for g in text.split(",") if g.strip())
+    unknown = [g for g in groupings if g not in ("all", "country", "region")]
+    if unknown or not groupings:
+        raise argparse.ArgumentTypeError(
+            f"unknown grouping(s) {unknown}; choose from all, country, region"
+        )
+    return groupings
+
+
+def build_arg_parser():
+    """Command-line interface: one sub-command per pipeline stage."""
+    # sub-commands take --db too, but with SUPPRESS so `starter.py --db x.db
+    # stats` keeps x.db instead of resetting it to the sub-command's default
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--db", default=argparse.SUPPRESS,
+                        help=f"SQLite database path (default: {DB_NAME})")
+
+    ingest_opts = argparse.ArgumentParser(add_help=False)
+    ingest_opts.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                             help=f"cities fetched per run (default: {BATCH_SIZE})")
+    ingest_opts.add_argument("--concurrency", type=int, default=1,
+                             help="parallel HTTP requests for weather fetches")
+    ingest_opts.add_argument("--sources", type=parse_sources, default=ALL_SOURCES,
+                             help="comma-separated sources to fetch: " + ",".join(ALL_SOURCES))
+    ingest_opts.add_argument("--rolling-retention", type=parse_window, default=None,
+                             help="prune rolling-window buckets older than this before each "
+                                  "city's newest, e.g. 8d (default: keep all)")
+
+    output_opts = argparse.ArgumentParser(add_help=False)
+    output_opts.add_argument("--output-dir", default=VIS_OUTPUT_DIR,
+                             help=f"directory for figures (default: {VIS_OUTPUT_DIR})")
+    output_opts.add_argument("--headless", action="store_true",
+                             help="render figures in parallel without a display")
+
+    archive_opts = argparse.ArgumentParser(add_help=False)
+    archive_opts.add_argument("--archive-dir", default=DEFAULT_ARCHIVE_DIR,
+                              help="raw API response archive (default: "
+                                   f"{DEFAULT_ARCHIVE_DIR})")
+    archive_opts.add_argument("--no-archive", action="store_true",
+                              help="don't archive the raw API responses")
+
+    metrics_opts = argparse.ArgumentParser(add_help=False)
+    metrics_opts.add_argument("--metrics-dir",
+                              help="export per-stage timing spans to this directory "
+                                   "(spans.jsonl + pipeline.prom)")
+
+    results_opts = argparse.ArgumentParser(add_help=False)
+    results_opts.add_argument("--results-file", default="results.txt",
+                              help="where to write the results")
+    results_opts.add_argument("--format", dest="results_format",
+                              choices=("text", "csv", "jsonl"), default=None,
+                              help="results file format (default: from the file "
+                                   "extension, else text)")
+    results_opts.add_argument("--gzip", action="store_true",
+                              help="gzip the results file (adds .gz to the name)")
+
+    parser = argparse.ArgumentParser(
+        description="City Explorers: weather + air quality + city data pipeline.",
+    )
+    parser.add_argument("--db", default=DB_NAME,
+                        help=f"SQLite database path (default: {DB_NAME})")
+    sub = parser.add_subparsers(dest="command")
+
+    sub.add_parser("pipeline",
+                   parents=[common, ingest_opts, archive_opts, output_opts, results_opts,
+                            metrics_opts],
+                   help="run every stage (default)")
+    sub.add_parser("ingest", parents=[common, ingest_opts, archive_opts, metrics_opts],
+                   help="fetch + store one batch of API data")
+    stats = sub.add_parser("stats", parents=[common, results_opts],
+                           help="compute city stats and write the results file")
+    stats.add_argument("--since", type=parse_date, help="only weather from this date")
+    stats.add_argument("--until", type=parse_date, help="only weather before this date")
+    backfill = sub.add_parser("backfill", parents=[common, archive_opts],
+                              help="load historical / forecast weather for known cities")
+    backfill.add_argument("--start", type=parse_date, required=True,
+                          help="YYYY-MM-DD or unix seconds")
+    backfill.add_argument("--end", type=parse_date, required=True,
+                          help="YYYY-MM-DD or unix seconds (exclusive)")
+    backfill.add_argument("--mode", choices=("history", "forecast"), default="history")
+    backfill.add_argument("--concurrency", type=int, default=4,
+                          help="parallel chunk downloads")
+    backfill.add_argument("--calls-per-minute", type=int,
+                          default=OPENWEATHER_CALLS_PER_MINUTE,
+                          help="API quota to stay under")
+    sub.add_parser("plot", parents=[common, output_opts],
+                   help="compute city stats and draw the figures")
+    bench = sub.add_parser("bench", parents=[common, output_opts],
+                           help="time the stats + plot stages")
+    bench.add_argument("--repeat", type=int, default=3)
+    bench.add_argument("--sizes", type=parse_bench_sizes,
+                       help="run the scaling suite (benchmarks.py) on synthetic "
+                            "databases of these sizes instead, e.g. 1k,100k,10M")
+    bench.add_argument("--timeout", type=float, default=300,
+                       help="seconds before a suite case is given up (default: 300)")
+    bench.add_argument("--out", default="bench_results.jsonl",
+                       help="JSON Lines file the suite appends its records to")
+    synth = sub.add_parser("synth", help="write a seeded synthetic database for load testing")
+    synth.add_argument("path", help="new database file to create")
+    synth.add_argument("--cities", type=int, default=1000)
+    synth.add_argument("--hours", type=int, default=168,
+                       help="hourly weather / air-quality rows per city (default: 168)")
+    synth.add_argument("--seed", type=int, default=0)
+    synth.add_argument("--pollutants", default="pm25",
+                       help="comma-separated pollutants to generate (default: pm25)")
+    synth.add_argument("--overwrite", action="store_true",
+                       help="replace the file if it already exists")
+    serve = sub.add_parser("serve", parents=[common],
+                           help="read-only HTTP/JSON query service over the DB")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--pool-size", type=int, default=4,
+                       help="pooled read-only SQLite connections")
+    plans = sub.add_parser("plans", help="check the project's SQL query plans against "
+                                         "the committed baseline")
+    plans.add_argument("--update", action="store_true",
+                       help="re-record the baseline (query_plans.json) instead of checking")
+    crosswalk = sub.add_parser("crosswalk", parents=[common],
+                               help="map Cities rows to GeoDB cities (CityCrosswalk)")
+    crosswalk.add_argument("--rebuild", action="store_true",
+                           help="forget every existing mapping and match all cities again")
+    correlations = sub.add_parser("correlations", parents=[common],
+                                  help="temperature vs PM2.5 correlations with bootstrap "
+                                       "confidence intervals")
+    correlations.add_argument("--by", type=parse_groupings, default=("all", "country", "region"),
+                              help="comma-separated groupings: all, country, region "
+                                   "(default: all three)")
+    correlations.add_argument("--window",
+                              help="also correlate across cities within every time window "
+                                   "of this length, e.g. 1d or 6h")
+    correlations.add_argument("--bootstrap", type=int, default=None,
+                              help="bootstrap resamples per interval (default: 1000, 0 = none)")
+    correlations.add_argument("--seed", type=int, default=0)
+    correlations.add_argument("--out", help="also write the table to this .csv / .jsonl file")
+    reprocess = sub.add_parser("reprocess", parents=[common],
+                               help="rebuild the weather / air-quality / GeoDB rows held in "
+                                    "the raw response archive, without network access")
+    reprocess.add_argument("--archive-dir", default=DEFAULT_ARCHIVE_DIR,
+                           help=f"raw API response archive (default: {DEFAULT_ARCHIVE_DIR})")
+    reprocess.add_argument("--sources", type=parse_sources, default=ALL_SOURCES,
+                           help="comma-separated sources to rebuild: " + ",".join(ALL_SOURCES))
+    reprocess.add_argument("--workers", type=int, default=None,
+                           help="parser processes (default: one per core)")
+    sub.add_parser("test", help="run the test_* functions")
+
+    return parser
+
+
+def results_file_from_args(args):
+    """--results-file, with .gz appended when --gzip is given."""
+    results_file = getattr(args, "results_file", "results.txt")
+    if getattr(args, "gzip", False) and not results_file.endswith(".gz"):
+        results_file += ".gz"
+    return results_file
+
+
+def archive_dir_from_args(args):
+    """--archive-dir, or None (no archiving) with --no-archive."""
+    if getattr(args, "no_archive", False):
+        return None
+    return getattr(args, "archive_dir", DEFAULT_ARCHIVE_DIR)
+
+
+def main(argv=None):
+    """Entry point for the program."""
+    args = build_arg_parser().parse_args(argv)
+    command = args.command or "pipeline"
+
+    if command == "pipeline":
+        # no sub-command given -> same options as `pipeline` with defaults
+        run_pipeline(
+            db_name=args.db,
+            batch_size=getattr(args, "batch_size", BATCH_SIZE),
+            sources=getattr(args, "sources", ALL_SOURCES),
+            concurrency=getattr(args, "concurrency", 1),
+            output_dir=getattr(args, "output_dir", VIS_OUTPUT_DIR),
+            results_file=results_file_from_args(args),
+            headless=getattr(args, "headless", False),
+            results_format=getattr(args, "results_format", None),
+            metrics_dir=getattr(args, "metrics_dir", None),
+            archive_dir=archive_dir_from_args(args),
+            rolling_retention=getattr(args, "rolling_retention", None),
+        )
+    elif command == "ingest":
+        use_archive(archive_dir_from_args(args))
+        create_database(args.db)
+        conn = sqlite3.connect(args.db)
+        with span("ingest"):
+            ingest_batch(conn, batch_size=args.batch_size, sources=args.sources,
+                         concurrency=args.concurrency, rolling_retention=args.rolling_retention)
+        conn.close()
+        metrics.print_api_report()
+        if args.metrics_dir:
+            metrics.export_metrics(args.metrics_dir)
+    elif command == "stats":
+        run_stats(db_name=args.db, results_file=results_file_from_args(args),
+                  since=args.since, until=args.until,
+                  results_format=args.results_format)
+    elif command == "backfill":
+        use_archive(archive_dir_from_args(args))
+        create_database(args.db)
+        conn = sqlite3.connect(args.db)
+        backfill_weather(conn, args.start, args.end, mode=args.mode,
+                         max_workers=args.concurrency,
+                         calls_per_minute=args.calls_per_minute)
+        conn.close()
+        metrics.print_api_report()
+    elif command == "plot":
+        run_plots(db_name=args.db, output_dir=args.output_dir, headless=args.headless)
+    elif command == "bench":
+        if args.sizes:
+            from benchmarks import run_suite
+            run_suite(sizes=args.sizes, output=args.out, timeout=args.timeout)
+        else:
+            run_bench(db_name=args.db, output_dir=args.output_dir, repeat=args.repeat)
+    elif command == "synth":
+        from synthetic_data import generate_database
+        start = time.perf_counter()
+        try:
+            counts = generate_database(
+                args.path, args.cities, hours=args.hours, seed=args.seed,
+                pollutants=[p.strip() for p in args.pollutants.split(",") if p.strip()],
+                overwrite=args.overwrite,
+            )
+        except (FileExistsError, ValueError) as e:
+            print(f"Error: {e}")
+            return
+        print(f"Wrote {counts['cities']:,} cities, {counts['weather_rows']:,} weather rows and "
+              f"{counts['aq_rows']:,} air-quality rows to {args.path} "
+              f"in {time.perf_counter() - start:.1f}s")
+    elif command == "serve":
+        from query_service import serve
+        serve(args.db, host=args.host, port=args.port, pool_size=args.pool_size)
+    elif command == "plans":
+        from query_plans import run_plan_check
+        if not run_plan_check(update=args.update):
+            sys.exit(1)
+    elif command == "crosswalk":
+        create_database(args.db)
+        conn = sqlite3.connect(args.db)
+        summary = update_crosswalk(conn, rebuild=args.rebuild)
+        mapped, total = conn.execute(
+            "SELECT (SELECT COUNT(*) FROM CityCrosswalk), (SELECT COUNT(*) FROM Cities)"
+        ).fetchone()
+        conn.close()
+        print_crosswalk_summary(summary)
+        print(f"{mapped} of {total} cities are mapped to a GeoDB city.")
+    elif command == "correlations":
+        run_correlations(db_name=args.db, by=args.by, window=args.window,
+                         n_boot=args.bootstrap, seed=args.seed, out=args.out)
+    elif command == "reprocess":
+        run_reprocess(db_name=args.db, archive_dir=args.archive_dir, sources=args.sources,
+                      workers=args.workers)
+    elif command == "test":
+        run_tests()
 
 
 ##test for merging
@@ -1203,9 +2474,1183 @@ def test_calculate_city_stats():
     print()
 
 
+# -----------------------------
+# Performance / scaling helper tests
+# -----------------------------
+def test_group_by_codes():
+    """Test for the vectorised group-by behind plot_aq_category_overview."""
+    print("Running test_group_by_codes...")
+    from group_stats import group_by_codes
+
+    codes = [0, 0, 0, 1, 1, 2]
+    values = [1.0, 2.0, 3.0, 10.0, float("nan"), 5.0]
+    summary = group_by_codes(codes, values, n_groups=4)
+
+    counts = list(summary["count"])
+    if counts != [3, 1, 1, 0]:
+        print("FAIL: group_by_codes counts are wrong:", counts)
+        return
+    if summary["mean"][0] != 2.0 or summary["quantiles"][0][1] != 2.0:
+        print("FAIL: group_by_codes mean/median are wrong.")
+        return
+    if summary["mean"][3] == summary["mean"][3]:  # NaN != NaN
+        print("FAIL: empty group should have a NaN mean.")
+        return
+
+    print("PASS: test_group_by_codes")
+    print()
+
+
+def test_aqi():
+    """Test for the vectorised AQI engine in aqi.py."""
+    print("Running test_aqi...")
+    from aqi import aqi_values, aqi_categories, aqi_sql
+
+    # EPA worked values: 12.0 -> 50, 35.4 -> 100, 55.5 -> 151
+    values = list(aqi_values("pm25", [12.0, 35.4, 55.5, -1.0]))
+    if values[:3] != [50.0, 100.0, 151.0] or values[3] == values[3]:
+        print("FAIL: aqi_values gave unexpected PM2.5 AQIs:", values)
+        return
+
+    categories = list(aqi_categories([10, 75, 180, float("nan")], simple=True))
+    if categories != ["Good", "Moderate", "Unhealthy", None]:
+        print("FAIL: aqi_categories gave unexpected categories:", categories)
+        return
+
+    # SQL version has to agree with the numpy version
+    conn = sqlite3.connect(":memory:")
+    sql_value = conn.execute(
+        f"SELECT {aqi_sql('pm10', 'x')} FROM (SELECT ? AS x)", (200,)
+    ).fetchone()[0]
+    conn.close()
+    if sql_value != aqi_values("pm10", [200])[0]:
+        print("FAIL: aqi_sql disagrees with aqi_values:", sql_value)
+        return
+
+    print("PASS: test_aqi")
+    print()
+
+
+def test_store_multi_pollutant_data():
+    """Test for multi-pollutant store_air_quality_data + calculate_city_stats."""
+    print("Running test_store_multi_pollutant_data...")
+
+    test_db_name = os.path.join(TEST_OUTPUT_DIR, "test_multi_pollutant.db")
+    if os.path.exists(test_db_name):
+        os.remove(test_db_name)
+    create_database(test_db_name)
+    conn = sqlite3.connect(test_db_name)
+
+    store_weather_data(conn, [{
+        "city_name": "Test City", "country": "TC", "latitude": 1.0, "longitude": 2.0,
+        "timestamp": 1700000000, "temperature": 20.0, "feels_like": 19.0,
+        "humidity": 40, "wind_speed": 1.0, "weather_main": "Clear",
+    }])
+    store_air_quality_data(conn, [{
+        "city": "Test City",
+        "location": "Station T",
+        "latitude": 1.0,
+        "longitude": 2.0,
+        "pm25": 10.0,
+        "unit": "µg/m³",
+        "measurements": {
+            "pm25": {"value": 10.0, "unit": "µg/m³", "timestamp": "2024-01-01T00:00:00Z"},
+            "no2": {"value": 0.02, "unit": "ppm", "timestamp": "2024-01-01T00:00:00Z"},
+        },
+    }])
+
+    rows = conn.execute(
+        "SELECT parameter FROM AirQualityMeasurements ORDER BY parameter"
+    ).fetchall()
+    if [r[0] for r in rows] != ["no2", "pm25"]:
+        print("FAIL: expected one long-format row per pollutant, got", rows)
+        conn.close()
+        return
+
+    stats = calculate_city_stats(conn, pollutants=("pm25", "no2"))
+    conn.close()
+    if not stats or stats[0].get("avg_no2") != 0.02 or stats[0].get("avg_pm25") != 10.0:
+        print("FAIL: calculate_city_stats per-pollutant averages are wrong:", stats)
+        return
+
+    print("PASS: test_store_multi_pollutant_data")
+    print()
+
+
+def test_store_weather_series():
+    """Test for the chunked, de-duplicating weather backfill insert."""
+    print("Running test_store_weather_series...")
+
+    test_db_name = os.path.join(TEST_OUTPUT_DIR, "test_weather_series.db")
+    if os.path.exists(test_db_name):
+        os.remove(test_db_name)
+    create_database(test_db_name)
+    conn = sqlite3.connect(test_db_name)
+
+    # 10 hourly rows, streamed from a generator in batches of 3
+    rows = ((1, 1700000000 + 3600 * h, 10.0 + h, 9.0, 50, 2.0, "Clear") for h in range(10))
+    first = store_weather_series(conn, rows, batch_size=3)
+    # same range again (plus one new hour) -> only the new hour is added
+    rows = ((1, 1700000000 + 3600 * h, 10.0 + h, 9.0, 50, 2.0, "Clear") for h in range(11))
+    second = store_weather_series(conn, rows, batch_size=3)
+
+    total = conn.execute("SELECT COUNT(*) FROM WeatherObservations").fetchone()[0]
+    conn.close()
+
+    if first == 10 and second == 1 and total == 11:
+        print("PASS: test_store_weather_series")
+    else:
+        print("FAIL: store_weather_series inserted", first, second, "rows; total", total)
+    print()
+
+
+def test_write_results_stream():
+    """Test for the streaming text / CSV / JSON Lines (+ gzip) results writer."""
+    import csv
+    import gzip
+    from results_writer import write_results_stream
+
+    print("Running test_write_results_stream...")
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE t (city TEXT, avg_temp REAL, avg_pm25 REAL, "
+                 "population INTEGER, aq_category TEXT)")
+    conn.executemany("INSERT INTO t VALUES (?, ?, ?, ?, ?)",
+                     [(f"City {i}", 10.0 + i, 5.0 * i, 1000 * i, "Good") for i in range(50)])
+
+    csv_path = os.path.join(TEST_OUTPUT_DIR, "test_results.csv")
+    jsonl_path = os.path.join(TEST_OUTPUT_DIR, "test_results.jsonl.gz")
+    text_path = os.path.join(TEST_OUTPUT_DIR, "test_results_stream.txt")
+
+    # tiny buffer so the chunked flushing is exercised too
+    n_csv = write_results_stream(conn.execute("SELECT * FROM t"), csv_path, buffer_chars=64)
+    n_jsonl = write_results_stream(conn.execute("SELECT * FROM t"), jsonl_path)
+    n_text = write_results_stream(conn.execute("SELECT * FROM t LIMIT 1"), text_path)
+    conn.close()
+
+    with open(csv_path, newline="") as f:
+        csv_rows = list(csv.DictReader(f))
+    with gzip.open(jsonl_path, "rt") as f:
+        jsonl_rows = [json.loads(line) for line in f]
+    with open(text_path) as f:
+        text = f.read()
+
+    if (n_csv, n_jsonl, n_text) != (50, 50, 1):
+        print("FAIL: write_results_stream row counts:", n_csv, n_jsonl, n_text)
+    elif csv_rows[49]["city"] != "City 49" or jsonl_rows[49]["population"] != 49000:
+        print("FAIL: write_results_stream wrote the wrong rows")
+    elif "City: City 0\nPopulation: 0\n" not in text:
+        print("FAIL: text format does not match results.txt layout:", text)
+    else:
+        print("PASS: test_write_results_stream")
+    print()
+
+
+def test_query_service():
+    """Test for the read-only HTTP query service (pagination, top-k, cache)."""
+    import threading
+    import urllib.error
+    import urllib.request
+    from query_service import make_server
+
+    print("Running test_query_service...")
+
+    test_db_name = os.path.join(TEST_OUTPUT_DIR, "test_query_service.db")
+    if os.path.exists(test_db_name):
+        os.remove(test_db_name)
+    create_database(test_db_name)
+    conn = sqlite3.connect(test_db_name)
+    for i in range(3):
+        cur = conn.execute("INSERT INTO Cities (city_name, country) VALUES (?, 'US')", (f"City {i}",))
+        city_id = cur.lastrowid
+        conn.execute("INSERT INTO WeatherObservations (city_id, timestamp, temperature) "
+                     "VALUES (?, 1700000000, ?)", (city_id, 10.0 + i))
+        cur = conn.execute("INSERT INTO AirQualityLocations (city_id, location_name) "
+                           "VALUES (?, 'Station')", (city_id,))
+        conn.execute("INSERT INTO AirQualityMeasurements (location_id, timestamp, parameter, value, unit) "
+                     "VALUES (?, '2024-01-01T00:00:00Z', 'pm25', ?, 'µg/m³')", (cur.lastrowid, 5.0 * (i + 1)))
+    conn.commit()
+
+    server = make_server(test_db_name, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def get(path):
+        with urllib.request.urlopen(base + path) as resp:
+            return json.loads(resp.read())
+
+    try:
+        page = get("/cities?limit=2")
+        top = get("/top?metric=avg_pm25&k=1")
+        series = get(f"/cities/{page['items'][0]['city_id']}/weather")
+        get("/cities?limit=2")
+        hits_before_write = get("/health")["cache_hits"]
+
+        # a committed write invalidates the cache
+        conn.execute("UPDATE AirQualityMeasurements SET value = 100 WHERE id = 1")
+        conn.commit()
+        top_after = get("/top?metric=avg_pm25&k=1")
+
+        # an unexpected error still gets a JSON 500 back
+        def broken_handle(path, params):
+            raise RuntimeError("boom")
+
+        server.service.handle = broken_handle
+        try:
+            get("/cities")
+            crashed = None
+        except urllib.error.HTTPError as e:
+            crashed = (e.code, json.loads(e.read()))
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.service.close()
+        conn.close()
+
+    if page["total"] != 3 or len(page["items"]) != 2 or page["next_offset"] != 2:
+        print("FAIL: /cities pagination is wrong:", page)
+    elif top["items"][0]["avg_pm25"] != 15.0 or top_after["items"][0]["avg_pm25"] != 100.0:
+        print("FAIL: /top ranking or cache invalidation is wrong:", top, top_after)
+    elif series["total"] != 1 or series["items"][0]["timestamp"] != 1700000000:
+        print("FAIL: /cities/<id>/weather is wrong:", series)
+    elif hits_before_write < 1:
+        print("FAIL: repeated request was not served from the cache")
+    elif crashed is None or crashed[0] != 500 or "boom" not in crashed[1].get("error", ""):
+        print("FAIL: an unexpected handler error did not return a 500:", crashed)
+    else:
+        print("PASS: test_query_service")
+    print()
+
+
+def test_city_stats_memo():
+    """Test that calculate_city_stats is memoised until the data changes."""
+    import threading
+    import analysis_visualizations
+    from analysis_visualizations import MEMO_STATS
+
+    print("Running test_city_stats_memo...")
+
+    test_db_name = os.path.join(TEST_OUTPUT_DIR, "test_city_stats_memo.db")
+    if os.path.exists(test_db_name):
+        os.remove(test_db_name)
+    create_database(test_db_name)
+    conn = sqlite3.connect(test_db_name)
+    other = sqlite3.connect(test_db_name)
+
+    conn.execute("INSERT INTO Cities (city_name, country) VALUES ('Memo City', 'US')")
+    conn.execute("INSERT INTO WeatherObservations (city_id, timestamp, temperature) VALUES (1, 1700000000, 10.0)")
+    conn.execute("INSERT INTO AirQualityLocations (city_id, location_name) VALUES (1, 'Station')")
+    conn.execute("INSERT INTO AirQualityMeasurements (location_id, timestamp, parameter, value, unit) "
+                 "VALUES (1, '2024-01-01T00:00:00Z', 'pm25', 10.0, 'µg/m³')")
+    conn.commit()
+
+    hits = MEMO_STATS["hits"]
+    first = calculate_city_stats(conn)
+    second = calculate_city_stats(conn)
+    memo_hit = MEMO_STATS["hits"] == hits + 1
+
+    # a write on this connection invalidates ...
+    conn.execute("UPDATE AirQualityMeasurements SET value = 20.0")
+    conn.commit()
+    after_own_write = calculate_city_stats(conn)
+
+    # ... and so does a commit from another connection
+    other.execute("UPDATE AirQualityMeasurements SET value = 30.0")
+    other.commit()
+    after_other_write = calculate_city_stats(conn)
+    conn.close()
+    other.close()
+
+    # many threads on their own connections (as the query service does),
+    # with fewer memo slots than threads so they keep evicting each other
+    errors = []
+
+    def hammer():
+        thread_conn = sqlite3.connect(test_db_name)
+        try:
+            for _ in range(200):
+                calculate_city_stats(thread_conn)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            thread_conn.close()
+
+    original_max = analysis_visualizations.MEMO_MAX_CONNECTIONS
+    analysis_visualizations.MEMO_MAX_CONNECTIONS = 2
+    try:
+        threads = [threading.Thread(target=hammer) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        analysis_visualizations.MEMO_MAX_CONNECTIONS = original_max
+
+    if not memo_hit or first != second:
+        print("FAIL: repeated calculate_city_stats call was not memoised")
+    elif after_own_write[0]["avg_pm25"] != 20.0 or after_other_write[0]["avg_pm25"] != 30.0:
+        print("FAIL: memoised city stats were not invalidated by a write:",
+              after_own_write, after_other_write)
+    elif errors:
+        print("FAIL: concurrent calculate_city_stats calls raised:", errors[:3])
+    else:
+        print("PASS: test_city_stats_memo")
+    print()
+
+
+def test_benchmark_suite():
+    """Smoke test for the scaling benchmark suite on a tiny database."""
+    from benchmarks import run_suite
+
+    print("Running test_benchmark_suite...")
+
+    output = os.path.join(TEST_OUTPUT_DIR, "test_bench.jsonl")
+    if os.path.exists(output):
+        os.remove(output)
+    records = run_suite(sizes=[400], output=output, timeout=60,
+                        benchmarks=["store_city_data", "calculate_city_stats"])
+
+    with open(output) as f:
+        written = [json.loads(line) for line in f]
+    timed = [r for r in written if r["benchmark"] != "build_db"]
+
+    if len(written) != len(records) or len(timed) != 2:
+        print("FAIL: benchmark suite wrote", len(written), "records:", written)
+    elif any(r["status"] != "ok" or r["rows_per_second"] is None or "max_rss_mb" not in r
+             for r in timed):
+        print("FAIL: benchmark records are incomplete:", timed)
+    else:
+        print("PASS: test_benchmark_suite")
+    print()
+
+
+def test_synthetic_data():
+    """Test that the synthetic generator is seeded and fills the real schema."""
+    from synthetic_data import generate_database
+
+    print("Running test_synthetic_data...")
+
+    paths = [os.path.join(TEST_OUTPUT_DIR, f"test_synthetic_{i}.db") for i in range(2)]
+    for path in paths:
+        counts = generate_database(path, 30, hours=24, seed=7,
+                                   pollutants=("pm25", "no2"), overwrite=True)
+
+    dumps = []
+    for path in paths:
+        conn = sqlite3.connect(path)
+        dumps.append((
+            conn.execute("SELECT * FROM WeatherObservations ORDER BY id").fetchall(),
+            conn.execute("SELECT * FROM AirQualityMeasurements ORDER BY id").fetchall(),
+        ))
+        stats = calculate_city_stats(conn, pollutants=("pm25", "no2"))
+        coords = conn.execute("SELECT COUNT(*) FROM Cities WHERE latitude IS NULL").fetchone()[0]
+        conn.close()
+
+    if counts != {"cities": 30, "weather_rows": 720, "aq_rows": 1440}:
+        print("FAIL: generate_database row counts are wrong:", counts)
+    elif dumps[0] != dumps[1]:
+        print("FAIL: the same seed produced different databases")
+    elif len(stats) != 30 or coords or any(s["population"] is None for s in stats):
+        print("FAIL: synthetic cities don't join through calculate_city_stats:", stats[:2])
+    else:
+        print("PASS: test_synthetic_data")
+    print()
+
+
+def test_pipeline_metrics():
+    """Test timing spans + JSON Lines / Prometheus export."""
+    print("Running test_pipeline_metrics...")
+
+    metrics_dir = os.path.join(TEST_OUTPUT_DIR, "metrics")
+    if os.path.exists(os.path.join(metrics_dir, "spans.jsonl")):
+        os.remove(os.path.join(metrics_dir, "spans.jsonl"))
+
+    metrics.reset_spans()
+    with span("pipeline"):
+        with span("ingest.store_weather", rows=3) as s:
+            s.bytes = 4096
+        try:
+            with span("plots"):
+                raise RuntimeError("no display")
+        except RuntimeError:
+            pass
+    run_id = metrics.export_metrics(metrics_dir)
+
+    with open(os.path.join(metrics_dir, "spans.jsonl")) as f:
+        spans = {r["span"]: r for r in map(json.loads, f)}
+    with open(os.path.join(metrics_dir, "pipeline.prom")) as f:
+        prom = f.read()
+
+    store = spans.get("ingest.store_weather", {})
+    if set(spans) != {"pipeline", "ingest.store_weather", "plots"}:
+        print("FAIL: unexpected spans:", list(spans))
+    elif store.get("parent") != "pipeline" or store.get("rows") != 3 or store.get("run_id") != run_id:
+        print("FAIL: span record is wrong:", store)
+    elif spans["plots"]["status"] != "error":
+        print("FAIL: a span that raised was not marked as an error")
+    elif 'city_pipeline_span_bytes{span="ingest.store_weather"} 4096' not in prom:
+        print("FAIL: Prometheus export is missing the span bytes:\n" + prom)
+    else:
+        print("PASS: test_pipeline_metrics")
+    print()
+
+
+def test_api_latency_metrics():
+    """Test per-endpoint latency histograms + status / error counters."""
+    print("Running test_api_latency_metrics...")
+
+    class FakeResponse:
+        def __init__(self, status_code, content):
+            self.status_code = status_code
+            self.content = content
+
+    class ReadTimeout(Exception):  # same class name as requests' timeout
+        pass
+
+    def fake_get(url, status=200, fail=False):
+        if fail:
+            raise ReadTimeout(url)
+        return FakeResponse(status, b"x" * 100)
+
+    metrics.reset_api_stats()
+    for _ in range(20):
+        timed_request("test.api", fake_get, "http://example")
+    timed_request("test.api", fake_get, "http://example", status=503)
+    try:
+        timed_request("test.api", fake_get, "http://example", fail=True)
+    except ReadTimeout:
+        pass
+
+    report = metrics.api_report().get("test.api", {})
+    prom = metrics.prometheus_text()
+    metrics.reset_api_stats()
+
+    if report.get("requests") != 22 or report.get("bytes") != 2100:
+        print("FAIL: api_report counts are wrong:", report)
+    elif report["status_codes"] != {"200": 20, "503": 1} or report["errors"] != {"timeout": 1}:
+        print("FAIL: status / error counters are wrong:", report)
+    elif not (0 <= report["p50"] <= report["p95"] <= report["p99"]):
+        print("FAIL: latency percentiles are not ordered:", report)
+    elif 'city_pipeline_http_request_duration_seconds_count{endpoint="test.api"} 22' not in prom:
+        print("FAIL: Prometheus export is missing the latency histogram")
+    else:
+        print("PASS: test_api_latency_metrics")
+    print()
+
+
+def test_query_plans():
+    """Test that the plan guard flags scans of large tables and new flags."""
+    import query_plans
+
+    print("Running test_query_plans...")
+
+    path = os.path.join(TEST_OUTPUT_DIR, "test_plans.db")
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE Readings (id INTEGER PRIMARY KEY, city TEXT, value REAL)")
+    conn.executemany("INSERT INTO Readings (city, value) VALUES (?, ?)",
+                     ((f"City {i % 50}", i) for i in range(2000)))
+    conn.commit()
+    conn.close()
+
+    sql = "SELECT r.value FROM Readings r WHERE r.city = 'City 7' ORDER BY r.value"
+    before = query_plans.explain_statements(path, {"q": sql})
+
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE INDEX idx_readings_city_value ON Readings(city, value)")
+    conn.commit()
+    conn.close()
+    after = query_plans.explain_statements(path, {"q": sql})
+
+    regressions, _ = query_plans.compare_plans(before, after)
+    if query_plans.normalize_sql(sql) != before["q"]["sql"] or "'City 7'" in before["q"]["sql"]:
+        print("FAIL: literals were not normalised:", before["q"]["sql"])
+    elif "full-scan:Readings" not in before["q"]["flags"]:
+        print("FAIL: the unindexed scan was not flagged:", before["q"])
+    elif after["q"]["flags"]:
+        print("FAIL: the indexed plan is still flagged:", after["q"])
+    elif [r[2] for r in regressions] != [before["q"]["flags"]]:
+        print("FAIL: dropping the index is not reported as a regression:", regressions)
+    else:
+        print("PASS: test_query_plans")
+    print()
+
+
+def test_city_health_report():
+    """Test the per-city counts + freshness of debug_city_join_status."""
+    print("Running test_city_health_report...")
+
+    path = os.path.join(TEST_OUTPUT_DIR, "test_health.db")
+    if os.path.exists(path):
+        os.remove(path)
+    create_database(path)
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO Cities (id, city_name, country) VALUES (?, ?, 'XX')",
+                     [(1, "Alpha"), (2, "Beta")])
+    conn.executemany("INSERT INTO WeatherObservations (city_id, timestamp) VALUES (1, ?)",
+                     [(1_704_067_200 + 3600 * h,) for h in range(3)])
+    conn.executemany("INSERT INTO AirQualityLocations (id, city_id, location_name) VALUES (?, 1, ?)",
+                     [(1, "North"), (2, "South")])
+    # 2 locations x 3 weather rows: the old join counted 2 * 3 rows per city
+    conn.executemany("INSERT INTO AirQualityMeasurements (location_id, timestamp, parameter, value) "
+                     "VALUES (?, ?, ?, 1.0)",
+                     [(1, "2024-01-01T00:00:00Z", "pm25"), (2, "2024-01-01T05:00:00Z", "pm25"),
+                      (2, "2024-01-02T00:00:00Z", "no2")])
+    conn.commit()
+    report = {r["city"]: r for r in debug_city_join_status(conn)}
+    conn.close()
+
+    alpha, beta = report.get("Alpha"), report.get("Beta")
+    if not alpha or not beta:
+        print("FAIL: cities missing from the report:", list(report))
+    elif (alpha["weather_rows"], alpha["aq_locations"], alpha["aq_measurements"]) != (3, 2, 2):
+        print("FAIL: per-city counts are wrong:", alpha)
+    elif alpha["weather_last"] != "2024-01-01T02:00:00Z" or alpha["aq_last"] != "2024-01-01T05:00:00Z":
+        print("FAIL: freshness timestamps are wrong:", alpha)
+    elif (beta["weather_rows"], beta["aq_measurements"], beta["weather_last"]) != (0, 0, None):
+        print("FAIL: a city without data should report zeros:", beta)
+    else:
+        print("PASS: test_city_health_report")
+    print()
+
+
+def test_city_crosswalk():
+    """Test Cities -> GeoCities matching on name variants + coordinates."""
+    from city_crosswalk import update_crosswalk
+
+    print("Running test_city_crosswalk...")
+
+    path = os.path.join(TEST_OUTPUT_DIR, "test_crosswalk.db")
+    if os.path.exists(path):
+        os.remove(path)
+    create_database(path)
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO Cities (id, city_name, country, latitude, longitude) VALUES (?, ?, ?, ?, ?)",
+        [(1, "New York", "US", 40.7143, -74.006),
+         (2, "Paris", "FR", 48.8534, 2.3488),
+         (3, "Washington", "US", 38.8951, -77.0364),
+         (4, "Atlantis", "XX", 0.0, 0.0)],
+    )
+    store_city_data(conn, [
+        {"geodb_id": "Q60", "name": "New York City", "country": "US",
+         "population": 8_804_190, "latitude": 40.67, "longitude": -73.94},
+        {"geodb_id": "Q830149", "name": "Paris", "country": "US",  # Paris, Texas
+         "population": 24_171, "latitude": 33.6609, "longitude": -95.5555},
+        {"geodb_id": "Q90", "name": "Paris", "country": "FR",
+         "population": 2_165_423, "latitude": 48.8566, "longitude": 2.3522},
+        {"geodb_id": "Q61", "name": "Washington, D.C.", "country": "US",
+         "population": 689_545, "latitude": 38.9047, "longitude": -77.0163},
+    ])
+    first = update_crosswalk(conn)
+    second = update_crosswalk(conn)
+    mapping = dict(conn.execute("SELECT city_id, geodb_id FROM CityCrosswalk"))
+    conn.close()
+
+    if mapping != {1: "Q60", 2: "Q90", 3: "Q61"}:
+        print("FAIL: crosswalk mapping is wrong:", mapping)
+    elif first["matched"] != 3 or first["unmatched"] != 1:
+        print("FAIL: first update summary is wrong:", first)
+    elif second["checked"] != 1 or second["matched"] != 0:
+        print("FAIL: mapped cities were checked again:", second)
+    else:
+        print("PASS: test_city_crosswalk")
+    print()
+
+
+def test_spatial_index():
+    """Test the R*Tree triggers + radius look-ups (incl. the 180th meridian)."""
+    from spatial_index import within_radius, stations_near_city, bounding_boxes
+
+    print("Running test_spatial_index...")
+
+    path = os.path.join(TEST_OUTPUT_DIR, "test_spatial.db")
+    if os.path.exists(path):
+        os.remove(path)
+    create_database(path)
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO Cities (id, city_name, country, latitude, longitude) VALUES (?, ?, ?, ?, ?)",
+        [(1, "Ann Arbor", "US", 42.2808, -83.743), (2, "Detroit", "US", 42.3314, -83.0458),
+         (3, "Suva", "FJ", -18.1416, 178.4419), (4, "Nowhere", "XX", None, None)],
+    )
+    conn.executemany(
+        "INSERT INTO AirQualityLocations (id, city_id, location_name, latitude, longitude) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [(1, None, "Ypsilanti", 42.2411, -83.6130), (2, None, "Dearborn", 42.3223, -83.1763),
+         (3, None, "Taveuni", -16.85, -179.97)],
+    )
+    conn.execute("UPDATE Cities SET latitude = 42.9634, longitude = -85.6681 WHERE id = 2")
+    conn.commit()
+
+    near_ann_arbor = [loc for loc, _ in stations_near_city(conn, 1, radius_km=25)]
+    near_detroit = [loc for loc, _ in stations_near_city(conn, 2, radius_km=25)]
+    across_meridian = [loc for loc, _ in within_radius(conn, "AirQualityLocations",
+                                                        -18.1416, 178.4419, 300)]
+    indexed = conn.execute("SELECT COUNT(*) FROM Cities_rtree").fetchone()[0]
+    conn.execute("DELETE FROM Cities WHERE id = 3")
+    after_delete = conn.execute("SELECT COUNT(*) FROM Cities_rtree").fetchone()[0]
+    conn.close()
+
+    if near_ann_arbor != [1]:
+        print("FAIL: stations within 25 km of Ann Arbor are wrong:", near_ann_arbor)
+    elif near_detroit:
+        print("FAIL: the R*Tree didn't follow a coordinate update:", near_detroit)
+    elif across_meridian != [3] or len(bounding_boxes(-18.1416, 178.4419, 300)) != 2:
+        print("FAIL: radius look-up across the 180th meridian failed:", across_meridian)
+    elif (indexed, after_delete) != (3, 2):
+        print("FAIL: R*Tree rows are out of sync:", indexed, after_delete)
+    else:
+        print("PASS: test_spatial_index")
+    print()
+
+
+def test_rolling_windows():
+    """Test RollingBuckets maintenance + rolling-window look-ups."""
+    from rolling import rolling_mean, rolling_means, parse_window
+
+    print("Running test_rolling_windows...")
+
+    path = os.path.join(TEST_OUTPUT_DIR, "test_rolling.db")
+    if os.path.exists(path):
+        os.remove(path)
+    create_database(path)
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO Cities (id, city_name, country) VALUES (1, 'Alpha', 'XX')")
+    t0 = 1_704_067_200  # 2024-01-01 00:00 UTC
+    # 10 days of hourly weather: temperature = hour index
+    store_weather_series(conn, [(1, t0 + 3600 * h, float(h), None, None, None, "Clear")
+                                for h in range(240)])
+    store_air_quality_data(conn, [{
+        "city": "Alpha", "location": "Station",
+        "measurements": {"pm25": {"value": 10.0, "unit": "µg/m³",
+                                  "timestamp": "2024-01-10T22:00:00Z"}},
+    }, {
+        "city": "Alpha", "location": "Station 2",
+        "measurements": {"pm25": {"value": 30.0, "unit": "µg/m³",
+                                  "timestamp": "2024-01-10T23:30:00+00:00"}},
+    }])
+
+    day = rolling_mean(conn, 1, "temperature", "24h")
+    week_at = rolling_mean(conn, 1, "temperature", "7d", end=t0 + 3600 * 168)
+    pm25 = rolling_means(conn, "pm25", "24h").get(1, {})
+    pruned = prune_rolling_buckets(conn, keep_seconds=parse_window("7d"))
+    buckets = conn.execute("SELECT COUNT(*) FROM RollingBuckets WHERE metric = 'temperature'").fetchone()[0]
+    conn.close()
+
+    try:
+        parse_window("90m")
+        bad_window_rejected = False
+    except ValueError:
+        bad_window_rejected = True
+
+    if not day or day["n"] != 24 or day["mean"] != sum(range(216, 240)) / 24:
+        print("FAIL: 24h rolling temperature is wrong:", day)
+    elif not week_at or week_at["n"] != 168 or (week_at["min"], week_at["max"]) != (0.0, 167.0):
+        print("FAIL: 7d window ending at an explicit time is wrong:", week_at)
+    elif pm25.get("n") != 2 or pm25.get("mean") != 20.0:
+        print("FAIL: 24h rolling pm25 is wrong:", pm25)
+    elif pruned != 240 - 169 or buckets != 169:
+        print("FAIL: pruning kept the wrong buckets:", pruned, buckets)
+    elif not bad_window_rejected:
+        print("FAIL: a window that isn't whole buckets was accepted")
+    else:
+        print("PASS: test_rolling_windows")
+    print()
+
+
+def test_correlation_analytics():
+    """Test the grouped correlations + bootstrap intervals in analytics.py."""
+    import numpy as np
+    from analytics import correlation_report, correlation_table, grouped_spearman
+    from results_writer import correlations_filename, write_results_stream
+
+    print("Running test_correlation_analytics...")
+
+    rng = np.random.default_rng(3)
+    codes = np.repeat([0, 1], 200)
+    x = rng.normal(size=400)
+    y = np.where(codes == 0, x, -x) + rng.normal(scale=0.5, size=400)
+    rows = correlation_table(codes, x, y, ["up", "down"], "sign", n_boot=300, seed=1)
+    up, down = rows
+    expected = np.corrcoef(x[:200], y[:200])[0, 1]
+    if abs(up["pearson_r"] - expected) > 1e-4 or down["pearson_r"] > -0.5:
+        print("FAIL: grouped Pearson r does not match np.corrcoef:", up, down)
+        return
+    if not (up["pearson_ci_low"] <= up["pearson_r"] <= up["pearson_ci_high"]
+            and up["spearman_ci_low"] <= up["spearman_rho"] <= up["spearman_ci_high"]):
+        print("FAIL: bootstrap interval does not contain the estimate:", up)
+        return
+
+    # ties get average ranks: x ranks 1, 2.5, 2.5, 4 against y ranks 1..4
+    _, rho = grouped_spearman(np.zeros(4, dtype=np.int64), np.array([1.0, 2.0, 2.0, 3.0]),
+                              np.array([1.0, 2.0, 3.0, 4.0]), 1)
+    if abs(rho[0] - 0.9486833) > 1e-6:
+        print("FAIL: Spearman rho with ties:", rho[0])
+        return
+
+    city_stats = [{"city_id": i, "avg_temp": float(i), "avg_pm25": 2.0 * i} for i in range(10)]
+    city_stats.append({"city_id": 10, "avg_temp": None, "avg_pm25": 5.0})
+    report = correlation_report(None, city_stats, by=("all",), n_boot=50)
+    if len(report) != 1 or report[0]["n"] != 10 or report[0]["spearman_rho"] != 1.0:
+        print("FAIL: correlation_report rows are wrong:", report)
+        return
+
+    csv_path = os.path.join(TEST_OUTPUT_DIR, "test_corr_results.csv")
+    text_path = os.path.join(TEST_OUTPUT_DIR, "test_corr_results.txt")
+    write_results_stream(city_stats, csv_path, correlations=report)
+    write_results_stream(city_stats, text_path, correlations=lambda: report)
+    with open(correlations_filename(csv_path)) as f:
+        csv_text = f.read()
+    with open(text_path) as f:
+        text = f.read()
+    if not csv_text.startswith("grouping,group,n,pearson_r") or \
+            "Temperature vs PM2.5 Correlations" not in text or "Group: all cities" not in text:
+        print("FAIL: correlations missing from the results files")
+        return
+
+    print("PASS: test_correlation_analytics")
+    print()
+
+
+def test_running_stats():
+    """Test Welford / Chan running statistics in Python and in CityMetricStats."""
+    import statistics
+    from running_stats import RunningStats, merge_partials, metric_stats, rebuild_metric_stats
+
+    print("Running test_running_stats...")
+
+    values = [1e9 + v for v in (4.0, 7.0, 13.0, 16.0, 2.5, 9.0)]
+    whole = RunningStats.from_values(values)
+    merged = RunningStats.from_values(values[:2]).merge(RunningStats.from_values(values[2:]))
+    for stats in (whole, merged):
+        if stats.n != 6 or abs(stats.mean - statistics.fmean(values)) > 1e-6 or \
+                abs(stats.variance() - statistics.variance(values)) > 1e-6:
+            print("FAIL: RunningStats mean / variance are wrong:", stats)
+            return
+
+    path = os.path.join(TEST_OUTPUT_DIR, "test_running_stats.db")
+    if os.path.exists(path):
+        os.remove(path)
+    create_database(path)
+    conn = sqlite3.connect(path)
+    temps = [10.0, 12.5, 9.0, 14.0]
+    store_weather_data(conn, [{
+        "city_name": "Alpha", "country": "XX", "latitude": 1.0, "longitude": 2.0,
+        "timestamp": 1_704_067_200 + 3600 * i, "temperature": t, "feels_like": None,
+        "humidity": 50 + i, "wind_speed": 1.0, "weather_main": "Clear",
+    } for i, t in enumerate(temps)])
+    store_air_quality_data(conn, [{
+        "city": "Alpha", "location": "Station",
+        "measurements": {"pm25": {"value": v, "unit": "µg/m³",
+                                  "timestamp": "2024-01-01T00:00:00Z"}},
+    } for v in (5.0, 15.0)])
+    temperature = metric_stats(conn, 1, "temperature")
+    by_metric = metric_stats(conn, 1)
+
+    # a worker's partial for values that didn't go through the triggers
+    with conn:
+        merge_partials(conn, [(1, "pm25", 1, 40.0, 0.0, 40.0, 40.0)])
+    pm25 = metric_stats(conn, 1, "pm25")
+    rebuild_metric_stats(conn)
+    rebuilt = metric_stats(conn, 1, "pm25")
+    conn.close()
+
+    if temperature is None or temperature.n != 4 or \
+            abs(temperature.variance() - statistics.variance(temps)) > 1e-9 or \
+            (temperature.min, temperature.max) != (9.0, 14.0):
+        print("FAIL: trigger-maintained temperature stats are wrong:", temperature)
+    elif "feels_like" in by_metric or by_metric["humidity"].mean != 51.5:
+        print("FAIL: per-metric stats are wrong:", by_metric)
+    elif (pm25.n, pm25.mean, pm25.max) != (3, 20.0, 40.0) or abs(pm25.m2 - 650.0) > 1e-9:
+        print("FAIL: merging a partial gave the wrong stats:", pm25)
+    elif (rebuilt.n, rebuilt.mean) != (2, 10.0):
+        print("FAIL: rebuild_metric_stats did not recompute from the tables:", rebuilt)
+    else:
+        print("PASS: test_running_stats")
+    print()
+
+
+def test_json_stream():
+    """Test incremental JSON parsing of API pages (json_stream.py)."""
+    import requests
+    from json_stream import iter_array_items, project
+
+    print("Running test_json_stream...")
+
+    sensors = [{
+        "id": i, "locationsId": 100 + i, "location": f"Station µ{i}", "value": 12.25 * i,
+        "unit": "µg/m³", "datetime": {"utc": "2024-01-01T00:00:00Z"},
+        "coordinates": {"latitude": 1.5, "longitude": -2.0},
+        "summary": {"min": 0, "max": 99}, "coverage": {"percentComplete": 100.0},
+    } for i in range(30)]
+    body = json.dumps({"meta": {"found": 30}, "results": sensors, "after": [1, 2]}).encode("utf-8")
+    expected = [project(s, OPENAQ_FIELDS) for s in sensors]
+
+    # 1-byte chunks split every multi-byte character and number
+    one_byte = list(iter_array_items((body[i:i + 1] for i in range(len(body))), "results",
+                                     OPENAQ_FIELDS))
+    big_chunks = list(iter_array_items([body[:100], body[100:]], "results", OPENAQ_FIELDS))
+    missing = list(iter_array_items([b'{"meta": {}}'], "results"))
+    if one_byte != expected or big_chunks != expected or missing != []:
+        print("FAIL: iter_array_items did not reproduce the kept fields")
+        return
+    if "summary" in one_byte[0]:
+        print("FAIL: fields that were not asked for were kept")
+        return
+
+    class FakeStreamResponse:
+        status_code = 200
+        headers = {}  # chunked: no Content-Length
+        broken = False
+
+        def iter_content(self, chunk_size=1):
+            for i in range(0, len(body), 7):
+                if self.broken and i >= len(body) // 2:
+                    raise requests.exceptions.ChunkedEncodingError("connection cut mid-body")
+                yield body[i:i + 7]
+
+        def raise_for_status(self):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        @property
+        def content(self):
+            raise AssertionError("a streamed body must not be read whole")
+
+    class FakeSession:
+        def get(self, url, **kwargs):
+            return FakeStreamResponse()
+
+    metrics.reset_api_stats()
+    rows = _fetch_openaq_page(FakeSession(), 2, 1, 30)
+    recorded = metrics.api_report().get("openaq.latest", {}).get("bytes")
+    metrics.reset_api_stats()
+    if rows != expected or recorded != len(body):
+        print("FAIL: _fetch_openaq_page streaming parse / metrics are wrong:", recorded)
+        return
+
+    # a body cut off mid-stream: counted as an error, GeoDB falls back
+    FakeStreamResponse.broken = True
+    original_get = requests.get
+    requests.get = lambda url, **kwargs: FakeStreamResponse()
+    try:
+        cities = fetch_city_data(limit=3)
+    finally:
+        requests.get = original_get
+        FakeStreamResponse.broken = False
+    report = metrics.api_report().get("geodb.cities", {})
+    metrics.reset_api_stats()
+    if cities != build_fallback_city_data(limit=3, min_population=50000):
+        print("FAIL: fetch_city_data did not fall back when the body broke off")
+        return
+    if report.get("errors") != {"ChunkedEncodingError": 1} or not 0 < report.get("bytes", 0) < len(body):
+        print("FAIL: body-read error / bytes read were not recorded:", report)
+        return
+
+    print("PASS: test_json_stream")
+    print()
+
+
+# ============================================================
+def test_figure_cache():
+    """Test the figure cache only keeps PNGs drawn by the current call."""
+    import shutil
+    import figure_cache
+    from figure_cache import cached_figure, CACHE_DIR_NAME
+
+    print("Running test_figure_cache...")
+
+    out_dir = os.path.join(TEST_OUTPUT_DIR, "test_figure_cache")
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    path = os.path.join(out_dir, "figure.png")
+    draws = []
+
+    @cached_figure(fields=("city", "avg_pm25"))
+    def fake_plot(city_stats, save_path=None, show=True):
+        draws.append(len(city_stats))
+        if len(city_stats) < 2:
+            return  # "not enough data": nothing is saved
+        with open(save_path, "wb") as f:
+            f.write(repr(city_stats).encode("utf-8"))
+
+    two = [{"city": "A", "avg_pm25": 1.0}, {"city": "B", "avg_pm25": 2.0}]
+    one = [{"city": "A", "avg_pm25": 3.0}]
+    fake_plot(two, save_path=path, show=False)
+    fake_plot(two, save_path=path, show=False)  # hit: not drawn again
+    fake_plot(one, save_path=path, show=False)  # early return, old PNG stays
+    fake_plot(one, save_path=path, show=False)  # must draw again, not a cache hit
+    cached = os.listdir(os.path.join(out_dir, CACHE_DIR_NAME))
+    if draws != [2, 1, 1] or len(cached) != 1:
+        print("FAIL: figure cache draws / entries are wrong:", draws, cached)
+        return
+
+    # interactive calls always draw but still fill the cache
+    shutil.rmtree(os.path.join(out_dir, CACHE_DIR_NAME))
+    fake_plot(two, save_path=path, show=True)
+    if not fake_plot.cache_lookup(two, path):
+        print("FAIL: a show=True render was not stored in the figure cache")
+        return
+
+    # editing a module the figure depends on, or another matplotlib,
+    # changes the fingerprint (the digest is taken when a plot is decorated)
+    helper_path = os.path.join(out_dir, "figure_cache_helper.py")
+
+    def plot_with_helper(helper_source):
+        with open(helper_path, "w", encoding="utf-8") as f:
+            f.write(helper_source)
+        return cached_figure(fields=("city", "avg_pm25"),
+                             deps=("figure_cache_helper",))(fake_plot.__wrapped__)
+
+    sys.path.insert(0, out_dir)
+    original_version = figure_cache._matplotlib_version
+    try:
+        plot_with_helper("BAR_WIDTH = 0.8\n")(two, save_path=path, show=False)
+        helper_edited = plot_with_helper("BAR_WIDTH = 0.6\n").cache_lookup(two, path)
+        unchanged = plot_with_helper("BAR_WIDTH = 0.8\n")
+        same_helper = unchanged.cache_lookup(two, path)
+        figure_cache._matplotlib_version = lambda: "0.0"
+        other_matplotlib = unchanged.cache_lookup(two, path)
+    finally:
+        figure_cache._matplotlib_version = original_version
+        sys.path.remove(out_dir)
+    if helper_edited or not same_helper or other_matplotlib:
+        print("FAIL: the fingerprint ignores the figure's dependencies:",
+              helper_edited, same_helper, other_matplotlib)
+        return
+
+    print("PASS: test_figure_cache")
+    print()
+
+
+# ============================================================
+def test_raw_archive():
+    """Test the raw-response archive (raw_archive.py) and reprocessing from it."""
+    import shutil
+    import requests
+    from raw_archive import RawArchive, map_entries
+
+    print("Running test_raw_archive...")
+
+    def weather_body(name, country, temp):
+        return json.dumps({
+            "name": name, "sys": {"country": country}, "coord": {"lat": 1.0, "lon": 2.0},
+            "dt": 1_704_067_200, "main": {"temp": temp, "feels_like": temp - 1, "humidity": 60},
+            "wind": {"speed": 3.5}, "weather": [{"main": "Clouds"}],
+        }).encode("utf-8")
+
+    def sensor(i, value):
+        return {"id": i, "locationsId": 500 + i, "location": f"Station {i}", "value": value,
+                "unit": "µg/m³", "datetime": {"utc": "2024-01-01T00:00:00Z"},
+                "coordinates": {"latitude": 1.0, "longitude": 2.0}, "summary": {}}
+
+    bodies = {
+        "Alpha,XX": weather_body("Alpha", "XX", 11.5),
+        "Beta,YY": weather_body("Beta", "YY", 21.0),
+        "parameters/2/": json.dumps({"results": [sensor(1, 8.0), sensor(2, 30.5)]}).encode(),
+        "parameters/1/": json.dumps({"results": [sensor(1, 20.0)]}).encode(),
+        "/cities": json.dumps({"data": [
+            {"id": 7, "city": "Alpha", "country": "Xland", "region": "North",
+             "population": 120000, "latitude": 1.0, "longitude": 2.0},
+        ]}).encode(),
+    }
+
+    class FakeResponse:
+        status_code = 200
+        text = ""
+
+        def __init__(self, body):
+            self.content = body
+            self.headers = {"Content-Length": str(len(body))}
+
+        def json(self):
+            return json.loads(self.content)
+
+        def iter_content(self, chunk_size=1):
+            for i in range(0, len(self.content), 16):
+                yield self.content[i:i + 16]
+
+        def raise_for_status(self):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    def fake_get(url, params=None, **kwargs):
+        for key, body in bodies.items():
+            if key in url or key == (params or {}).get("q"):
+                return FakeResponse(body)
+        raise AssertionError(f"unexpected request {url}")
+
+    class FakeSession:
+        headers = {}
+        get = staticmethod(fake_get)
+
+        def close(self):
+            pass
+
+    archive_dir = os.path.join(TEST_OUTPUT_DIR, "test_raw_archive")
+    shutil.rmtree(archive_dir, ignore_errors=True)
+    live_path = os.path.join(TEST_OUTPUT_DIR, "test_raw_archive_live.db")
+    rebuilt_path = os.path.join(TEST_OUTPUT_DIR, "test_raw_archive_rebuilt.db")
+    for path in (live_path, rebuilt_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    original_get, original_session = requests.get, requests.Session
+    requests.get, requests.Session = fake_get, FakeSession
+    use_archive(archive_dir)
+    try:
+        weather = fetch_weather(["Alpha,XX", "Beta,YY"])
+        fetch_weather(["Alpha,XX"])  # same body again: one more index line, no new object
+        aq = fetch_air_quality(["Alpha", "Beta"], parameters=("pm25", "pm10"))
+        cities = fetch_city_data(limit=1)
+    finally:
+        use_archive(None)
+        requests.get, requests.Session = original_get, original_session
+
+    archive = RawArchive(archive_dir)
+    summary = archive.summary()
+    if summary["entries"] != 7 or summary["objects"] != 5:
+        print("FAIL: archive should have 7 index entries and 5 distinct objects:", summary)
+        return
+    entry = next(archive.entries(["openweather.current"]))
+    if archive.read(entry["sha256"]) != bodies["Alpha,XX"]:
+        print("FAIL: archived body differs from the response")
+        return
+
+    # the tables built from the live responses...
+    create_database(live_path)
+    live = sqlite3.connect(live_path)
+    store_weather_data(live, weather)
+    store_air_quality_data(live, aq)
+    store_city_data(live, cities)
+
+    # ...and from the archive alone, parsed in two worker processes
+    entries = list(archive.entries())
+    in_process = list(map_entries(archive, entries, _parse_archived, workers=1))
+    in_workers = list(map_entries(archive, entries, _parse_archived, workers=2, chunk_size=2))
+    if in_process != in_workers:
+        print("FAIL: parsing in worker processes gave different results")
+        live.close()
+        return
+
+    create_database(rebuilt_path)
+    rebuilt = sqlite3.connect(rebuilt_path)
+    reprocess_archive(rebuilt, archive, workers=2)
+    reprocess_archive(rebuilt, archive, workers=1)  # again: replaces, doesn't add
+
+    queries = [
+        "SELECT city_name, country FROM Cities ORDER BY id",
+        "SELECT city_id, timestamp, temperature, feels_like, humidity, wind_speed, weather_main "
+        "FROM WeatherObservations ORDER BY city_id",
+        "SELECT l.city_id, l.location_name, m.parameter, m.value, m.unit, m.timestamp "
+        "FROM AirQualityMeasurements AS m JOIN AirQualityLocations AS l ON l.id = m.location_id "
+        "ORDER BY l.city_id, m.parameter",
+        "SELECT geodb_id, city_name, country, region FROM GeoCities ORDER BY geodb_id",
+        "SELECT * FROM CityMetricStats ORDER BY city_id, metric",
+    ]
+    for query in queries:
+        expected = live.execute(query).fetchall()
+        got = rebuilt.execute(query).fetchall()
+        if got != expected or not expected:
+            print(f"FAIL: reprocessed rows differ for {query!r}:", got, expected)
+            live.close()
+            rebuilt.close()
+            return
+    rebuilt.close()
+
+    # rows that didn't come from the archive survive a reprocess, and the
+    # archived ones already there are replaced, not duplicated
+    store_weather_data(live, [{"city_name": "Gamma", "country": "ZZ", "timestamp": 1_704_067_200,
+                               "temperature": 4.0, "feels_like": 2.0, "humidity": 80,
+                               "wind_speed": 1.0, "weather_main": "Snow"}])
+    store_air_quality_data(live, [{"city": "Gamma", "location": "Hand Station", "latitude": None,
+                                   "longitude": None, "pm25": 9.0,
+                                   "timestamp": "2024-01-01T00:00:00Z"}])
+    store_city_data(live, build_fallback_city_data(limit=1))
+    before = [sorted(live.execute(query).fetchall(), key=repr) for query in queries]
+    reprocess_archive(live, archive, workers=1)
+    reprocess_archive(live, archive, sources=("geodb",), workers=1)
+    after = [sorted(live.execute(query).fetchall(), key=repr) for query in queries]
+    live.close()
+    if after != before:
+        print("FAIL: reprocessing changed rows the archive has no response for:", after, before)
+        return
+
+    print("PASS: test_raw_archive")
+    print()
+
+
+# ============================================================
+def test_cli_legacy_db():
+    """Test the read-side sub-commands migrate a pre-city_id database first."""
+    print("Running test_cli_legacy_db...")
+
+    os.makedirs(TEST_OUTPUT_DIR, exist_ok=True)
+    path = os.path.join(TEST_OUTPUT_DIR, "test_cli_legacy.db")
+    results_path = os.path.join(TEST_OUTPUT_DIR, "test_cli_legacy_results.txt")
+    if os.path.exists(path):
+        os.remove(path)
+
+    # the schema of the shipped final_project.db: stations keyed by city name
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE Cities (id INTEGER PRIMARY KEY AUTOINCREMENT, city_name TEXT,
+                             country TEXT, latitude REAL, longitude REAL);
+        CREATE TABLE WeatherObservations (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            city_id INTEGER, timestamp TEXT, temperature REAL, feels_like REAL,
+            humidity INTEGER, wind_speed REAL, weather_main TEXT);
+        CREATE TABLE AirQualityLocations (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            city_name TEXT, location_name TEXT, country TEXT, latitude REAL, longitude REAL);
+        CREATE TABLE AirQualityMeasurements (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            location_id INTEGER, timestamp TEXT, parameter TEXT, value REAL, unit TEXT);
+        INSERT INTO Cities (city_name, country, latitude, longitude)
+            VALUES ('Legacy Town', 'US', 40.0, -75.0);
+        INSERT INTO WeatherObservations (city_id, timestamp, temperature, feels_like,
+                                         humidity, wind_speed, weather_main)
+            VALUES (1, '1704067200', 12.5, 11.0, 60, 2.0, 'Clear');
+        INSERT INTO AirQualityLocations (city_name, location_name, country, latitude, longitude)
+            VALUES ('Legacy Town', 'Old Station', 'US', 40.0, -75.0);
+        INSERT INTO AirQualityMeasurements (location_id, timestamp, parameter, value, unit)
+            VALUES (1, '2024-01-01T00:00:00Z', 'pm25', 14.0, 'µg/m³');
+    """)
+    conn.close()
+
+    try:
+        main(["--db", path, "stats", "--results-file", results_path])
+        main(["--db", path, "correlations"])
+    except sqlite3.OperationalError as e:
+        print("FAIL: a sub-command read the legacy schema without migrating it:", e)
+        return
+
+    with open(results_path, encoding="utf-8") as f:
+        results = f.read()
+    conn = sqlite3.connect(path)
+    linked = conn.execute("SELECT city_id FROM AirQualityLocations").fetchall()
+    conn.close()
+    if linked != [(1,)] or "Legacy Town" not in results:
+        print("FAIL: legacy stations were not linked to their city:", linked)
+        return
+
+    print("PASS: test_cli_legacy_db")
+    print()
+
+
 # ============================================================
 # RUN MAIN
 # ============================================================
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv[1:])
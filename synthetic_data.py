@@ -0,0 +1,333 @@
+# ============================================================
+# synthetic_data.py
+# Seeded synthetic databases for load testing (any number of cities)
+# ============================================================
+#
+# generate_database(path, n_cities, hours) fills the create_database schema
+# with
+#   - n_cities cities scattered around real metro areas (ANCHORS), with
+#     rank-size (Zipf) populations, coordinates and matching GeoCities /
+#     CityDetails / CityCrosswalk rows so calculate_city_stats finds their
+#     population,
+#   - one AirQualityLocations station per city,
+#   - `hours` hourly weather observations per city (seasonal + daily cycle
+#     that depends on latitude / longitude),
+#   - `hours` hourly readings per city for every requested pollutant
+#     (log-normal around a regional level, worse in winter and at rush hour).
+#
+# Everything is generated with numpy for a block of cities at a time and
+# written with executemany (no journal, indexes rebuilt once at the end), so
+# the cost is essentially sqlite3's own insert speed. The per-row triggers
+# of the derived tables are off during the load: every block merges its
+# per-city CityMetricStats partials (running_stats.array_partials) instead,
+# and RollingBuckets is filled in one pass at the end. The same seed always
+# gives the same database.
+#
+#   python starter.py synth load_test.db --cities 50000 --hours 100
+
+import os
+import sqlite3
+
+DEFAULT_START = 1_704_067_200  # 2024-01-01T00:00:00Z
+STEP_SECONDS = 3600
+BATCH_ROWS = 500_000  # rows generated + inserted per block of cities
+
+# (name, country, latitude, longitude, typical PM2.5 in µg/m³)
+ANCHORS = [
+    ("New York", "US", 40.71, -74.01, 8.0),
+    ("Los Angeles", "US", 34.05, -118.24, 12.0),
+    ("Chicago", "US", 41.88, -87.63, 9.5),
+    ("Houston", "US", 29.76, -95.37, 10.0),
+    ("Mexico City", "MX", 19.43, -99.13, 20.0),
+    ("Toronto", "CA", 43.65, -79.38, 7.5),
+    ("Bogota", "CO", 4.71, -74.07, 15.0),
+    ("Lima", "PE", -12.05, -77.04, 25.0),
+    ("Sao Paulo", "BR", -23.55, -46.63, 16.0),
+    ("Buenos Aires", "AR", -34.60, -58.38, 12.0),
+    ("London", "GB", 51.51, -0.13, 9.0),
+    ("Paris", "FR", 48.86, 2.35, 11.0),
+    ("Berlin", "DE", 52.52, 13.40, 10.0),
+    ("Madrid", "ES", 40.42, -3.70, 9.0),
+    ("Rome", "IT", 41.90, 12.50, 13.0),
+    ("Warsaw", "PL", 52.23, 21.01, 18.0),
+    ("Moscow", "RU", 55.76, 37.62, 12.0),
+    ("Istanbul", "TR", 41.01, 28.98, 20.0),
+    ("Cairo", "EG", 30.04, 31.24, 45.0),
+    ("Lagos", "NG", 6.52, 3.38, 40.0),
+    ("Nairobi", "KE", -1.29, 36.82, 18.0),
+    ("Johannesburg", "ZA", -26.20, 28.05, 22.0),
+    ("Tehran", "IR", 35.69, 51.39, 30.0),
+    ("Karachi", "PK", 24.86, 67.01, 55.0),
+    ("Delhi", "IN", 28.61, 77.21, 95.0),
+    ("Mumbai", "IN", 19.08, 72.88, 45.0),
+    ("Dhaka", "BD", 23.81, 90.41, 75.0),
+    ("Bangkok", "TH", 13.76, 100.50, 25.0),
+    ("Jakarta", "ID", -6.21, 106.85, 35.0),
+    ("Manila", "PH", 14.60, 120.98, 18.0),
+    ("Beijing", "CN", 39.90, 116.41, 40.0),
+    ("Shanghai", "CN", 31.23, 121.47, 32.0),
+    ("Chengdu", "CN", 30.57, 104.07, 45.0),
+    ("Seoul", "KR", 37.57, 126.98, 22.0),
+    ("Tokyo", "JP", 35.68, 139.69, 11.0),
+    ("Sydney", "AU", -33.87, 151.21, 7.0),
+    ("Melbourne", "AU", -37.81, 144.96, 7.5),
+    ("Auckland", "NZ", -36.85, 174.76, 6.0),
+]
+
+# pollutant -> (unit, level relative to the city's PM2.5 level)
+# (units match the AQI tables in aqi.py)
+POLLUTANT_PROFILES = {
+    "pm25": ("µg/m³", 1.0),
+    "pm10": ("µg/m³", 1.8),
+    "no2": ("ppb", 1.5),
+    "so2": ("ppb", 0.3),
+    "o3": ("ppm", 0.0015),
+    "co": ("ppm", 0.03),
+}
+
+_WEATHER_SQL = """
+    INSERT INTO WeatherObservations
+        (city_id, timestamp, temperature, feels_like, humidity, wind_speed, weather_main)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+_AQ_SQL = """
+    INSERT INTO AirQualityMeasurements (location_id, timestamp, parameter, value, unit)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+
+def generate_cities(n_cities, seed=0):
+    """
+    Column arrays for n_cities synthetic cities:
+    name, country, latitude, longitude, population, pm25_level.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    anchor_lat = np.array([a[2] for a in ANCHORS])
+    anchor_lon = np.array([a[3] for a in ANCHORS])
+    anchor_pm25 = np.array([a[4] for a in ANCHORS])
+
+    anchor = rng.integers(0, len(ANCHORS), n_cities)
+    # most towns lie within a few hundred km of their metro
+    latitude = np.clip(anchor_lat[anchor] + rng.normal(0, 2.5, n_cities), -55, 70)
+    longitude = (anchor_lon[anchor] + rng.normal(0, 3.5, n_cities) + 180) % 360 - 180
+
+    # rank-size rule: the r-th largest city has ~ 1/r of the largest's population
+    ranks = rng.permutation(n_cities) + 1
+    population = np.maximum(20_000_000 / ranks ** 1.05 * rng.lognormal(0, 0.15, n_cities), 500)
+    population = population.astype(np.int64)
+
+    # bigger cities are somewhat dirtier than their region's typical level
+    pm25_level = (anchor_pm25[anchor] * rng.lognormal(0, 0.3, n_cities)
+                  * (1 + 0.08 * np.log10(population / 100_000)))
+    pm25_level = np.maximum(pm25_level, 1.0)
+
+    names = [f"{ANCHORS[a][0]} Synthetic {i}" for i, a in enumerate(anchor.tolist())]
+    countries = [ANCHORS[a][1] for a in anchor.tolist()]
+    return {
+        "name": names,
+        "country": countries,
+        "latitude": latitude,
+        "longitude": longitude,
+        "population": population,
+        "pm25_level": pm25_level,
+    }
+
+
+def _block_partials(partials, city_ids, columns):
+    """Append (city_id, metric, n, mean, m2, min, max) rows for {metric: cities x times array}."""
+    from running_stats import array_partials
+
+    ids = city_ids.tolist()
+    for metric, values in columns.items():
+        partials.extend(zip(ids, [metric] * len(ids), *(a.tolist() for a in array_partials(values))))
+
+
+def _weather_block(rng, city_ids, latitude, longitude, times, partials=None):
+    """
+    Row tuples for a block of cities x times (city-major, time ascending);
+    per-city statistics of the stored values are appended to partials.
+    """
+    import numpy as np
+
+    n_c, n_t = len(city_ids), len(times)
+    day_of_year = (times - DEFAULT_START) / 86_400.0 % 365.25
+    utc_hour = times / 3600.0 % 24
+
+    lat = latitude[:, None]
+    mean_temp = 28.0 - 0.45 * np.abs(lat)
+    # seasons: coldest mid-January in the north, mid-July in the south
+    amplitude = 0.3 * np.abs(lat)
+    season = -np.cos(2 * np.pi * (day_of_year[None, :] - 15) / 365.25) * np.sign(lat)
+    local_hour = (utc_hour[None, :] + longitude[:, None] / 15.0) % 24
+    daily = 4.0 * np.cos(2 * np.pi * (local_hour - 15) / 24)  # warmest at 3pm
+    temperature = mean_temp + amplitude * season + daily + rng.normal(0, 2.0, (n_c, n_t))
+
+    humidity = np.clip(rng.normal(65, 15, (n_c, n_t)) - 0.8 * daily, 5, 100).astype(np.int64)
+    wind = np.round(rng.gamma(2.0, 1.8, (n_c, n_t)), 2)
+    feels_like = temperature - 0.7 * wind + 0.02 * (humidity - 50)
+
+    weather_main = np.where(temperature < 0, "Snow", "Clear").astype(object)
+    rain = rng.random((n_c, n_t))
+    weather_main[(rain < 0.35) & (temperature >= 0)] = "Clouds"
+    weather_main[(rain < 0.12) & (temperature >= 0)] = "Rain"
+
+    temperature = np.round(temperature, 2)
+    feels_like = np.round(feels_like, 2)
+    if partials is not None:
+        _block_partials(partials, city_ids, {"temperature": temperature, "feels_like": feels_like,
+                                             "humidity": humidity, "wind_speed": wind})
+
+    return zip(
+        np.repeat(city_ids, n_t).tolist(),
+        np.tile(times, n_c).tolist(),
+        temperature.ravel().tolist(),
+        feels_like.ravel().tolist(),
+        humidity.ravel().tolist(),
+        wind.ravel().tolist(),
+        weather_main.ravel().tolist(),
+    )
+
+
+def _pollutant_block(rng, location_ids, latitude, longitude, pm25_level,
+                     times, iso_times, parameter, partials=None):
+    """
+    Row tuples for one pollutant over a block of locations x times
+    (location i is in city i); per-city statistics go to partials.
+    """
+    import numpy as np
+
+    unit, ratio = POLLUTANT_PROFILES[parameter]
+    n_c, n_t = len(location_ids), len(times)
+    day_of_year = (times - DEFAULT_START) / 86_400.0 % 365.25
+    local_hour = (times[None, :] / 3600.0 + longitude[:, None] / 15.0) % 24
+
+    # winter inversions + morning / evening traffic peaks
+    winter = 1 + 0.25 * np.cos(2 * np.pi * (day_of_year[None, :] - 15) / 365.25) * np.sign(latitude[:, None])
+    rush = 1 + 0.2 * (np.exp(-((local_hour - 8) ** 2) / 4) + np.exp(-((local_hour - 19) ** 2) / 4))
+    values = (pm25_level[:, None] * ratio) * winter * rush * rng.lognormal(-0.08, 0.4, (n_c, n_t))
+
+    values = np.round(values, 4 if unit == "ppm" else 2)
+    if partials is not None:
+        _block_partials(partials, location_ids, {parameter: values})
+    return zip(
+        np.repeat(location_ids, n_t).tolist(),
+        iso_times * n_c,
+        [parameter] * (n_c * n_t),
+        values.ravel().tolist(),
+        [unit] * (n_c * n_t),
+    )
+
+
+def generate_database(path, n_cities, hours=168, start=DEFAULT_START, seed=0,
+                      pollutants=("pm25",), batch_rows=BATCH_ROWS, overwrite=False):
+    """
+    Create `path` and fill it with synthetic data (see module comment).
+
+    Returns a dict with the row counts. Refuses to touch an existing file
+    unless overwrite=True.
+    """
+    import numpy as np
+    from create_database import create_database, fill_rolling_buckets
+    from running_stats import merge_partials
+
+    unknown = [p for p in pollutants if p not in POLLUTANT_PROFILES]
+    if unknown:
+        raise ValueError(f"Unknown pollutant(s) {unknown}; known: {', '.join(POLLUTANT_PROFILES)}")
+    if os.path.exists(path):
+        if not overwrite:
+            raise FileExistsError(f"{path} already exists (overwrite=True / --overwrite replaces it)")
+        os.remove(path)
+    create_database(path)
+
+    rng = np.random.default_rng(seed)
+    cities = generate_cities(n_cities, seed=seed)
+    city_ids = np.arange(1, n_cities + 1)
+
+    conn = sqlite3.connect(path)
+    # a throw-away load-test database: no need to survive a power cut
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+
+    geodb_ids = [f"synthetic-{i}" for i in city_ids.tolist()]
+    with conn:
+        conn.executemany(
+            "INSERT INTO Cities (id, city_name, country, latitude, longitude) VALUES (?, ?, ?, ?, ?)",
+            zip(city_ids.tolist(), cities["name"], cities["country"],
+                np.round(cities["latitude"], 4).tolist(), np.round(cities["longitude"], 4).tolist()),
+        )
+        conn.executemany(
+            "INSERT INTO GeoCities (geodb_id, city_name, country, region, latitude, longitude) "
+            "VALUES (?, ?, ?, NULL, ?, ?)",
+            zip(geodb_ids, cities["name"], cities["country"],
+                np.round(cities["latitude"], 4).tolist(), np.round(cities["longitude"], 4).tolist()),
+        )
+        conn.executemany(
+            "INSERT INTO CityDetails (geodb_id, population, elevation, density) VALUES (?, ?, NULL, NULL)",
+            zip(geodb_ids, cities["population"].tolist()),
+        )
+        # the generator knows which GeoDB row is which city
+        conn.executemany(
+            "INSERT INTO CityCrosswalk (city_id, geodb_id, method, distance_km) "
+            "VALUES (?, ?, 'synthetic', 0)",
+            zip(city_ids.tolist(), geodb_ids),
+        )
+        # one station per city, a few km from the centre
+        conn.executemany(
+            "INSERT INTO AirQualityLocations (id, city_id, location_name, latitude, longitude) "
+            "VALUES (?, ?, ?, ?, ?)",
+            zip(city_ids.tolist(), city_ids.tolist(),
+                [f"{name} Station" for name in cities["name"]],
+                np.round(cities["latitude"] + rng.normal(0, 0.03, n_cities), 4).tolist(),
+                np.round(cities["longitude"] + rng.normal(0, 0.03, n_cities), 4).tolist()),
+        )
+
+    # building the big indexes once at the end is cheaper than updating them
+    # row by row; their definitions are taken from the schema itself
+    big_indexes = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+        "AND tbl_name IN ('WeatherObservations', 'AirQualityMeasurements')"
+    ).fetchall()
+    for name, _ in big_indexes:
+        conn.execute(f"DROP INDEX {name}")
+    # per-row derived-table triggers off: blocks merge their CityMetricStats
+    # partials, RollingBuckets is rebuilt once at the end
+    stats_triggers = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' "
+        "AND (name LIKE 'metric_stats_%' OR name LIKE 'rolling_%')"
+    ).fetchall()
+    for name, _ in stats_triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+
+    times = start + STEP_SECONDS * np.arange(hours, dtype=np.int64)
+    iso_times = [t + "Z" for t in np.datetime_as_string(times.astype("datetime64[s]"), unit="s").tolist()]
+
+    block = max(1, batch_rows // max(hours, 1))
+    for lo in range(0, n_cities, block):
+        hi = min(lo + block, n_cities)
+        ids = city_ids[lo:hi]
+        lat = cities["latitude"][lo:hi]
+        lon = cities["longitude"][lo:hi]
+        partials = []
+        with conn:
+            conn.executemany(_WEATHER_SQL, _weather_block(rng, ids, lat, lon, times, partials))
+            # parameters sorted so rows arrive in idx_aqm_location_param_time order
+            for parameter in sorted(pollutants):
+                conn.executemany(_AQ_SQL, _pollutant_block(
+                    rng, ids, lat, lon, cities["pm25_level"][lo:hi], times, iso_times, parameter,
+                    partials))
+            merge_partials(conn, partials)
+
+    with conn:
+        for _, sql in big_indexes + stats_triggers:
+            conn.execute(sql)
+        # after the indexes: the AQ pass reads measurements per station
+        fill_rolling_buckets(conn.cursor())
+    conn.close()
+
+    return {
+        "cities": n_cities,
+        "weather_rows": n_cities * hours,
+        "aq_rows": n_cities * hours * len(pollutants),
+    }